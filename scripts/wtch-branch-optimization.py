@@ -1,22 +1,168 @@
 #!/usr/bin/env python
+import glob
 import pickle
 import os
 from collections import namedtuple
+from multiprocessing.pool import ThreadPool
 import tempfile
 import subprocess
 import numpy as np
 import click
-from asyncio.subprocess import DEVNULL
+
+from wmb.likelihood import encode_likelihood_alignment, optimized_jc69_trees_pool
+from wmb.parsimony import load_fasta
+from wmb.score_cache import (
+    ScoreRecord,
+    alignment_digest,
+    lookup_scores,
+    open_score_cache,
+    store_scores,
+    topology_key,
+)
 
 TreeData = namedtuple("TreeData", "pp_dict tree_set")
 
+IQTREE_LOG_LIKELIHOOD_PREFIX = "Log-likelihood of the tree: "
+
+# The model name of iqtree results in the score cache.
+IQTREE_CACHE_MODEL = "iqtree-jc69"
+
+# The model names in the score cache of the results of each backend. The jc69 backend
+# is wmb.likelihood, which optimizes the same model as iqtree in process. Its results
+# used to depend on the order in which the trees were scored, so they are cached under
+# a new name.
+BACKEND_CACHE_MODELS = {"iqtree": IQTREE_CACHE_MODEL, "jc69": "wmb-jc69-2"}
+
 
 def tree_data_of_path(tree_pickle_path):
     pp_dict, tree_ci_list = pickle.load(open(tree_pickle_path, "rb"))
     return TreeData(pp_dict, set(tree_ci_list))
 
 
-def optimize_branch_lengths(topology_set, sequence_file_path, sort=True):
+def parse_iqtree_log_likelihood(report_path):
+    """Returns the log-likelihood of the tree in the iqtree report report_path, from
+    the line "Log-likelihood of the tree: <value> (s.e. <error>)".
+    """
+    with open(report_path) as the_file:
+        for line in the_file:
+            if line.startswith(IQTREE_LOG_LIKELIHOOD_PREFIX):
+                return float(line[len(IQTREE_LOG_LIKELIHOOD_PREFIX) :].split()[0])
+    raise ValueError(f"No log-likelihood found in {report_path}")
+
+
+def run_iqtree(topology, sequence_file_path, prefix):
+    """
+    Returns the pair (T, L) of the tree T with branch lengths optimized by iqtree for
+    the topology and L its log-likelihood. All of the files of iqtree are written with
+    the given prefix, and are removed afterwards.
+    """
+    topology_path = prefix + ".topology.nwk"
+    with open(topology_path, "w") as fp:
+        fp.write(topology + "\n")
+
+    # Run iqtree on the tree. The command below may throw a runtime warning:
+    #       OMP: Info #271: omp_set_nested routine deprecated, please use
+    #       omp_set_max_active_levels instead.
+    # This is an issue with the installed version of openMP. Since it is only a
+    # warning, people say just ignore it. We redirect to suppress the message.
+    subprocess.run(
+        [
+            "iqtree",
+            "--redo",
+            "--quiet",
+            "-s",
+            sequence_file_path,
+            "-te",
+            topology_path,
+            "-m",
+            "jc69",
+            "-pre",
+            prefix,
+        ],
+        stderr=subprocess.DEVNULL,
+        check=True,
+    )
+    with open(prefix + ".treefile") as the_file:
+        optimized_tree = the_file.read().strip()
+    log_likelihood = parse_iqtree_log_likelihood(prefix + ".iqtree")
+
+    for path in glob.glob(glob.escape(prefix) + ".*"):
+        os.remove(path)
+    return optimized_tree, log_likelihood
+
+
+def run_iqtree_pool(topologies, sequence_file_path, jobs=1):
+    """
+    Yields the pairs of run_iqtree for the topologies, in the order of topologies. Up
+    to jobs iqtree processes run at once, each with its own prefix in a private scratch
+    directory, so concurrent runs on the same sequence file do not collide.
+    """
+    with tempfile.TemporaryDirectory() as scratch_dir:
+
+        def run_task(task):
+            index, topology = task
+            prefix = os.path.join(scratch_dir, f"tree-{index}")
+            return run_iqtree(topology, sequence_file_path, prefix)
+
+        # The work happens in the iqtree processes, so threads suffice to drive them.
+        with ThreadPool(processes=jobs) as pool:
+            yield from pool.imap(run_task, enumerate(topologies))
+
+
+def run_backend(topologies, sequence_file_path, jobs=1, backend="iqtree"):
+    """
+    Yields the pairs (T, L) of the tree T with optimized branch lengths for each of the
+    topologies and L its log-likelihood, in the order of topologies. The backend is
+    either "iqtree" (see run_iqtree_pool) or "jc69", which computes them in jobs worker
+    processes (see wmb.likelihood.optimized_jc69_trees_pool).
+    """
+    if backend == "iqtree":
+        yield from run_iqtree_pool(topologies, sequence_file_path, jobs)
+    elif backend == "jc69":
+        alignment = encode_likelihood_alignment(load_fasta(sequence_file_path))
+        yield from optimized_jc69_trees_pool(topologies, alignment, jobs)
+    else:
+        raise ValueError(f"Unknown backend: {backend}")
+
+
+def iter_optimized_trees(
+    topologies, sequence_file_path, jobs=1, cache=None, backend="iqtree"
+):
+    """
+    Yields the pairs of run_backend for the topologies, in the order of topologies.
+    When a ScoreCache is given, the backend only runs on the topologies missing from
+    it, and their results are added to it.
+    """
+    if cache is None:
+        yield from run_backend(topologies, sequence_file_path, jobs, backend)
+        return
+    model = BACKEND_CACHE_MODELS[backend]
+    digest = alignment_digest(load_fasta(sequence_file_path))
+    keys = [topology_key(topology) for topology in topologies]
+    records = lookup_scores(cache, digest, model, keys)
+    missing = {}
+    for key, topology in zip(keys, topologies):
+        if key not in records:
+            missing.setdefault(key, topology)
+    # The missing topologies come back in the order of their first appearance.
+    missing_results = run_backend(
+        list(missing.values()), sequence_file_path, jobs, backend
+    )
+    new_records = {}
+    try:
+        for key in keys:
+            if key not in records:
+                records[key] = new_records[key] = ScoreRecord(
+                    *next(missing_results), None
+                )
+            yield records[key].optimized_newick, records[key].log_likelihood
+    finally:
+        store_scores(cache, digest, model, new_records)
+
+
+def optimize_branch_lengths(
+    topology_set, sequence_file_path, sort=True, jobs=1, cache=None, backend="iqtree"
+):
     """
     Returns the list of trees in topology_set with optimal branch lengths, optionally
     ordered by likelihood (highest likelihood first).
@@ -25,63 +171,29 @@ def optimize_branch_lengths(topology_set, sequence_file_path, sort=True):
                         their Newick tree format (without branch lengths).
                     sequence_file_path (string): The file containing the sequencing
                         data for the tree tips.
+                    jobs (int): The number of iqtree or worker processes to run at
+                        once.
+                    cache (ScoreCache): An optional cache of the results (see
+                        wmb.score_cache).
+                    backend (string): Either "iqtree" or "jc69" (see run_backend).
             Returns:
                     optimized_trees (list): The list of trees from topology_set. Each
                     tree is represented as a string of their Newick tree format (with
                     optimal branch lengths). This list is optionally ordered according
-                    to the log-likelihood from iqtree, with maximum likelihood first.
+                    to the log-likelihood from the backend, with maximum likelihood
+                    first.
     """
-    topology_file_name = "topology.nwk"
-    optimized_file_name = "optimized-trees.nwk"
-    likelihood_file_name = "tree-likelihoods.temp"
-    with tempfile.TemporaryDirectory() as tmpdir:
-        topology_path = os.path.join(tmpdir, topology_file_name)
-        optimized_path = os.path.join(tmpdir, optimized_file_name)
-        likelihood_path = os.path.join(tmpdir, likelihood_file_name)
-
-        for topology in topology_set:
-            with open(topology_path, "w") as fp:
-                fp.write(topology + "\n")
-
-            # Run iqtree on the tree. The command below may throw a runtime warning:
-            #       OMP: Info #271: omp_set_nested routine deprecated, please use
-            #       omp_set_max_active_levels instead.
-            # This is an issue with the installed version of openMP. Since it is only a
-            # warning, people say just ignore it. We redirect to suppress the message.
-            subprocess.check_call(
-                f"iqtree --redo --quiet -s {sequence_file_path} -te {topology_path} "
-                + "-m jc69",
-                shell=True,
-                stderr=DEVNULL,
-            )
+    results = list(
+        iter_optimized_trees(topology_set, sequence_file_path, jobs, cache, backend)
+    )
+    optimized_trees = [tree for tree, _ in results]
 
-            # Add the tree with optimized branch lengths somewhere temporary, same for
-            # the likelihoods. Grabbing the likelihood requires some magic to find it
-            # in the full report.
-            subprocess.check_call(
-                f"cat {sequence_file_path}.treefile >> {optimized_path}", shell=True
-            )
-            subprocess.check_call(
-                f'grep "Log-likelihood of the tree: " {sequence_file_path}.iqtree | '
-                + "sed -e 's/^Log\\-likelihood of the tree: \\(.*\\) (.*$/\\1/;'"
-                + f">> {likelihood_path}",
-                shell=True,
-            )
-
-        # Load all the tree info into variables.
-        with open(optimized_path, "r") as the_file:
-            optimized_trees = the_file.read().splitlines()
-
-        if sort:
-            tree_likelihoods = np.loadtxt(likelihood_path, delimiter=";", dtype=float)
-            indices_for_sort = np.flip(np.argsort(tree_likelihoods))
-            optimized_trees = [optimized_trees[j] for j in indices_for_sort]
+    if sort:
+        tree_likelihoods = np.array([likelihood for _, likelihood in results])
+        indices_for_sort = np.flip(np.argsort(tree_likelihoods))
+        optimized_trees = [optimized_trees[j] for j in indices_for_sort]
 
-        # Clean up local files.
-        for extension in ["ckp.gz", "iqtree", "log", "treefile"]:
-            subprocess.check_call(f"rm {sequence_file_path}.{extension}", shell=True)
-
-        return optimized_trees
+    return optimized_trees
 
 
 @click.command()
@@ -89,11 +201,48 @@ def optimize_branch_lengths(topology_set, sequence_file_path, sort=True):
 @click.argument("fasta_path")
 @click.argument("output_path")
 @click.option("--sort", default=True)
-def wrapper_for_tree_optimizing(topology_path, fasta_path, output_path, sort=True):
+@click.option("--jobs", default=1, help="Number of processes to run at once.")
+@click.option(
+    "--backend",
+    type=click.Choice(sorted(BACKEND_CACHE_MODELS)),
+    default="iqtree",
+    help="Run iqtree, or optimize the JC69 likelihood in process.",
+)
+@click.option(
+    "--score_cache",
+    default=None,
+    help="Path of the score cache, by default $WTCH_SCORE_CACHE or under ~/.cache.",
+)
+@click.option(
+    "--no_score_cache", is_flag=True, help="Run the backend on every topology."
+)
+def wrapper_for_tree_optimizing(
+    topology_path,
+    fasta_path,
+    output_path,
+    sort=True,
+    jobs=1,
+    backend="iqtree",
+    score_cache=None,
+    no_score_cache=False,
+):
     with open(topology_path, "r") as the_file:
         topology_data = the_file.read().splitlines()
-
-    optimized_trees = optimize_branch_lengths(topology_data, fasta_path, sort)
+    cache = None if no_score_cache else open_score_cache(score_cache)
+
+    if sort:
+        optimized_trees = optimize_branch_lengths(
+            topology_data, fasta_path, sort, jobs, cache, backend
+        )
+    else:
+        # Without sorting, each tree is written as soon as it and the trees before it
+        # are done.
+        optimized_trees = (
+            tree
+            for tree, _ in iter_optimized_trees(
+                topology_data, fasta_path, jobs, cache, backend
+            )
+        )
 
     with open(output_path, "w") as the_output_file:
         for tree in optimized_trees:
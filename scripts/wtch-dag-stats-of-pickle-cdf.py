@@ -3,13 +3,14 @@
 import bito
 import json
 import tempfile
-import pickle
 import click
 import os
 
+from wmb.posterior import read_posterior
+
 
 def write_stats(pickle_path, out_stats_path):
-    pp_dict, tree_ci_list = pickle.load(open(pickle_path, "rb"))
+    pp_dict, tree_ci_list = read_posterior(pickle_path)
 
     with tempfile.TemporaryDirectory() as tmpdir:
         ci_path = os.path.join(tmpdir, "ci_trees.nwk")
@@ -11,12 +11,4 @@ fi
 tree_path="$1"
 root_taxon="$2"
 
-temp_file=$(mktemp)
-trap "rm -f $temp_file" 0 2 3 15
-
-cat "$tree_path" | while read line
-do
-    echo $line | spr_neighbors --nni >> $temp_file
-done
-
-cat $temp_file | nw_reroot - $root_taxon | nw_order - | sort -R | uniq
+wmb nni-neighbors "$tree_path" "$root_taxon" --seed 0
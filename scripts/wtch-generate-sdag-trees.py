@@ -1,10 +1,10 @@
 #!/usr/bin/env python
 
-import pickle
-
 import bito
 import click
 
+from wmb.posterior import read_posterior
+
 
 def build_sdag_trees(read_collection_path, write_sdag_path):
     mmap_path = "_ignore/mmap.dat"
@@ -41,7 +41,7 @@ def cli(sample_trees_path, write_sdag_path, pickle_path):
     python generate-sdag-trees.py _ignore/rerooted-topologies.noburnin.10000.nwk\
         _ignore/sdag-trees.10000.nwk _ignore/golden.pickle
     """
-    pp_dict, tree_ci_list = pickle.load(open(pickle_path, "rb"))
+    pp_dict, tree_ci_list = read_posterior(pickle_path)
     build_sdag_trees(sample_trees_path, write_sdag_path)
     sum_pp, count_in_ci = count_pp(pp_dict, tree_ci_list)
     click.echo(f"{sum_pp} {count_in_ci}")
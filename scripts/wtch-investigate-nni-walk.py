@@ -1,20 +1,14 @@
 #!/usr/bin/env python
-import pickle
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import json
-import pathlib
-from collections import namedtuple
 import click
 
-
-GoldenData = namedtuple("GoldenData", "pp_dict credible_set")
-
-
-def golden_data_of_path(golden_pickle_path):
-    pp_dict, tree_ci_list = pickle.load(open(golden_pickle_path, "rb"))
-    return GoldenData(pp_dict, set(tree_ci_list))
+from wmb.mcmc import mcmc_df_of_topology_sequence
+from wmb.posterior import open_posterior
+from wmb.representations import iter_sdag_rep_batches, sdag_rep_hashes
+from wmb.walk_metrics import new_node_flags, read_tree_set, tree_set_lookup
 
 
 def dict_of_json(json_path):
@@ -22,77 +16,42 @@ def dict_of_json(json_path):
         return json.load(json_file)
 
 
-def mcmc_df_of_topology_sequence(topology_sequence_path, golden):
-    pathlib.Path("topologies-seen").mkdir(exist_ok=True)
-    df = pd.read_csv(
-        topology_sequence_path, delimiter="\t", names=["dwell_count", "topology"]
-    )
-    # The set of topologies seen so far.
-    seen = set()
-    # A list that tracks each topology observed in the sequence and marks if it was seen
-    # for the first time.
-    first_time = []
-
-    for topology in df["topology"]:
-        if topology in seen:
-            first_time.append(False)
-        else:
-            first_time.append(True)
-            seen.add(topology)
-    df["first_time"] = first_time
-    df["support_size"] = df["first_time"].cumsum()
-    df["mcmc_iters"] = df["dwell_count"].cumsum()
-    df["pp"] = df["topology"].apply(lambda t: golden.pp_dict.get(t, 0.0))
-    df["total_pp"] = (df["pp"] * df["first_time"]).cumsum()
-    df["in_credible_set"] = df["topology"].apply(golden.credible_set.__contains__)
-    df["credible_set_found"] = (df["in_credible_set"] & df["first_time"]).cumsum()
-    df["credible_set_frac"] = df["credible_set_found"] / len(golden.credible_set)
-    return df
-
-
-def indexer_reps_of_path(path, sort=True):
-    representations = []
-    with open(path) as the_file:
-        for line in the_file:
-            # After the last comma is either an empty entry or the log-likelihood.
-            rep = [int(j) for j in line.split(",")[:-1]]
-            if sort:
-                rep.sort()
-            representations.append(rep)
-    return representations
-
-
 def nni_results_df_of(nni_rep_path, credible_rep_path, pp_rep_path, pp_values_path):
-    nni_reps = indexer_reps_of_path(nni_rep_path, sort=False)
-    cred_set_reps = indexer_reps_of_path(credible_rep_path, sort=True)
-    pp_set_reps = indexer_reps_of_path(pp_rep_path, sort=True)
-    with open(pp_values_path) as the_file:
-        pp_set_values = [float(line.strip()) for line in the_file]
+    """The trees of the walk are read in batches and identified by the hashes of their
+    sDAG nodes, so only the credible and pp hash tables are held in memory."""
+    credible = read_tree_set(credible_rep_path)
+    pp_set = read_tree_set(
+        pp_rep_path, values=np.loadtxt(pp_values_path, dtype=float, ndmin=1)
+    )
 
+    is_cred = []
+    pp = []
     sdag_increased = []
-    seen_indices = set()
-    for rep in nni_reps:
-        rep_set = set(rep)
-        has_new_indices = not rep_set.issubset(seen_indices)
-        sdag_increased.append(has_new_indices)
-        if has_new_indices:
-            seen_indices.update(rep_set)
-
-    nni_reps = [",".join(map(str, rep)) for rep in nni_reps]
-    cred_set_reps = [",".join(map(str, rep)) for rep in cred_set_reps]
-    pp_set_reps = [",".join(map(str, rep)) for rep in pp_set_reps]
-    rep_to_pp = dict(zip(pp_set_reps, pp_set_values))
-
-    nni_results_df = pd.DataFrame(nni_reps, columns=["pcsp_rep"])
-    nni_results_df["support_size"] = range(1, len(nni_reps) + 1)
-    nni_results_df["is_cred"] = [rep in cred_set_reps for rep in nni_reps]
-    nni_results_df["pp"] = [rep_to_pp.get(rep, 0.0) for rep in nni_reps]
+    seen_bits = np.zeros(1, dtype=np.uint64)
+    for lengths, indices, _, _ in iter_sdag_rep_batches(nni_rep_path):
+        hashes = sdag_rep_hashes(lengths, indices)
+        is_cred.append(tree_set_lookup(credible, hashes)[0])
+        pp.append(tree_set_lookup(pp_set, hashes)[1])
+        batch_increased, seen_bits = new_node_flags(lengths, indices, seen_bits)
+        sdag_increased.append(batch_increased)
+    is_cred = np.concatenate(is_cred) if is_cred else np.zeros(0, dtype=np.bool_)
+    pp = np.concatenate(pp) if pp else np.zeros(0)
+    sdag_increased = (
+        np.concatenate(sdag_increased)
+        if sdag_increased
+        else np.zeros(0, dtype=np.bool_)
+    )
+
+    nni_results_df = pd.DataFrame({"support_size": np.arange(1, len(pp) + 1)})
+    nni_results_df["is_cred"] = is_cred
+    nni_results_df["pp"] = pp
     nni_results_df["total_pp"] = nni_results_df["pp"].cumsum()
     nni_results_df["cred_total"] = nni_results_df["is_cred"].cumsum()
-    nni_results_df["cred_frac"] = nni_results_df["cred_total"] / len(cred_set_reps)
+    nni_results_df["cred_frac"] = nni_results_df["cred_total"] / credible.line_count
     nni_results_df["bigger_sdag"] = sdag_increased
-    nni_results_df["comps_current"] = nni_results_df["bigger_sdag"] * 12
-    nni_results_df["comps_current"].iloc[0] = 48
+    comps_current = sdag_increased * 12
+    comps_current[:1] = 48
+    nni_results_df["comps_current"] = comps_current
     nni_results_df["comps_total"] = nni_results_df["comps_current"].cumsum()
     nni_results_df["sdag_iter"] = nni_results_df["bigger_sdag"].cumsum()
 
@@ -114,7 +73,7 @@ def run(
     golden_pickle_path,
     topology_sequence_path,
 ):
-    golden = golden_data_of_path(golden_pickle_path)
+    golden = open_posterior(golden_pickle_path)
     mcmc_df = mcmc_df_of_topology_sequence(topology_sequence_path, golden)
     mcmc_df.to_csv("mcmc.csv")
     last_mcmc_pp_idx = mcmc_df[mcmc_df["first_time"]]["total_pp"].idxmax()
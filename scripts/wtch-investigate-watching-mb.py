@@ -1,162 +1,142 @@
 #!/usr/bin/env python
 
 
-import pickle
-import bito
+import click
+import numpy as np
 import pandas as pd
-import json
-import tempfile
-import os
-import subprocess
-import multiprocessing
-import pathlib
-from functools import partial
-from collections import namedtuple
 
-
-GoldenData = namedtuple("GoldenData", "pp_dict credible_set")
-
-
-def golden_data_of_path(golden_pickle_path):
-    pp_dict, tree_ci_list = pickle.load(open(golden_pickle_path, "rb"))
-    return GoldenData(pp_dict, set(tree_ci_list))
-
-
-def dict_of_json(json_path):
-    with open(json_path, "r") as json_file:
-        return json.load(json_file)
-
-
-def topology_set_of_path(topologies_path):
-    "Read a set of topologies."
-    with open(topologies_path) as topologies_file:
-        return {t.strip() for t in topologies_file}
-
-
-def topology_set_to_path(topology_set, topologies_path):
-    "Write a set of topologies."
-    with open(topologies_path, "w") as topologies_file:
-        for topology in topology_set:
-            topologies_file.write(topology + "\n")
+from wmb.mcmc import (
+    mcmc_df_of_topology_sequence,
+    read_topology_log_prefix,
+    topology_log_count,
+    write_topology_log,
+)
+from wmb.posterior import (
+    credible_count,
+    credible_mask,
+    iter_store_topologies,
+    open_posterior,
+)
+from wmb.sdag import (
+    add_topology,
+    new_span_index,
+    new_subsplit_dag,
+    sdag_pcsp_count,
+    sdag_subsplit_count,
+    sdag_topology_count,
+    update_span_index,
+)
+
+
+def write_topologies_seen(df, topologies_seen_path):
+    """Writes the topologies of the sequence in order of first appearance to a
+    topology log, so that those seen by a prefix of the sequence are a prefix of it."""
+    write_topology_log(df.loc[df["first_time"], "topology"], topologies_seen_path)
+
+
+def sdag_results_df_of(
+    max_topology_count, topologies_seen_path, golden_pickle_path, checkpoints=None
+):
+    """Grows the sDAG one topology of the log at a time, recording its subsplit, PCSP
+    and topology counts after each one. The golden topologies that the sDAG spans, and
+    hence their number in the credible set and their total pp, are only found for the
+    topology counts in checkpoints (all of them if None), and are NaN elsewhere.
+
+    Both the log and the golden posterior hold topologies rerooted on the same taxon,
+    so a golden topology is spanned when all of its PCSPs are in the sDAG. The golden
+    topologies are indexed by the PCSPs they lack once the first topology is added,
+    and the PCSPs each later topology adds then update which of them are spanned.
+    """
+    golden = open_posterior(golden_pickle_path)
+    golden_pp = np.asarray(golden.pp)
+    golden_credible = credible_mask(golden)
+    if checkpoints is None:
+        checkpoints = range(1, max_topology_count + 1)
+    checkpoints = set(checkpoints)
+    track_golden = any(1 <= k <= max_topology_count for k in checkpoints)
+    sdag = new_subsplit_dag()
+    span_index = None
+    topos_in_credible = 0
+    total_pp = 0.0
+    rows = []
+    for topology_count, topology in enumerate(
+        read_topology_log_prefix(topologies_seen_path, max_topology_count), 1
+    ):
+        new_pcsps = add_topology(sdag, topology)
+        if track_golden:
+            if span_index is None:
+                span_index, spanned = new_span_index(
+                    sdag, iter_store_topologies(golden)
+                )
+            else:
+                spanned = update_span_index(span_index, new_pcsps)
+            topos_in_credible += int(golden_credible[spanned].sum())
+            total_pp += float(golden_pp[spanned].sum())
+        row = [
+            sdag_subsplit_count(sdag),
+            sdag_pcsp_count(sdag),
+            np.nan,
+            sdag_topology_count(sdag),
+            np.nan,
+        ]
+        if topology_count in checkpoints:
+            row[2] = topos_in_credible
+            row[4] = total_pp
+        rows.append(row)
+    return pd.DataFrame(
+        rows,
+        columns=[
+            "sdag_subsplit_count",
+            "sdag_pcsp_count",
+            "sdag_topos_in_credible",
+            "sdag_topos_total",
+            "sdag_total_pp",
+        ],
+    )
 
 
-def mcmc_df_of_topology_sequence(topology_sequence_path, golden):
-    pathlib.Path("topologies-seen").mkdir(exist_ok=True)
-    df = pd.read_csv(
-        topology_sequence_path, delimiter="\t", names=["dwell_count", "topology"]
-    )
-    # The set of topologies seen so far.
-    seen = set()
-    # A list that tracks each topology observed in the sequence and marks if it was seen
-    # for the first time.
-    first_time = []
-
-    def seen_to_file():
-        topology_set_to_path(seen, f"topologies-seen/topologies-seen.{len(seen)}.nwk")
-
-    for topology in df["topology"]:
-        if topology in seen:
-            first_time.append(False)
-        else:
-            first_time.append(True)
-            seen.add(topology)
-            seen_to_file()
-    df["first_time"] = first_time
-    df["support_size"] = df["first_time"].cumsum()
-    df["mcmc_iters"] = df["dwell_count"].cumsum()
-    df["pp"] = df["topology"].apply(lambda t: golden.pp_dict.get(t, 0.0))
-    df["total_pp"] = (df["pp"] * df["first_time"]).cumsum()
-    df["in_credible_set"] = df["topology"].apply(golden.credible_set.__contains__)
-    df["credible_set_found"] = (df["in_credible_set"] & df["first_time"]).cumsum()
-    df["credible_set_frac"] = df["credible_set_found"] / len(golden.credible_set)
-    df.set_index("mcmc_iters")
-    return df
-
-
-def build_sdag_trees(tmpdir, read_collection_path, write_sdag_trees_path):
-    inst = bito.gp_instance(os.path.join(tmpdir, "mmap.dat"))
-    inst.read_newick_file(read_collection_path)
-    inst.make_dag()
-    inst.print_status()
-    inst.export_all_generated_topologies(write_sdag_trees_path)
-    return inst.dag_summary_statistics()
-
-
-def build_sdag_topologies_set_and_stats(topologies_seen_path, reroot_number):
-    with tempfile.TemporaryDirectory() as tmpdir:
-        sdag_trees_path = os.path.join(tmpdir, "generated-trees.nwk")
-        sdag_topologies_path = os.path.join(tmpdir, "sdag-topologies.nwk")
-        sdag_summary_stats = build_sdag_trees(
-            tmpdir, topologies_seen_path, sdag_trees_path
-        )
-        subprocess.check_call(
-            f"nw_topology {sdag_trees_path} | nw_reroot - {reroot_number} | nw_order - "
-            f"> {sdag_topologies_path}",
-            shell=True,
-        )
-        return topology_set_of_path(sdag_topologies_path), sdag_summary_stats
-
-
-def sdag_results_of_topology_count_general(topology_count, golden, reroot_number):
-    topologies_seen_path = f"topologies-seen/topologies-seen.{topology_count}.nwk"
-    sdag_topologies_set, sdag_summary_stats = build_sdag_topologies_set_and_stats(
-        topologies_seen_path, reroot_number
-    )
-    return [
-        sdag_summary_stats["node_count"],
-        sdag_summary_stats["edge_count"],
-        len(golden.credible_set.intersection(sdag_topologies_set)),
-        len(sdag_topologies_set),
-        sum(golden.pp_dict.get(t, 0.0) for t in sdag_topologies_set),
-    ]
-
-
-def sdag_results_df_of(max_topology_count, golden, reroot_number, max_thread_count):
-    sdag_results_of_topology_count = partial(
-        sdag_results_of_topology_count_general,
-        golden=golden,
-        reroot_number=reroot_number,
-    )
-    with multiprocessing.Pool(5) as pool:
-        return pd.DataFrame(
-            pool.map(sdag_results_of_topology_count, range(1, max_topology_count + 1)),
-            columns=[
-                "sdag_node_count",
-                "sdag_edge_count",
-                "sdag_topos_in_credible",
-                "sdag_topos_total",
-                "sdag_total_pp",
-            ],
-        )
+def checkpoints_of_string(checkpoints):
+    if checkpoints is None:
+        return None
+    return [int(k) for k in checkpoints.split(",") if k.strip()]
 
 
+@click.command()
+@click.option("--target-topology-count", default=250)
+@click.option("--golden-pickle-path", default="golden/posterior.pkl")
+@click.option("--topology-sequence-path", default="mb/rerooted-topology-sequence.tab")
+@click.option("--topologies-seen-path", default="topologies-seen.nwk")
+@click.option(
+    "--checkpoints",
+    default=None,
+    help="Comma-separated topology counts at which to compute the overlap of the "
+    "sDAG with the golden posterior (default: all).",
+)
 def run(
-    target_topology_count=250,
-    max_thread_count=5,
-    golden_pickle_path="golden/posterior.pkl",
-    topology_sequence_path="mb/rerooted-topology-sequence.tab",
-    config_path="data/base.json",
+    target_topology_count,
+    golden_pickle_path,
+    topology_sequence_path,
+    topologies_seen_path,
+    checkpoints,
 ):
 
-    config = dict_of_json(config_path)
-    golden = golden_data_of_path(golden_pickle_path)
+    golden = open_posterior(golden_pickle_path)
     accumulation_df = mcmc_df_of_topology_sequence(topology_sequence_path, golden)
+    write_topologies_seen(accumulation_df, topologies_seen_path)
 
     ax = accumulation_df[["total_pp", "credible_set_frac"]].plot(ylim=[0, 1])
     ax.figure.savefig("accumulation.pdf")
     accumulation_df.to_csv("accumulation.csv")
 
-    total_seen_count = int(
-        subprocess.check_output("ls topologies-seen | wc -l", shell=True)
-    )
+    total_seen_count = topology_log_count(topologies_seen_path)
 
     max_topology_count = min([total_seen_count, target_topology_count])
 
     sdag_results_df = sdag_results_df_of(
         max_topology_count=max_topology_count,
-        golden=golden,
-        reroot_number=config["reroot_number"],
-        max_thread_count=max_thread_count,
+        topologies_seen_path=topologies_seen_path,
+        golden_pickle_path=golden_pickle_path,
+        checkpoints=checkpoints_of_string(checkpoints),
     )
     sdag_results_df.to_csv("sdag-results.csv")
 
@@ -165,7 +145,7 @@ def run(
     sdag_results_df.rename(columns={"index": "support_size"}, inplace=True)
     sdag_results_df["sdag_credible_set_frac"] = sdag_results_df[
         "sdag_topos_in_credible"
-    ] / len(golden.credible_set)
+    ] / credible_count(golden)
     sdag_results_df.tail()
 
     final_df = accumulation_df.merge(sdag_results_df)
@@ -178,8 +158,8 @@ def run(
             "in_credible_set",
             "credible_set_found",
             "credible_set_frac",
-            "sdag_edge_count",
-            "sdag_node_count",
+            "sdag_pcsp_count",
+            "sdag_subsplit_count",
             "sdag_topos_in_credible",
             "sdag_topos_total",
             "sdag_total_pp",
@@ -1,147 +1,37 @@
 #!/usr/bin/env python
 import numpy as np
-import igraph
 import click
-import multiprocessing
-from sortedcontainers import SortedList
 from functools import partial
 import os
-import sys
-
-# This funny business with paths is needed because this file is intended to be called
-# from the command line by a sym link in $CONDA_PREFIX/bin, but naively python does not
-# know to check that directory for parsimony.py.
-sys.path.append(os.path.dirname(__file__))
-from parsimony import load_fasta, build_tree, sankoff_upward
-
-
-# A note on igraph and indexing:
-# The module igraph keeps track of the vertices using contiguous indexing. So
-# when vertices are deleted or moved around, the indices may change. But vertices are
-# allowed attibutes and attributes are exposed as dictionaries. For an attribute
-# specifically named "name", igraph does indexing based on this attribute in amortized
-# constant time, so working with vertices based on the attribute "name" is a safe and
-# fast way to go when there may be issues with indices. But there are two issues.
-# 1) There are different behaviors if attribute "name" is string or an int. When a
-# vertex has the "name" attribute with value "10", the_graph.vs.find(name="10") and
-# the_graph.vs.find("10") yield the vertex with name "10", and the_graph.vs[10] yields
-# the vertex at index 10. When a vertex has the "name" attribute with value 10,
-# the_graph.vs.find(name=10) yields the vertex with name 10, whereas
-# the_graph.vs.find(10) and the_graph.vs[10] yield the vertex at index 10.
-# 2) The values of the attribute "name" need not be unique.
-
-
-def fast_line_count(file_path):
-    """Returns the number of lines in file_path. This method is as fast as invoking
-    wc -l.
-    """
-
-    def _make_gen(reader):
-        while True:
-            b = reader(2**16)
-            if not b:
-                break
-            yield b
-
-    with open(file_path, "rb") as the_file:
-        count = sum(buffer.count(b"\n") for buffer in _make_gen(the_file.raw.read))
-    return count
-
-
-def encode_sdag_nodes_as_int(sdag_node_list):
-    """Given a list of integers, which represent specific nodes of some subsplit dag,
-    construct an integer that represents this list. In the base 2 representation of the
-    returned integer, the digit at entry j (reading from right to left and with the far
-    right digit being at entry 0) is 1 exactly when j is in sdag_node_list.
-
-    E.g.: [5,2,0,1] -> 100111 -> 2^5+2^2+2^1+2^0 = 39
-    """
-    return sum(2**n for n in sdag_node_list)
-
-
-def decode_int_as_sdag_nodes(the_int):
-    """This is the inverse function of encode_sdag_nodes_as_int, up to list ordering."""
-    bit_string = bin(the_int)[::-1]
-    return [j for j in range(the_int.bit_length()) if bit_string[j] == "1"]
-
-
-def build_and_score(nwk, fasta_map):
-    """Returns the parsimony score for the given newick string and custom fasta_map."""
-    return sankoff_upward(build_tree(nwk, fasta_map), gap_as_char=False)
-
-
-def parsimony_scores(nwk_list, fasta_map):
-    """
-    Returns the parsimony scores for the given list of newick strings and custom
-    fasta_map.
-    """
-    informative_sites = [
-        idx for idx, chars in enumerate(zip(*fasta_map.values())) if len(set(chars)) > 1
-    ]
-    newfasta = {
-        key: "".join(oldseq[idx] for idx in informative_sites)
-        for key, oldseq in fasta_map.items()
-    }
-    with multiprocessing.Pool(processes=16) as pool:
-        partial_build_and_score = partial(build_and_score, fasta_map=newfasta)
-        scores = pool.map(partial_build_and_score, nwk_list)
-    return scores
-
-
-def compute_parsimony_scores_from_files(nwk_path, fasta_path):
-    """
-    Returns the parsimony scores for the newick strings in the file nwk_path using the
-    fasta file located at fasta_path.
-    """
-    nwk_list = read_nwk(nwk_path)
-    fasta_map = load_fasta(fasta_path)
-    return parsimony_scores(nwk_list, fasta_map)
-
-
-def read_nwk(nwk_path):
-    """Returns the list of newick strings in the file nwk_path."""
-    tree_nwk_list = []
-    with open(nwk_path) as the_file:
-        for line in the_file:
-            tree_nwk_list.append(line.strip())
-    return tree_nwk_list
 
-
-def read_sdag_rep_trees(file_path, with_likelihoods=False):
-    """
-    Loads the tree data from file_path. The expected file format of file_path is one
-    tree per line, each line consists of i) a comma separated list of integers of the
-    subsplit dag node indices comprising the tree; ii) another comma; iii) nothing when
-    with_likelihoods=False and the log-likelihood of the tree when
-    with_likelilihooods=True; and iv) the newline character \\n (even the final line
-    should have the newline character).
-
-    Since the subsplit DAG is not seen by any of this code, it is assumed that the trees
-    are all from a common sDAG and the node indices are correct. Trees that are not in
-    this commond sDAG are identified by an invalid sDAG node index and are omitted from
-    the returned values.
-
-    :return: A pair (T,L), where T is a python list of integers encoding each tree's
-        subsplit DAG node representation (a single integer is used for a single tree),
-        and L is a numpy.array of each tree's log-likelihood. When
-        with_likelihoods=False, L is a vector of zeros. When with_likelihoods=True, both
-        T and L are sorted in descending order according to log-likelihood.
-    :rtype: tuple
-    """
-    n_rows = fast_line_count(file_path)
-    # In bito, reps_and_likelihoods uses SIZE_MAX for unknown subsplits.
-    invalid_index = 2**64 - 1
-    tree_bit_list = []
-    tree_likelihood_array = np.zeros(n_rows, dtype=float)
-    with open(file_path, "rt") as the_file:
-        for j, line in enumerate(the_file):
-            tree_info = line.strip().split(",")
-            sdag_rep = [int(c) for c in tree_info[:-1]]
-            if invalid_index not in sdag_rep:
-                tree_bit_list.append(encode_sdag_nodes_as_int(sdag_rep))
-                if with_likelihoods:
-                    tree_likelihood_array[j] = float(tree_info[-1])
-    return tree_bit_list, tree_likelihood_array
+from wmb.nni_index import (
+    NEIGHBOR_INDEX_CHOICES,
+    build_prefix_index,
+    find_nni_edges,
+    find_nni_neighbors,
+    iter_nni_edge_lists,
+)
+from wmb.parsimony import parsimony_scores_of_files
+from wmb.score_cache import open_score_cache
+from wmb.representations import (
+    decode_bits_as_sdag_nodes,
+    kept_tree_count,
+    read_sdag_rep_trees,
+    read_top_sdag_rep_trees,
+    rows_in,
+    valid_sdag_rep_count,
+)
+from wmb.traversal import (
+    cached_neighbors,
+    csr_neighbors,
+    csr_of_edges,
+    iter_max_weight_walk,
+    load_csr,
+    merge_edge_shards,
+    prefix_neighbors,
+    write_edge_shard,
+)
+from wmb.walk_metrics import WALK_METRIC_COLUMNS, read_tree_set, walk_metric_rows
 
 
 def process_trees(
@@ -150,104 +40,238 @@ def process_trees(
     use_parsimony=False,
     nwk_path=None,
     fasta_path=None,
+    max_tree_count=0,
+    max_tree_ratio=0.0,
+    score_cache=None,
 ):
     """
     Loads the tree data from file_path (according to the method read_sdag_rep_trees).
-    If either with_likelihoods or use_parsimony is true, then both an integer list
+    If either with_likelihoods or use_parsimony is true, then both the bitset matrix
     encoding the trees and a numpy array of the statistic are returned and both are
     sorted according to the statistic. When both with_likelihoods and use_parsimony are
-    false, only the list of integers encoding the trees is returned. Both nwk_path and
-    fasta_path are required when use_parsimony=True.
+    false, only the bitset matrix encoding the trees is returned. Both nwk_path and
+    fasta_path are required when use_parsimony=True, and the trees of nwk_path must
+    correspond to the lines of file_path.
+
+    When using a statistic, only the first max_tree_count (max_tree_ratio,
+    respectively) trees after sorting are kept, and this is applied while reading (see
+    read_top_sdag_rep_trees). When max_tree_count and max_tree_ratio are both given,
+    the more restrictive condition is used.
 
     When using parsimony scores, the negative of the parsimony score is returned. This
     is done so that the ordering is always descending (high likelihood is good, whereas
-    low parsimony is good).
+    low parsimony is good). Parsimony scores are looked up in and added to the optional
+    ScoreCache score_cache (see wmb.score_cache).
     """
     if with_likelihoods and use_parsimony:
         raise ValueError("process_trees cannot use both likelihood and parsimony")
     if use_parsimony and (nwk_path is None or fasta_path is None):
         raise ValueError("process_trees requires nwk_path and fasta_path for parsimony")
 
-    tree_bit_list, tree_scores = read_sdag_rep_trees(file_path, with_likelihoods)
+    if not (with_likelihoods or use_parsimony):
+        tree_bits, _ = read_sdag_rep_trees(file_path)
+        return tree_bits
+    line_scores = None
     if use_parsimony:
-        tree_scores = compute_parsimony_scores_from_files(nwk_path, fasta_path)
-        tree_scores = np.array([-p for p in tree_scores])
-    if with_likelihoods or use_parsimony:
-        new_indices = tree_scores.argsort()[::-1]
-        tree_bit_list = [tree_bit_list[j] for j in new_indices]
-        tree_scores = tree_scores[new_indices]
-        return tree_bit_list, tree_scores
-    else:
-        return tree_bit_list
+        parsimony_scores = parsimony_scores_of_files(
+            nwk_path, fasta_path, cache=score_cache
+        )
+        line_scores = -parsimony_scores.astype(float)
+    tree_bits, tree_scores, _ = read_top_sdag_rep_trees(
+        file_path, max_tree_count, max_tree_ratio, line_scores
+    )
+    return tree_bits, tree_scores
 
 
-def are_nni_related(this_int, that_int):
-    """Determine if two integers represent trees that are a single NNI operation away
-    from each other (in the common subsplit dag).
+def tree_selection_options(command):
+    """Adds the options of process_trees that select and order the trees, which the
+    walk and the edge shards must be given alike.
+    """
+    for option in reversed(
+        [
+            click.option("--max_tree_count", default=0),
+            click.option("--max_tree_ratio", default=0.0),
+            click.option("--use_parsimony", default=False, is_flag=True),
+            click.option("--nwk_path", default=None),
+            click.option("--fasta_path", default=None),
+            click.option(
+                "--no_score_cache",
+                is_flag=True,
+                help="Compute every parsimony score instead of using the score cache.",
+            ),
+        ]
+    ):
+        command = option(command)
+    return command
+
+
+neighbor_index_option = click.option(
+    "--neighbor_index",
+    type=click.Choice(NEIGHBOR_INDEX_CHOICES),
+    default="prefix",
+    help="Engine used to find the pairs of trees that are an NNI apart.",
+)
+
+
+def load_scored_trees(
+    sdag_rep_path,
+    use_parsimony,
+    nwk_path,
+    fasta_path,
+    max_tree_count,
+    max_tree_ratio,
+    no_score_cache=False,
+):
+    """Returns the bitset matrix and the scores of the trees of sdag_rep_path, as
+    selected by the options of tree_selection_options. Vertex j of the NNI graph is the
+    tree in row j of the bitset matrix.
     """
-    return bin(this_int ^ that_int).count("1") <= 10
+    score_cache = None
+    if use_parsimony and not no_score_cache:
+        score_cache = open_score_cache()
+    return process_trees(
+        sdag_rep_path,
+        with_likelihoods=not use_parsimony,
+        use_parsimony=use_parsimony,
+        nwk_path=nwk_path,
+        fasta_path=fasta_path,
+        max_tree_count=max_tree_count,
+        max_tree_ratio=max_tree_ratio,
+        score_cache=score_cache,
+    )
 
 
-def find_nni_trees(j, tree_bits_list):
-    """Returns a list of pairs (j,k), where the integers tree_bits_list[j]
-    and tree_bits_list[k] represent trees that are single NNI operation away
-    from each other. This method is designed for multiprocessing on j.
+def sweep_output_path(output_path, ratio):
+    """Returns the output path of the walk for the ratio of a sweep, which inserts the
+    ratio before the extension of output_path.
     """
-    return [
-        (j, k)
-        for k in range(j + 1, len(tree_bits_list))
-        if are_nni_related(tree_bits_list[j], tree_bits_list[k])
-    ]
+    root, extension = os.path.splitext(output_path)
+    return f"{root}.ratio-{ratio:g}{extension}"
 
 
-def max_weight_neighbor_traversal(graph, weight_attribute, start_trees=[]):
-    """Calculate a list of vertex indices from graph with large weight_attribute
-    values. More precisely, the list begins with a vertex of maximal weight_attribute
-    value, along with the vertices in start_trees, and each later element of the list
-    has maximal weight_attribute value among the neighors of all earlier elements.
-
-    :type graph: igraph.Graph
+def write_walk(output_path, vertices, tree_bits, tree_scores):
+    """Writes the trees of the walk vertices to output_path, one per line, as their sDAG
+    nodes followed by their score.
     """
-    if graph.vcount() == 0:
-        return []
-    current_vertex = graph.vs[np.argmax(graph.vs[weight_attribute])]
-    visited_vertices = [] if current_vertex in start_trees else [current_vertex]
-    visited_vertices.extend(start_trees)
-    unvisited_neighbors = SortedList(key=lambda v: -v[weight_attribute])
-    unvisited_neighbors.update(
-        {
-            n
-            for c in visited_vertices
-            for n in c.neighbors()
-            if n not in visited_vertices
-        }
-    )
+    with open(output_path, "wt") as out_file:
+        for vertex in vertices:
+            sdag_rep = decode_bits_as_sdag_nodes(tree_bits[vertex])
+            score = tree_scores[vertex].item()
+            out_file.write(",".join(map(str, sdag_rep)) + f",{score}" + "\n")
+
+
+def metrics_path_of(output_path):
+    """Returns the default path of the metrics of the walk written to output_path."""
+    root, _ = os.path.splitext(output_path)
+    return f"{root}.metrics.csv"
+
+
+def tracked_walk(
+    vertices,
+    tree_bits,
+    metrics_path,
+    credible,
+    pp_set,
+    target_cred_frac=None,
+    target_total_pp=None,
+):
+    """Yields the vertices of a walk, writing its cumulative metrics (see
+    wmb.walk_metrics.walk_metric_rows) to the CSV file metrics_path as each one is
+    visited. The walk stops after the vertex at which cred_frac reaches
+    target_cred_frac or total_pp reaches target_total_pp.
+    """
+    with open(metrics_path, "wt") as metrics_file:
+        metrics_file.write(",".join(WALK_METRIC_COLUMNS) + "\n")
+        for vertex, metrics in walk_metric_rows(vertices, tree_bits, credible, pp_set):
+            metrics_file.write(",".join(map(str, metrics)) + "\n")
+            yield vertex
+            row = dict(zip(WALK_METRIC_COLUMNS, metrics))
+            if (
+                target_cred_frac is not None and row["cred_frac"] >= target_cred_frac
+            ) or (target_total_pp is not None and row["total_pp"] >= target_total_pp):
+                break
 
-    while len(unvisited_neighbors) > 0:
-        current_vertex = unvisited_neighbors.pop(0)
-        visited_vertices.append(current_vertex)
-        unvisited_neighbors.update(
-            [
-                neighbor
-                for neighbor in current_vertex.neighbors()
-                if neighbor not in visited_vertices
-                and neighbor not in unvisited_neighbors
-            ]
-        )
-    vertex_indices = [v.index for v in visited_vertices]
 
-    return vertex_indices
+@click.group()
+def cli():
+    """
+    Walk the NNI graph of the trees of a representations file, visiting trees of high
+    likelihood (or low parsimony score). For large files, the NNI edges can be computed
+    in shards with shard-edges and merged with merge-shards, and the walk then memory
+    maps the merged adjacency.
+    """
+    pass
 
 
-@click.command()
+@cli.command("walk")
 @click.argument("sdag_rep_path")
 @click.argument("output_path")
 @click.option("--extra_trees_path", default=None)
-@click.option("--max_tree_count", default=0)
-@click.option("--max_tree_ratio", default=0.0)
-@click.option("--use_parsimony", default=False, is_flag=True)
-@click.option("--nwk_path", default=None)
-@click.option("--fasta_path", default=None)
+@tree_selection_options
+@neighbor_index_option
+@click.option(
+    "--lazy",
+    default=False,
+    is_flag=True,
+    help="Find the neighbors of a tree only when the walk visits it.",
+)
+@click.option(
+    "--max_walk_count", default=0, help="Stop after visiting this many trees."
+)
+@click.option(
+    "--max_score_drop",
+    default=None,
+    type=float,
+    help="Stop before visiting a tree scored this far below the best tree.",
+)
+@click.option(
+    "--max_sdag_growth",
+    default=0,
+    help="Stop once the sDAG of the visited trees has grown this many times.",
+)
+@click.option(
+    "--adjacency_path",
+    default=None,
+    help="Use the NNI adjacency written by merge-shards instead of finding the edges.",
+)
+@click.option(
+    "--sweep",
+    default=None,
+    help="Comma separated tree ratios to walk, each written to its own output file. "
+    "A ratio of 0 walks all of the trees.",
+)
+@click.option(
+    "--credible_rep_path",
+    default=None,
+    help="Representations of the credible set, for the metrics of the walk.",
+)
+@click.option(
+    "--pp_rep_path",
+    default=None,
+    help="Representations of the posterior trees, for the metrics of the walk.",
+)
+@click.option(
+    "--pp_values_path",
+    default=None,
+    help="Posterior probabilities of the trees of --pp_rep_path, one per line.",
+)
+@click.option(
+    "--metrics_path",
+    default=None,
+    help="Where to write the metrics of the walk, by default next to OUTPUT_PATH.",
+)
+@click.option(
+    "--target_cred_frac",
+    default=None,
+    type=float,
+    help="Stop once the walk has visited this fraction of the credible set.",
+)
+@click.option(
+    "--target_total_pp",
+    default=None,
+    type=float,
+    help="Stop once the walk has visited trees of this total posterior probability.",
+)
 def find_likely_neighbors(
     sdag_rep_path,
     output_path,
@@ -257,6 +281,20 @@ def find_likely_neighbors(
     use_parsimony=False,
     nwk_path=None,
     fasta_path=None,
+    no_score_cache=False,
+    neighbor_index="prefix",
+    lazy=False,
+    max_walk_count=0,
+    max_score_drop=None,
+    max_sdag_growth=0,
+    adjacency_path=None,
+    sweep=None,
+    credible_rep_path=None,
+    pp_rep_path=None,
+    pp_values_path=None,
+    metrics_path=None,
+    target_cred_frac=None,
+    target_total_pp=None,
 ):
     """
     Determine a list of trees that are nearest neighbor interchanges of each other with
@@ -265,57 +303,209 @@ def find_likely_neighbors(
     extra_trees_path specifies a file of trees with which to start the list along with
     the best scored tree. The optional parameters max_tree_count and max_tree_ratio
     indicate to use only the first max_tree_count (max_tree_ratio, respectively) after
-    sorting the trees. When max_tree_count and max_tree_ratio are both given, the more
-    restrictive condition is used. The list of trees is determined by the method
-    max_weight_neighbor_traversal.
+    sorting the trees, and only these trees are loaded. When max_tree_count and
+    max_tree_ratio are both given, the more restrictive condition is used. The list of
+    trees is determined by the method max_weight_walk (see wmb.traversal). The NNI
+    edges are found by the engine named by neighbor_index (see wmb.nni_index), and
+    every engine gives the same edges.
+
+    With lazy=True, the NNI edges are not computed up front. Instead, the neighbors of
+    a tree are found with the prefix index when the walk visits it. The walk stops
+    early when one of the budgets max_walk_count, max_score_drop or max_sdag_growth is
+    used up (see max_weight_walk), which keeps a lazy walk to the explored region.
+
+    With adjacency_path, the NNI edges are memory mapped from the adjacency written by
+    merge-shards, which must have been computed with the same tree selection options.
+
+    The sweep parameter takes the place of max_tree_ratio to walk several ratios at
+    once. As for max_tree_ratio, a ratio of 0 keeps all of the trees, so it is the
+    largest. The trees and edges are loaded for the largest ratio. Since the trees are
+    sorted by score, the graph for a smaller ratio is the subgraph induced on a prefix
+    of the rows, so each ratio is walked on its prefix and written to
+    sweep_output_path(output_path, ratio). An adjacency_path must then be computed for
+    the largest ratio.
+
+    Given credible_rep_path, or pp_rep_path and pp_values_path, the credible and
+    posterior trees are loaded up front, and the cumulative metrics of the walk (see
+    wmb.walk_metrics) are written to metrics_path, by default metrics_path_of(
+    output_path), as the trees are visited. The walk then also stops once cred_frac
+    reaches target_cred_frac or total_pp reaches target_total_pp. A sweep writes the
+    metrics of each ratio to sweep_output_path(metrics_path, ratio).
     """
-    weight_attr = "parsimony" if use_parsimony else "log_likelihood"
-
-    tree_bits_list, tree_scores = process_trees(
+    if lazy and adjacency_path is not None:
+        raise ValueError("A lazy walk cannot use a precomputed adjacency")
+    if (pp_rep_path is None) != (pp_values_path is None):
+        raise ValueError("The pp metrics require both pp_rep_path and pp_values_path")
+    credible = None
+    if credible_rep_path is not None:
+        credible = read_tree_set(credible_rep_path)
+    pp_set = None
+    if pp_rep_path is not None:
+        pp_set = read_tree_set(
+            pp_rep_path, values=np.loadtxt(pp_values_path, dtype=float, ndmin=1)
+        )
+    track_metrics = credible is not None or pp_set is not None
+    if not track_metrics and (
+        target_cred_frac is not None or target_total_pp is not None
+    ):
+        raise ValueError("Walk metric targets require credible or pp representations")
+    if target_cred_frac is not None and credible is None:
+        raise ValueError("A target cred_frac requires credible_rep_path")
+    if target_total_pp is not None and pp_set is None:
+        raise ValueError("A target total_pp requires pp_rep_path")
+    if metrics_path is None:
+        metrics_path = metrics_path_of(output_path)
+    walks = None
+    if sweep is not None:
+        if max_tree_ratio > 0:
+            raise ValueError("A sweep cannot be combined with max_tree_ratio")
+        ratios = sorted({float(ratio) for ratio in sweep.split(",")})
+        if ratios[0] < 0:
+            raise ValueError("The ratios of a sweep cannot be negative")
+        valid_count = valid_sdag_rep_count(sdag_rep_path)
+        walks = [
+            (
+                sweep_output_path(output_path, ratio),
+                sweep_output_path(metrics_path, ratio),
+                kept_tree_count(valid_count, max_tree_count, ratio),
+            )
+            for ratio in ratios
+        ]
+        max_tree_ratio = 0.0 if ratios[0] == 0 else ratios[-1]
+    tree_bits, tree_scores = load_scored_trees(
         sdag_rep_path,
-        with_likelihoods=not use_parsimony,
-        use_parsimony=use_parsimony,
-        nwk_path=nwk_path,
-        fasta_path=fasta_path,
+        use_parsimony,
+        nwk_path,
+        fasta_path,
+        max_tree_count,
+        max_tree_ratio,
+        no_score_cache,
     )
 
-    vertex_count = len(tree_bits_list)
-    if max_tree_ratio > 0:
-        vertex_count = min(vertex_count, int(np.floor(max_tree_ratio * vertex_count)))
-    if max_tree_count > 0:
-        vertex_count = min(vertex_count, max_tree_count)
-    the_graph = igraph.Graph(vertex_count)
-    the_graph.vs["encoded_sdag_representation"] = tree_bits_list[:vertex_count]
-    the_graph.vs[weight_attr] = tree_scores[:vertex_count]
-    tree_bits_list = None
-    tree_scores = None
-
-    # For the cluster, 16 processes works well.
-    with multiprocessing.Pool(processes=16) as pool:
-        partial_find_nni_trees = partial(
-            find_nni_trees, tree_bits_list=the_graph.vs["encoded_sdag_representation"]
+    extra_indices = []
+    if extra_trees_path is not None:
+        extras = process_trees(extra_trees_path)
+        extra_indices = np.flatnonzero(rows_in(tree_bits, extras))
+
+    # Vertex j of the graph is the tree in row j of tree_bits.
+    budget = dict(
+        max_visit_count=max_walk_count,
+        max_score_drop=max_score_drop,
+        tree_bits=tree_bits,
+        max_sdag_growth=max_sdag_growth,
+    )
+    if lazy:
+        prefix_index = build_prefix_index(tree_bits)
+        neighbors_of = cached_neighbors(
+            partial(find_nni_neighbors, tree_bits=tree_bits, prefix_index=prefix_index)
         )
-        edges = pool.map(partial_find_nni_trees, range(vertex_count - 1))
-    for edge_list in edges:
-        the_graph.add_edges(edge_list)
-    # At this point, the graph is fully constructed.
+    else:
+        if adjacency_path is None:
+            indptr, indices = csr_of_edges(
+                find_nni_edges(tree_bits, neighbor_index=neighbor_index), len(tree_bits)
+            )
+        else:
+            indptr, indices = load_csr(adjacency_path)
+            if len(indptr) != len(tree_bits) + 1:
+                raise ValueError(
+                    f"The adjacency {adjacency_path} has {len(indptr) - 1} vertices "
+                    f"but {len(tree_bits)} trees were selected"
+                )
+        # At this point, the graph is fully constructed.
+        neighbors_of = csr_neighbors(indptr, indices)
+
+    if walks is None:
+        walks = [(output_path, metrics_path, len(tree_bits))]
+    for walk_output_path, walk_metrics_path, tree_count in walks:
+        good_vertex_indices = iter_max_weight_walk(
+            prefix_neighbors(neighbors_of, tree_count),
+            tree_scores[:tree_count],
+            [vertex for vertex in extra_indices if vertex < tree_count],
+            **budget,
+        )
+        if track_metrics:
+            good_vertex_indices = tracked_walk(
+                good_vertex_indices,
+                tree_bits,
+                walk_metrics_path,
+                credible,
+                pp_set,
+                target_cred_frac,
+                target_total_pp,
+            )
+        write_walk(walk_output_path, good_vertex_indices, tree_bits, tree_scores)
+
+    return None
 
-    extras = [] if extra_trees_path is None else process_trees(extra_trees_path)
-    extra_nodes = the_graph.vs.select(encoded_sdag_representation_in=extras)
 
-    good_vertex_indices = max_weight_neighbor_traversal(
-        the_graph, weight_attr, extra_nodes
+@cli.command("shard-edges")
+@click.argument("sdag_rep_path")
+@click.argument("shard_path")
+@tree_selection_options
+@neighbor_index_option
+@click.option("--start_row", default=0, help="First row of the shard.")
+@click.option(
+    "--stop_row", default=None, type=int, help="Row after the last row of the shard."
+)
+@click.option("--processes", default=16, help="Number of worker processes.")
+def shard_edges(
+    sdag_rep_path,
+    shard_path,
+    max_tree_count=0,
+    max_tree_ratio=0.0,
+    use_parsimony=False,
+    nwk_path=None,
+    fasta_path=None,
+    no_score_cache=False,
+    neighbor_index="prefix",
+    start_row=0,
+    stop_row=None,
+    processes=16,
+):
+    """
+    Compute the NNI edges (j,k) with j < k and start_row <= j < stop_row among the trees
+    selected as in walk, and write them to the edge shard shard_path as they are found
+    (see write_edge_shard). By default the shard holds every row. Shards with disjoint
+    row ranges can run as independent jobs, and merge-shards combines them.
+    """
+    tree_bits, _ = load_scored_trees(
+        sdag_rep_path,
+        use_parsimony,
+        nwk_path,
+        fasta_path,
+        max_tree_count,
+        max_tree_ratio,
+        no_score_cache,
     )
+    # The last row has no later neighbors.
+    last_row = max(len(tree_bits) - 1, 0)
+    if stop_row is None:
+        stop_row = last_row
+    start_row, stop_row = min(start_row, last_row), min(stop_row, last_row)
+    edge_lists = []
+    if start_row < stop_row:
+        edge_lists = iter_nni_edge_lists(
+            tree_bits, range(start_row, stop_row), neighbor_index, processes
+        )
+    write_edge_shard(edge_lists, shard_path, len(tree_bits), start_row, stop_row)
 
-    with open(output_path, "wt") as out_file:
-        for vertex in the_graph.vs[good_vertex_indices]:
-            sdag_rep = decode_int_as_sdag_nodes(vertex["encoded_sdag_representation"])
-            out_file.write(
-                ",".join(map(str, sdag_rep)) + f",{vertex[weight_attr]}" + "\n"
-            )
+    return None
+
+
+@cli.command("merge-shards")
+@click.argument("adjacency_path")
+@click.argument("shard_paths", nargs=-1, required=True)
+def merge_shards(adjacency_path, shard_paths):
+    """
+    Merge the edge shards shard_paths written by shard-edges into the on-disk CSR
+    adjacency adjacency_path, which walk takes as --adjacency_path. The shards must
+    cover every row, and the merge uses memory linear in the number of trees rather
+    than the number of edges (see merge_edge_shards).
+    """
+    merge_edge_shards(shard_paths, adjacency_path)
 
     return None
 
 
 if __name__ == "__main__":
-    find_likely_neighbors()
+    cli()
@@ -1,9 +1,10 @@
 #!/usr/bin/env python
 
-import pickle
 import os
 import click
 
+from wmb.posterior import read_posterior
+
 
 @click.command()
 @click.argument("read_path")
@@ -12,12 +13,12 @@ import click
 @click.argument("pp_value_write_path")
 def cli(read_path, credible_tree_write_path, pp_tree_write_path, pp_value_write_path):
     """
-    Given a pickle file of a tuple from a MrBayes run, write out three files for the
-    credible set topologies, the topologies with pp-values, and the pp-values of the
-    those topologies.
+    Given a pickle file of a tuple from a MrBayes run, or the posterior store converted
+    from it, write out three files for the credible set topologies, the topologies with
+    pp-values, and the pp-values of the those topologies.
     """
 
-    pp_dict, cred_tree_list = pickle.load(open(read_path, "rb"))
+    pp_dict, cred_tree_list = read_posterior(read_path)
     with open(credible_tree_write_path, "wt") as out_file:
         for tree in cred_tree_list:
             out_file.write(tree + "\n")
@@ -19,5 +19,7 @@ then
         extra_parameters=$extra_parameters$1
 fi
 
-wtch-nni-likelihood-walk.py $sdag_rep_path $output_path --max_tree_ratio=0.01 --nwk_path=$nwk_path --fasta_path=$fasta_path $extra_parameters
+# Convert the representations to a binary cache, unless there is a fresh one already.
+wmb reps-cache $sdag_rep_path
+wtch-nni-likelihood-walk.py walk $sdag_rep_path $output_path --max_tree_ratio=0.01 --nwk_path=$nwk_path --fasta_path=$fasta_path $extra_parameters
 # Decrease the ratio for a faster run.
@@ -13,7 +13,7 @@ wtch-unpickle-cdf.py golden/mb/posterior.pkl ds{{ds_number}}.credible.nwk ds{{ds
 wtch-generate-all-nnis.sh ds{{ds_number}}.credible.nwk {{reroot_number}} > ds{{ds_number}}.neighbors.nwk
 
 # Get optimal branches from iqtree. 
-wtch-branch-optimization.py ds{{ds_number}}.neighbors.nwk ds{{ds_number}}.fasta ds{{ds_number}}.ordered.nwk --sort=True
+wtch-branch-optimization.py ds{{ds_number}}.neighbors.nwk ds{{ds_number}}.fasta ds{{ds_number}}.ordered.nwk --sort=True --jobs=16
 wtch-branch-optimization.py ds{{ds_number}}.credible.nwk ds{{ds_number}}.fasta ds{{ds_number}}.credible.with-branches.nwk --sort=False
 wtch-branch-optimization.py ds{{ds_number}}.mb-trees.nwk ds{{ds_number}}.fasta ds{{ds_number}}.mb-trees.with-branches.nwk --sort=False
 
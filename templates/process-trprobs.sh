@@ -2,3 +2,4 @@
 
 
 wtch-process-trprobs.py runs/a 0 9 ds{{ds_number}}.trprobs {{reroot_number}} posterior.pkl
+wmb posterior-store posterior.pkl
@@ -3,6 +3,13 @@
 import json
 import sys
 import click
+import numpy as np
+import wmb.newick as newick
+import wmb.nni as nni
+import wmb.parsimony as parsimony
+import wmb.posterior as posterior
+import wmb.representations as representations
+import wmb.score_cache as score_cache
 import wmb.templating as templating
 
 
@@ -52,5 +59,167 @@ def template(
     templating.template_file(template_name, template_dir, settings_dict, dest_path)
 
 
+@cli.command("reps-cache")
+@click.argument("sdag_rep_path", required=True, type=click.Path(exists=True))
+@click.option(
+    "--compression",
+    type=click.Choice(representations.CACHE_COMPRESSION_CHOICES),
+    default="none",
+    help="Compress the cache arrays, at the cost of memory mapping.",
+)
+@click.option("--force", is_flag=True, help="Rebuild the cache even if it is fresh.")
+def reps_cache(sdag_rep_path, compression, force):
+    """Convert a representations CSV from reps_and_likelihoods to the binary cache that
+    wtch-nni-likelihood-walk.py loads when it is fresher than the CSV."""
+    if force or not representations.sdag_rep_cache_is_fresh(sdag_rep_path):
+        representations.write_sdag_rep_cache(sdag_rep_path, compression=compression)
+
+
+@cli.command()
+@click.argument("nwk_path", required=True, type=click.File("r"))
+@click.argument("taxon", required=True)
+def reroot(nwk_path, taxon):
+    """Print the topologies of the trees in NWK_PATH, one per line, rerooted on the
+    taxon TAXON and ordered, as `nw_topology | nw_reroot - TAXON | nw_order -` does.
+    NWK_PATH may be - for standard input."""
+    for topology in newick.reroot_newicks(nwk_path, taxon):
+        click.echo(topology)
+
+
+@cli.command("nni-neighbors")
+@click.argument("nwk_path", required=True, type=click.File("r"))
+@click.argument("taxon", required=True)
+@click.option(
+    "--seed",
+    default=None,
+    type=int,
+    help="Print the neighbors in an order shuffled with this seed.",
+)
+def nni_neighbors(nwk_path, taxon, seed):
+    """Print the distinct NNI neighbors of the binary trees in NWK_PATH, one per line,
+    rerooted on the taxon TAXON and ordered as by `wmb reroot`. NWK_PATH may be - for
+    standard input."""
+    for topology in nni.unique_nni_neighbors(nwk_path, taxon, seed):
+        click.echo(topology)
+
+
+@cli.command("nni-graph")
+@click.argument("trees_path", required=True, type=click.Path(exists=True))
+@click.argument("adjacency_path", required=True, type=click.Path(exists=False))
+@click.option(
+    "--posterior",
+    "is_posterior",
+    is_flag=True,
+    help="TREES_PATH is a posterior pickle or store rather than a Newick file.",
+)
+@click.option(
+    "--edge-list-path",
+    default=None,
+    help="Also write the edges here, one tab-separated pair of tree ids per line.",
+)
+def nni_graph(trees_path, adjacency_path, is_posterior, edge_list_path):
+    """Write the graph joining the binary trees in TREES_PATH that are one NNI apart as
+    a CSR adjacency directory ADJACENCY_PATH, in the format of
+    `wtch-nni-likelihood-walk.py merge-shards`. The trees are numbered from 0 in the
+    order of the nonblank lines of the Newick file, or of the topologies of the
+    posterior."""
+    if is_posterior:
+        newicks = list(posterior.read_posterior(trees_path)[0])
+    else:
+        newicks = [line for line in newick.read_newick_file(trees_path) if line]
+    edges, tree_count = nni.nni_graph_edges(newicks)
+    nni.write_nni_graph(edges, tree_count, adjacency_path)
+    if edge_list_path is not None:
+        np.savetxt(edge_list_path, edges, fmt="%d", delimiter="\t")
+    print(f"{tree_count} trees, {len(edges)} NNI edges")
+
+
+@cli.command("count-topologies")
+@click.argument("t_paths", required=True, nargs=-1, type=click.Path(exists=True))
+@click.option("--reroot", "taxon", required=True, help="Taxon to reroot on.")
+@click.option(
+    "--burnin-samples",
+    default=0,
+    help="Start from this sample of each file, as tail -n +BURNIN_SAMPLES does.",
+)
+@click.option(
+    "--posterior-path",
+    default="rerooted-topologies.noburnin.posterior.nwk",
+    help="Where to write the posterior, a topology per line.",
+)
+@click.option(
+    "--pickle-path",
+    default="posterior.pkl",
+    help="Where to pickle the posterior dictionary and the credible set.",
+)
+@click.option("--processes", default=16, help="Number of worker processes.")
+def count_topologies(
+    t_paths, taxon, burnin_samples, posterior_path, pickle_path, processes
+):
+    """Count the rerooted topologies sampled in the MrBayes .t files T_PATHS after
+    burn-in, and write their posterior as the nw_reroot | sort | uniq -c pipeline and
+    wtch-pickle-cdf.py did."""
+    counts = posterior.count_topologies(t_paths, taxon, burnin_samples, processes)
+    rows = posterior.posterior_rows(counts)
+    posterior.write_posterior(rows, posterior_path)
+    posterior.write_posterior_pickle(rows, pickle_path)
+
+
+@cli.command("posterior-store")
+@click.argument("pickle_path", required=True, type=click.Path(exists=True))
+@click.option(
+    "--store-path",
+    default=None,
+    help="Where to write the store, by default PICKLE_PATH.store.",
+)
+@click.option("--no-newicks", is_flag=True, help="Only keep the topology hashes.")
+def posterior_store(pickle_path, store_path, no_newicks):
+    """Convert a posterior pickle of (pp_dict, credible_list) to a memory-mappable
+    posterior store, which the analysis scripts open in place of the pickle."""
+    posterior.convert_posterior_pickle(
+        pickle_path, store_path, with_newicks=not no_newicks
+    )
+
+
+@cli.command("nni-parsimony")
+@click.argument("nwk_path", required=True, type=click.Path(exists=True))
+@click.argument("fasta_path", required=True, type=click.Path(exists=True))
+@click.argument("output_path", required=True, type=click.Path(exists=False))
+def nni_parsimony(nwk_path, fasta_path, output_path):
+    """Write the NNI neighbors of the binary trees in NWK_PATH, one per line, each
+    followed by a tab and its parsimony score on the alignment in FASTA_PATH. The
+    neighbors are scored incrementally from the Fitch state sets of their parent."""
+    alignment = parsimony.encode_alignment(parsimony.load_fasta(fasta_path))
+    with open(nwk_path) as in_file, open(output_path, "w") as out_file:
+        for line in in_file:
+            if not line.strip():
+                continue
+            for neighbor, score in parsimony.nni_neighbor_scores(
+                line.strip(), alignment
+            ):
+                out_file.write(f"{neighbor}\t{score}\n")
+
+
+@cli.command("score-cache-stats")
+@click.option(
+    "--path",
+    default=None,
+    help="Path of the score cache, by default $WTCH_SCORE_CACHE or under ~/.cache.",
+)
+@click.option(
+    "--max-entries",
+    default=None,
+    type=int,
+    help="First evict the least recently used entries beyond this many.",
+)
+def score_cache_stats(path, max_entries):
+    """Print statistics of the score cache of likelihoods, optimized trees and
+    parsimony scores."""
+    cache = score_cache.open_score_cache(path)
+    if max_entries is not None:
+        score_cache.evict_scores(cache, max_entries)
+    print(json.dumps(score_cache.score_cache_stats(cache), indent=4))
+
+
 if __name__ == "__main__":
     cli()  # pylint: disable=no-value-for-parameter
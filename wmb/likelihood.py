@@ -0,0 +1,238 @@
+"""Log-likelihoods of trees with optimized branch lengths under the JC69 model.
+
+This is the model that simplest.mb uses (nst=1 rates=equal) and that we ask of iqtree
+with -m jc69. The alignment is collapsed into weighted site patterns, and a tip has the
+partial likelihood vector 1 for each state allowed by its character (see
+wmb.parsimony), so gaps and unknown characters allow every state.
+
+A tree is treated as unrooted, and is evaluated on its canonical topology (see
+wmb.newick.canonical_topology) rooted at the node next to the smallest taxon.
+Felsenstein pruning computes the partial likelihood vectors of all site patterns at
+once, rescaling them to avoid underflow. The branch lengths are then optimized one at a
+time, in rounds over the tree, until the log-likelihood stops improving. Given the
+partial likelihood vectors on both sides of an edge, the likelihood of a pattern is
+A + B e, where e = exp(-4t/3) for the branch length t. Since the log-likelihood is
+concave in e, Newton steps on e find the best branch length.
+
+Every tree is optimized from the same initial branch lengths, so its result does not
+depend on which trees were scored before it or by which worker process.
+"""
+
+import multiprocessing
+from collections import namedtuple
+
+import numpy as np
+
+from wmb.newick import canonical_topology
+from wmb.parsimony import STATE_BIT_COUNT, encode_states
+
+MIN_BRANCH_LENGTH = 1e-6
+MAX_BRANCH_LENGTH = 10.0
+DEFAULT_BRANCH_LENGTH = 0.1
+
+# The taxa map each taxon name to the Partial of its tip, and weights gives the number
+# of sites of each pattern.
+LikelihoodAlignment = namedtuple("LikelihoodAlignment", ["taxa", "weights"])
+
+# A partial likelihood vector for every site pattern, as a (4 x pattern count) array,
+# along with the per-pattern logarithms of the factors it was scaled down by.
+Partial = namedtuple("Partial", ["vectors", "log_scales"])
+
+# Worker state, set once per process by _init_worker rather than pickled per task.
+_alignment = None
+
+
+def encode_likelihood_alignment(fasta_map):
+    """Returns the LikelihoodAlignment of the dictionary fasta_map from taxon names to
+    aligned sequences.
+    """
+    states = encode_states(fasta_map)
+    patterns, weights = np.unique(states.T, axis=0, return_counts=True)
+    tip_vectors = (patterns.T[:, None, :] >> np.arange(STATE_BIT_COUNT)[:, None]) & 1
+    return LikelihoodAlignment(
+        taxa={
+            name: Partial(tip_vectors[row].astype(float), np.zeros(len(patterns)))
+            for row, name in enumerate(fasta_map)
+        },
+        weights=weights.astype(float),
+    )
+
+
+def jc69_transition(partial, length):
+    """Returns the Partial at the far end of an edge of the given length from partial,
+    that is, its vectors multiplied by the JC69 transition matrix.
+    """
+    e = np.exp(-4.0 * length / 3.0)
+    vectors = e * partial.vectors
+    vectors += (1.0 - e) / 4.0 * partial.vectors.sum(axis=0)
+    return Partial(vectors, partial.log_scales)
+
+
+def partial_product(partials):
+    """Returns the rescaled product of the nonempty list of Partials."""
+    vectors = partials[0].vectors.copy()
+    log_scales = partials[0].log_scales.copy()
+    for partial in partials[1:]:
+        vectors *= partial.vectors
+        log_scales += partial.log_scales
+    scales = vectors.max(axis=0)
+    vectors /= scales
+    log_scales += np.log(scales)
+    return Partial(vectors, log_scales)
+
+
+def optimize_edge_length(upper, lower, weights, length):
+    """Returns the branch length maximizing the likelihood of an edge with Partial upper
+    at one end and Partial lower at the other, starting the Newton steps from length.
+    """
+    upper_sums = upper.vectors.sum(axis=0)
+    lower_sums = lower.vectors.sum(axis=0)
+    constant = upper_sums * lower_sums / 16.0
+    slope = (upper.vectors * lower.vectors).sum(axis=0) / 4.0 - constant
+    min_e = np.exp(-4.0 * MAX_BRANCH_LENGTH / 3.0)
+    max_e = np.exp(-4.0 * MIN_BRANCH_LENGTH / 3.0)
+
+    # The log-likelihood is concave in e, so its gradient decreases in e, and the
+    # gradients seen so far bracket the optimum. Newton steps that leave the bracket
+    # are replaced by bisection.
+    low, high = min_e, max_e
+    e = min(max(np.exp(-4.0 * length / 3.0), min_e), max_e)
+    for _ in range(50):
+        ratios = slope / (constant + slope * e)
+        gradient = weights @ ratios
+        curvature = -(weights @ (ratios * ratios))
+        if gradient > 0.0:
+            low = e
+        else:
+            high = e
+        if curvature == 0.0:
+            break
+        new_e = e - gradient / curvature
+        if new_e >= high:
+            new_e = max_e if high == max_e else (e + high) / 2.0
+        elif new_e <= low:
+            new_e = min_e if low == min_e else (e + low) / 2.0
+        converged = abs(new_e - e) < 1e-10
+        e = new_e
+        if converged:
+            break
+    return float(-0.75 * np.log(e))
+
+
+def optimize_jc69_tree(tree, alignment, tolerance=1e-6, max_rounds=100):
+    """Returns the pair (T, L) of the Newick string T of tree, a nested tuple or Newick
+    string, with branch lengths that maximize its JC69 likelihood on alignment, and L
+    its log-likelihood. The rounds of branch length optimization stop once one improves
+    the log-likelihood by less than tolerance.
+    """
+    nodes, children = _node_lists(tree)
+    node_count = len(nodes)
+    lengths = [DEFAULT_BRANCH_LENGTH if v > 0 else 0.0 for v in range(node_count)]
+    weights = alignment.weights
+
+    # The initial pruning pass, in postorder.
+    lower = [None] * node_count
+    for v in reversed(range(node_count)):
+        if children[v]:
+            lower[v] = partial_product(
+                [jc69_transition(lower[c], lengths[c]) for c in children[v]]
+            )
+        else:
+            lower[v] = alignment.taxa[nodes[v]]
+
+    def log_likelihood():
+        root = partial_product(
+            [jc69_transition(lower[c], lengths[c]) for c in children[0]]
+        )
+        return float(
+            weights @ (np.log(root.vectors.sum(axis=0) / 4.0) + root.log_scales)
+        )
+
+    def optimize_below(v, from_above):
+        """Optimizes the edges below node v, where from_above is the Partial at v of
+        the rest of the tree, or None at the root.
+        """
+        messages = {c: jc69_transition(lower[c], lengths[c]) for c in children[v]}
+        for c in children[v]:
+            factors = [messages[s] for s in children[v] if s != c]
+            if from_above is not None:
+                factors.append(from_above)
+            upper = partial_product(factors)
+            lengths[c] = optimize_edge_length(upper, lower[c], weights, lengths[c])
+            if children[c]:
+                optimize_below(c, jc69_transition(upper, lengths[c]))
+                lower[c] = partial_product(
+                    [jc69_transition(lower[g], lengths[g]) for g in children[c]]
+                )
+            messages[c] = jc69_transition(lower[c], lengths[c])
+
+    value = log_likelihood()
+    for _ in range(max_rounds):
+        optimize_below(0, None)
+        new_value = log_likelihood()
+        converged = new_value - value < tolerance
+        value = new_value
+        if converged:
+            break
+
+    def subtree_newick(v):
+        if not children[v]:
+            return nodes[v]
+        return (
+            "("
+            + ",".join(f"{subtree_newick(c)}:{lengths[c]:.10g}" for c in children[v])
+            + ")"
+        )
+
+    return subtree_newick(0) + ";", value
+
+
+def _node_lists(tree):
+    """Returns the preorder lists (N, C) of the nodes and of the children of the nodes
+    of the canonical topology of tree, rooted at the node next to the smallest taxon.
+    A node is a nested tuple.
+    """
+    smallest_taxon, rest = canonical_topology(tree)
+    nodes = []
+    children = []
+    stack = [((smallest_taxon,) + rest, None)]
+    while stack:
+        node, parent = stack.pop()
+        index = len(nodes)
+        nodes.append(node)
+        children.append([])
+        if parent is not None:
+            children[parent].append(index)
+        if not isinstance(node, str):
+            stack.extend((child, index) for child in reversed(node))
+    return nodes, children
+
+
+def optimized_jc69_trees(newicks, alignment):
+    """Yields the pairs of optimize_jc69_tree for the Newick strings newicks, in
+    order.
+    """
+    for newick in newicks:
+        yield optimize_jc69_tree(newick, alignment)
+
+
+def _init_worker(alignment):
+    global _alignment
+    _alignment = alignment
+
+
+def _optimize_jc69_tree_worker(newick):
+    return optimize_jc69_tree(newick, _alignment)
+
+
+def optimized_jc69_trees_pool(newicks, alignment, processes=16):
+    """Yields the pairs of optimize_jc69_tree for the Newick strings newicks in order,
+    computed by the given number of worker processes.
+    """
+    if processes <= 1:
+        yield from optimized_jc69_trees(newicks, alignment)
+        return
+    with multiprocessing.Pool(
+        processes=processes, initializer=_init_worker, initargs=(alignment,)
+    ) as pool:
+        yield from pool.imap(_optimize_jc69_tree_worker, newicks, chunksize=64)
@@ -0,0 +1,182 @@
+"""How MCMC topology sequences accumulate the golden posterior.
+
+A topology sequence is a .tab file of MrBayes samples run-length encoded by
+`uniq -c`: each line gives a dwell count, a tab and a rerooted topology (see
+templates/process-watching-mb-run.sh). The file is read in chunks, and topologies are
+factorized to integer codes as they first appear, so that each distinct topology is
+looked up in the golden posterior (see wmb.posterior) only once. The topology column of
+the result is categorical, which keeps one copy of each Newick string.
+
+The topologies in order of first appearance are kept in a topology log: an
+append-only Newick file with a topology per line, and an index of the byte offsets of
+its lines, so that the topologies seen by any prefix of the sequence are a prefix of
+the file. An index that is missing is rebuilt from the log, and one that does not end
+at the end of the log is an error.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from wmb.posterior import credible_count, in_credible, lookup_pp, topology_hashes
+
+# The number of lines of a topology sequence read at a time.
+DEFAULT_CHUNK_SIZE = 2**18
+
+
+def topology_log_index_path_of(log_path):
+    """Returns the path of the offset index of the topology log log_path."""
+    return log_path + ".offsets"
+
+
+def write_topology_log_index(log_path):
+    """Writes the offset index of the topology log log_path from its lines, creating an
+    empty log if there is none.
+    """
+    offsets = [0]
+    with open(log_path, "ab+") as log_file:
+        log_file.seek(0)
+        for line in log_file:
+            if not line.endswith(b"\n"):
+                raise ValueError(f"The topology log {log_path} ends mid-line")
+            offsets.append(offsets[-1] + len(line))
+    with open(topology_log_index_path_of(log_path), "wb") as index_file:
+        index_file.write(np.array(offsets, dtype="<i8").tobytes())
+
+
+def append_to_topology_log(topologies, log_path):
+    """Appends the Newick strings topologies to the topology log log_path, creating it
+    if needed, and returns the number of topologies in the log. The index of a log
+    without one is rebuilt first.
+    """
+    index_path = topology_log_index_path_of(log_path)
+    if not os.path.exists(index_path):
+        write_topology_log_index(log_path)
+    with open(log_path, "ab") as log_file, open(index_path, "ab") as index_file:
+        offset = log_file.tell()
+        if os.path.getsize(index_path) < 8 or offset != int(
+            topology_log_offsets(log_path)[-1]
+        ):
+            raise ValueError(
+                f"The index of the topology log {log_path} does not match the log"
+            )
+        lengths = []
+        for topology in topologies:
+            line = (topology + "\n").encode()
+            log_file.write(line)
+            lengths.append(len(line))
+        offsets = offset + np.cumsum(lengths, dtype=np.int64)
+        index_file.write(offsets.astype("<i8").tobytes())
+    return topology_log_count(log_path)
+
+
+def write_topology_log(topologies, log_path):
+    """Writes the Newick strings topologies to a new topology log log_path."""
+    for path in [log_path, topology_log_index_path_of(log_path)]:
+        if os.path.exists(path):
+            os.remove(path)
+    return append_to_topology_log(topologies, log_path)
+
+
+def topology_log_offsets(log_path):
+    """Returns the memory-mapped int64 array of the byte offsets of the lines of the
+    topology log log_path, with one more entry than the number of topologies.
+    """
+    return np.memmap(topology_log_index_path_of(log_path), dtype="<i8", mode="r")
+
+
+def topology_log_count(log_path):
+    """Returns the number of topologies in the topology log log_path."""
+    return os.path.getsize(topology_log_index_path_of(log_path)) // 8 - 1
+
+
+def read_topology_log_prefix(log_path, topology_count):
+    """Returns the list of the first topology_count topologies of the topology log
+    log_path, reading only their bytes.
+    """
+    offsets = topology_log_offsets(log_path)
+    if not 0 <= topology_count < len(offsets):
+        raise ValueError(
+            f"The topology log {log_path} has {len(offsets) - 1} topologies, not "
+            f"{topology_count}"
+        )
+    stop = int(offsets[topology_count])
+    with open(log_path, "rb") as log_file:
+        data = log_file.read(stop)
+    if len(data) < stop:
+        raise ValueError(f"The topology log {log_path} is shorter than its index")
+    return data.decode().splitlines()
+
+
+def mcmc_df_of_topology_sequence(
+    topology_sequence_path, golden, chunk_size=DEFAULT_CHUNK_SIZE
+):
+    """Returns a DataFrame with a row per line of the topology sequence file
+    topology_sequence_path, with the columns dwell_count and topology from the file,
+    and the accumulation curves against the PosteriorStore golden: first_time (whether
+    the topology appears for the first time), support_size (the number of distinct
+    topologies so far), mcmc_iters (the number of samples so far), pp (the posterior
+    probability of the topology), total_pp (the posterior probability of the distinct
+    topologies so far), in_credible_set, credible_set_found (the number of credible
+    topologies so far) and credible_set_frac.
+    """
+    code_of_topology = {}
+    topologies = []
+    pp_of_code = []
+    credible_of_code = []
+    dwell_counts = []
+    codes = []
+    for chunk in pd.read_csv(
+        topology_sequence_path,
+        delimiter="\t",
+        names=["dwell_count", "topology"],
+        chunksize=chunk_size,
+    ):
+        chunk_codes, chunk_topologies = pd.factorize(chunk["topology"])
+        new_topologies = [
+            topology
+            for topology in chunk_topologies
+            if topology not in code_of_topology
+        ]
+        for topology in new_topologies:
+            code_of_topology[topology] = len(topologies)
+            topologies.append(topology)
+        new_hashes = topology_hashes(new_topologies)
+        pp_of_code.append(lookup_pp(golden, new_hashes))
+        credible_of_code.append(in_credible(golden, new_hashes))
+        global_codes = np.fromiter(
+            (code_of_topology[topology] for topology in chunk_topologies),
+            dtype=np.int64,
+            count=len(chunk_topologies),
+        )
+        codes.append(global_codes[chunk_codes])
+        dwell_counts.append(chunk["dwell_count"].to_numpy())
+
+    codes = np.concatenate(codes) if codes else np.zeros(0, dtype=np.int64)
+    pp_of_code = np.concatenate(pp_of_code) if pp_of_code else np.zeros(0)
+    credible_of_code = (
+        np.concatenate(credible_of_code)
+        if credible_of_code
+        else np.zeros(0, dtype=np.bool_)
+    )
+    df = pd.DataFrame(
+        {
+            "dwell_count": (
+                np.concatenate(dwell_counts)
+                if dwell_counts
+                else np.zeros(0, dtype=np.int64)
+            ),
+            "topology": pd.Categorical.from_codes(codes, categories=topologies),
+        }
+    )
+    # Codes are numbered in order of first appearance.
+    df["first_time"] = ~pd.Series(codes).duplicated().to_numpy()
+    df["support_size"] = df["first_time"].cumsum()
+    df["mcmc_iters"] = df["dwell_count"].cumsum()
+    df["pp"] = pp_of_code[codes]
+    df["total_pp"] = (df["pp"] * df["first_time"]).cumsum()
+    df["in_credible_set"] = credible_of_code[codes]
+    df["credible_set_found"] = (df["in_credible_set"] & df["first_time"]).cumsum()
+    df["credible_set_frac"] = df["credible_set_found"] / credible_count(golden)
+    return df
@@ -0,0 +1,177 @@
+"""Read and write trees in Newick format.
+
+A tree is a nested tuple: a leaf is its name, and an internal node is the tuple of its
+children. Branch lengths and internal node labels are dropped when parsing, so the
+tuple only describes the topology. Quoted labels are not supported.
+
+Rerooted topologies are written as newick_utils writes them with
+`nw_topology | nw_reroot - <taxon> | nw_order -`: rooted on the pendant edge of the
+taxon, without branch lengths, and with the children of every node sorted by their
+first label, so that a clade sorts by its alphabetically smallest leaf name.
+"""
+
+import functools
+import re
+
+# A token is a parenthesis, a comma, a semicolon, a branch length or a label.
+_TOKEN_RE = re.compile(r"[(),;]|:[^(),;]*|[^(),;:\s]+")
+
+_BRANCH_LENGTH_RE = re.compile(r":[^(),;]*")
+
+# The number of distinct topologies whose rerooted Newick strings are memoized.
+REROOT_CACHE_SIZE = 2**16
+
+
+def parse_newick(newick):
+    """Returns the nested tuple of the Newick string newick."""
+    stack = [[]]
+    after_subtree = False
+    for token in _TOKEN_RE.findall(newick):
+        if token == "(":
+            stack.append([])
+            after_subtree = False
+        elif token == ")":
+            if len(stack) < 2:
+                raise ValueError(f"Unbalanced parentheses in Newick: {newick}")
+            children = stack.pop()
+            stack[-1].append(tuple(children))
+            after_subtree = True
+        elif token == ",":
+            after_subtree = False
+        elif token == ";":
+            break
+        elif token[0] == ":":
+            continue
+        elif after_subtree:
+            # The label of an internal node, such as a support value.
+            continue
+        else:
+            stack[-1].append(token)
+    if len(stack) != 1 or len(stack[0]) != 1:
+        raise ValueError(f"Malformed Newick: {newick}")
+    return stack[0][0]
+
+
+def to_newick(tree):
+    """Returns the Newick string of the nested tuple tree, without branch lengths."""
+
+    def subtree_newick(node):
+        if isinstance(node, str):
+            return node
+        return "(" + ",".join(subtree_newick(child) for child in node) + ")"
+
+    return subtree_newick(tree) + ";"
+
+
+def leaf_names(tree):
+    """Returns the list of leaf names of the nested tuple tree, from left to right."""
+    if isinstance(tree, str):
+        return [tree]
+    return [name for child in tree for name in leaf_names(child)]
+
+
+def canonical_topology(tree):
+    """Returns a nested tuple giving the unrooted topology of tree, a nested tuple or
+    Newick string, in a canonical form: rooted at the leaf with the smallest name, with
+    the children of every node sorted by their smallest leaf name. Two trees have the
+    same canonical topology exactly when they have the same unrooted topology.
+    """
+    if isinstance(tree, str):
+        tree = parse_newick(tree)
+    if isinstance(tree, str) or len(tree) < 2:
+        return tree
+    return _rooted_at_leaf(tree, None)
+
+
+def rerooted_topology(tree, taxon):
+    """Returns the nested tuple of tree, a nested tuple or Newick string, rooted on the
+    pendant edge of the leaf named taxon, with the children of every node sorted by
+    their smallest leaf name. This is the topology of
+    `nw_topology | nw_reroot - <taxon> | nw_order -`.
+    """
+    if isinstance(tree, str):
+        tree = parse_newick(tree)
+    if isinstance(tree, str) or len(tree) < 2:
+        return tree
+    name, rest = _rooted_at_leaf(tree, taxon)
+    if min(leaf_names(rest)) < name:
+        return (rest, name)
+    return (name, rest)
+
+
+def _rooted_at_leaf(tree, taxon):
+    """Returns the pair (L, R) of the name L of the leaf taxon of the nested tuple
+    tree, or of its smallest leaf name when taxon is None, and the nested tuple R of
+    the rest of the unrooted tree, hanging from the neighbor of that leaf. The children
+    of every node of R are sorted by their smallest leaf name.
+    """
+    # Build the unrooted adjacency, with nodes numbered in preorder.
+    neighbors = []
+    names = []
+    stack = [(tree, None)]
+    while stack:
+        node, parent = stack.pop()
+        index = len(neighbors)
+        neighbors.append([] if parent is None else [parent])
+        names.append(node if isinstance(node, str) else None)
+        if parent is not None:
+            neighbors[parent].append(index)
+        if not isinstance(node, str):
+            stack.extend((child, index) for child in reversed(node))
+    # A root with two children is not a node of the unrooted tree.
+    if len(neighbors[0]) == 2:
+        left, right = neighbors[0]
+        neighbors[left][neighbors[left].index(0)] = right
+        neighbors[right][neighbors[right].index(0)] = left
+    leaves = (index for index, name in enumerate(names) if name is not None)
+    if taxon is None:
+        root = min(leaves, key=lambda index: names[index])
+    else:
+        root = next((index for index in leaves if names[index] == taxon), None)
+        if root is None:
+            raise ValueError(f"Taxon {taxon} is not in the tree")
+
+    def subtree(index, parent):
+        if names[index] is not None and index != root:
+            return names[index], names[index]
+        children = sorted(
+            subtree(child, index) for child in neighbors[index] if child != parent
+        )
+        return children[0][0], tuple(child for _, child in children)
+
+    (neighbor,) = neighbors[root]
+    _, rest = subtree(neighbor, root)
+    return (names[root], rest)
+
+
+def strip_branch_lengths(newick):
+    """Returns the Newick string newick without its branch lengths."""
+    return _BRANCH_LENGTH_RE.sub("", newick.strip())
+
+
+@functools.lru_cache(maxsize=REROOT_CACHE_SIZE)
+def _reroot_topology_newick(topology_newick, taxon):
+    return to_newick(rerooted_topology(topology_newick, taxon))
+
+
+def reroot_newick(newick, taxon):
+    """Returns the Newick string of rerooted_topology(newick, taxon). Since branch
+    lengths are stripped first, the results are memoized by topology, so trees sampled
+    again and again are only parsed once.
+    """
+    return _reroot_topology_newick(strip_branch_lengths(newick), taxon)
+
+
+def reroot_newicks(newicks, taxon):
+    """Yields reroot_newick(newick, taxon) for the Newick strings newicks, skipping
+    blank lines, so that a file of trees can be rerooted as it is read.
+    """
+    for newick in newicks:
+        if newick.strip():
+            yield reroot_newick(newick, taxon)
+
+
+def read_newick_file(nwk_path):
+    """Returns the list of Newick strings in the file nwk_path, one per line."""
+    with open(nwk_path) as the_file:
+        return [line.strip() for line in the_file]
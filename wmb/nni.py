@@ -0,0 +1,174 @@
+"""NNI neighbors of collections of trees, without duplicates.
+
+The NNI neighbors of a binary tree on n taxa are the 2(n-3) trees of
+wmb.parsimony.nni_neighbors. Neighbors of different trees often coincide, so each
+neighbor is put in a canonical form, rerooted on a given taxon with sorted children
+(see wmb.newick.rerooted_topology), and only the first copy of each canonical Newick
+string is kept. Duplicates are found by the 128-bit hashes of these strings, so that
+memory grows by a few dozen bytes per distinct neighbor rather than by its Newick
+string. Shuffled neighbors are spilled to a temporary file and read back in a random
+order by their byte offsets, which keeps this bound.
+
+The NNI graph of a collection of binary trees joins the pairs of trees that are one
+NNI apart. Two distinct unrooted binary trees are one NNI apart exactly when
+contracting an internal edge of each gives the same tree, that is, when removing one
+split from each split set leaves the same set. So every tree is given a key for each
+of its internal edges, the hash of its split set without that split, and trees that
+share a key are joined. Split sets are hashed Zobrist style, as the sum modulo 2^128
+of the 128-bit hashes of their splits, so the key of each contracted edge is the hash
+of the whole tree minus the hash of one split. This takes time linear in the total
+size of the trees, with no comparison of pairs of trees that share no key.
+"""
+
+import functools
+import hashlib
+import os
+import tempfile
+from array import array
+
+import numpy as np
+
+from wmb.newick import parse_newick, rerooted_topology, to_newick
+from wmb.parsimony import nni_neighbors
+from wmb.traversal import merge_edge_shards, write_edge_shard
+
+SPLIT_HASH_MODULUS = 2**128
+SPLIT_HASH_CACHE_SIZE = 2**20
+
+
+def unique_nni_neighbors(newicks, taxon, seed=None):
+    """Yields the distinct NNI neighbors of the binary trees given by the Newick
+    strings newicks, as Newick strings of their topologies rerooted on taxon, skipping
+    blank lines. Neighbors are yielded as they are first generated, unless seed is
+    given, in which case they are all written to a temporary file and yielded in an
+    order shuffled with that seed.
+    """
+    seen = set()
+
+    def iter_unique():
+        for newick in newicks:
+            if not newick.strip():
+                continue
+            for neighbor in nni_neighbors(parse_newick(newick)):
+                topology = to_newick(rerooted_topology(neighbor, taxon))
+                key = hashlib.blake2b(topology.encode(), digest_size=16).digest()
+                if key not in seen:
+                    seen.add(key)
+                    yield topology
+
+    if seed is None:
+        yield from iter_unique()
+        return
+    with tempfile.TemporaryFile() as spill_file:
+        offsets = array("q", [0])
+        for topology in iter_unique():
+            spill_file.write((topology + "\n").encode())
+            offsets.append(spill_file.tell())
+        offsets = np.frombuffer(offsets, dtype=np.int64)
+        for j in np.random.default_rng(seed).permutation(len(offsets) - 1):
+            spill_file.seek(offsets[j])
+            yield spill_file.read(offsets[j + 1] - offsets[j] - 1).decode()
+
+
+@functools.lru_cache(maxsize=SPLIT_HASH_CACHE_SIZE)
+def _split_hash(split):
+    split_bytes = split.to_bytes((split.bit_length() + 7) // 8, "little")
+    return int.from_bytes(
+        hashlib.blake2b(split_bytes, digest_size=16).digest(), "little"
+    )
+
+
+def tree_splits(tree, taxa):
+    """Returns the list of the nontrivial splits of the unrooted binary tree tree, a
+    nested tuple or Newick string whose root may have two or three children, as int
+    bitmasks of the side without the taxon of lowest bit. The dictionary taxa maps
+    taxon names to their bits, and taxa not yet in it are given new bits.
+    """
+    if isinstance(tree, str):
+        tree = parse_newick(tree)
+    if isinstance(tree, str) or len(tree) not in (2, 3):
+        raise ValueError("The NNI graph requires binary trees")
+    clades = []
+
+    def clade_below(node):
+        if isinstance(node, str):
+            if node not in taxa:
+                taxa[node] = 1 << len(taxa)
+            return taxa[node]
+        if len(node) != 2:
+            raise ValueError("The NNI graph requires binary trees")
+        clade = clade_below(node[0]) | clade_below(node[1])
+        clades.append(clade)
+        return clade
+
+    all_taxa = 0
+    for child in tree:
+        all_taxa |= clade_below(child)
+    reference = all_taxa & -all_taxa
+    splits = set()
+    for clade in clades:
+        if clade & reference:
+            clade ^= all_taxa
+        # Leaves and the complement of the reference taxon are trivial splits. The
+        # two children of a binary root give the same split.
+        if clade & (clade - 1) and clade != all_taxa ^ reference:
+            splits.add(clade)
+    return list(splits)
+
+
+def nni_graph_edges(newicks):
+    """Returns the pair (E, n) of the (edge count x 2) int64 array E of the pairs (j,
+    k) with j < k of the trees in the list of Newick strings newicks that are one NNI
+    apart, sorted, and the number n of trees. The trees must be binary and on the same
+    taxa. Repeated topologies are not joined to each other.
+    """
+    taxa = {}
+    split_counts = set()
+    tree_keys = []
+    edge_keys = []
+    edge_trees = []
+    for tree_id, newick in enumerate(newicks):
+        splits = tree_splits(newick, taxa)
+        split_counts.add(len(splits))
+        split_hashes = [_split_hash(split) for split in splits]
+        tree_key = sum(split_hashes) % SPLIT_HASH_MODULUS
+        tree_keys.append(tree_key.to_bytes(16, "little"))
+        for split_hash in split_hashes:
+            edge_key = (tree_key - split_hash) % SPLIT_HASH_MODULUS
+            edge_keys.append(edge_key.to_bytes(16, "little"))
+        edge_trees.extend([tree_id] * len(splits))
+    # A binary tree on n taxa has n - 3 nontrivial splits, so a tree has all of the
+    # taxa seen in any tree exactly when it has len(taxa) - 3 of them.
+    if split_counts and split_counts != {len(taxa) - 3}:
+        raise ValueError("The trees of an NNI graph must have the same taxa")
+    tree_count = len(tree_keys)
+    tree_keys = np.array(tree_keys, dtype="S16")
+    edge_keys = np.array(edge_keys, dtype="S16")
+    edge_trees = np.array(edge_trees, dtype=np.int64)
+
+    # A contracted tree has three resolutions, so the trees sharing a key are few,
+    # unless topologies are repeated.
+    order = np.argsort(edge_keys, kind="stable")
+    edge_keys, edge_trees = edge_keys[order], edge_trees[order]
+    starts = np.flatnonzero(np.r_[True, edge_keys[1:] != edge_keys[:-1]])
+    stops = np.r_[starts[1:], len(edge_keys)]
+    edges = []
+    for start, stop in zip(starts[stops - starts > 1], stops[stops - starts > 1]):
+        group = edge_trees[start:stop]
+        for position, j in enumerate(group):
+            for k in group[position + 1 :]:
+                if tree_keys[j] != tree_keys[k]:
+                    edges.append((min(j, k), max(j, k)))
+    edges = np.array(edges, dtype=np.int64).reshape(-1, 2)
+    return np.unique(edges, axis=0), tree_count
+
+
+def write_nni_graph(edges, tree_count, adjacency_path):
+    """Writes the NNI graph with the given edges on tree_count trees as a CSR adjacency
+    directory adjacency_path, which wmb.traversal.load_csr memory maps.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        shard_path = os.path.join(tmpdir, "edges.bin")
+        write_edge_shard([edges.tolist()], shard_path, tree_count, 0, tree_count)
+        merge_edge_shards([shard_path], adjacency_path)
+    return adjacency_path
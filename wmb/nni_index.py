@@ -0,0 +1,174 @@
+"""Find the pairs of trees that are a single NNI apart in a common subsplit DAG.
+
+Trees are given as a bitset matrix (see wmb.representations), with a row per tree.
+Two trees are considered NNI related when their rows differ in at most
+NNI_HAMMING_RADIUS bits.
+
+The all-pairs engine compares every pair of trees, which is quadratic in the number
+of trees. The prefix engine gives the same edges without doing so, using the prefix
+filter from set similarity joins. Order the sDAG nodes from rarest to most common. If
+trees A and B differ in at most r nodes, the first node of A & B in that order is
+preceded in A only by nodes of A - B, and in B only by nodes of B - A. So A and B share
+a node among the first |A - B| + 1 nodes of A and among the first |B - A| + 1 nodes of
+B, and both of these are bounded in terms of r and the tree sizes. We index every
+tree by the nodes of its prefix and only compare trees that share a prefix node.
+Since the rarest nodes come first, these posting lists are short.
+"""
+
+import multiprocessing
+from collections import defaultdict
+
+import numpy as np
+
+from wmb.representations import hamming_distances, popcount
+
+NNI_HAMMING_RADIUS = 10
+
+NEIGHBOR_INDEX_CHOICES = ["prefix", "all-pairs"]
+
+# Worker state, set once per process by _init_worker rather than pickled per task.
+_tree_bits = None
+_prefix_index = None
+
+
+def are_nni_related(this_bits, that_bits):
+    """Determine if two bitset rows represent trees that are a single NNI operation
+    away from each other (in the common subsplit dag). When that_bits is a matrix, this
+    returns a boolean array with an entry per row.
+    """
+    return hamming_distances(that_bits, this_bits) <= NNI_HAMMING_RADIUS
+
+
+def node_frequencies(tree_bits, chunk_size=2**14):
+    """Returns an array giving the number of trees containing each sDAG node."""
+    frequencies = np.zeros(64 * tree_bits.shape[1], dtype=np.int64)
+    for start in range(0, len(tree_bits), chunk_size):
+        chunk = np.ascontiguousarray(tree_bits[start : start + chunk_size], dtype="<u8")
+        frequencies += np.unpackbits(
+            chunk.view(np.uint8), axis=1, bitorder="little"
+        ).sum(axis=0, dtype=np.int64)
+    return frequencies
+
+
+def prefix_length(node_count, min_node_count, radius=NNI_HAMMING_RADIUS):
+    """Returns how many of the rarest nodes of a tree with node_count nodes must be
+    indexed so that every tree within radius of it, among trees with at least
+    min_node_count nodes, shares one of them.
+
+    If |A ^ B| <= radius and |B| >= min_node_count, then
+    |A - B| = (|A ^ B| + |A| - |B|) / 2 <= (radius + |A| - min_node_count) / 2.
+    """
+    return (radius + node_count - min_node_count) // 2 + 1
+
+
+def build_prefix_index(tree_bits):
+    """Returns a pair (P, N), where P[j] is the array of prefix nodes of tree j and N
+    maps each node to the increasing array of the trees having it as a prefix node.
+    """
+    if len(tree_bits) == 0:
+        return [], {}
+    frequencies = node_frequencies(tree_bits)
+    node_counts = popcount(tree_bits).sum(axis=1, dtype=np.int64)
+    min_node_count = int(node_counts.min())
+    prefixes = []
+    posting_lists = defaultdict(list)
+    for j, bits_row in enumerate(tree_bits):
+        bytes_row = np.ascontiguousarray(bits_row, dtype="<u8").view(np.uint8)
+        nodes = np.flatnonzero(np.unpackbits(bytes_row, bitorder="little"))
+        # A stable sort, so that ties in frequency are broken by node index.
+        nodes = nodes[np.argsort(frequencies[nodes], kind="stable")]
+        prefix = nodes[: prefix_length(len(nodes), min_node_count)]
+        prefixes.append(prefix)
+        for node in prefix.tolist():
+            posting_lists[node].append(j)
+    postings = {
+        node: np.array(trees, dtype=np.int64) for node, trees in posting_lists.items()
+    }
+    return prefixes, postings
+
+
+def find_nni_trees(j, tree_bits):
+    """Returns a list of pairs (j,k), where rows j and k of tree_bits represent trees
+    that are single NNI operation away from each other. This compares tree j against
+    every later tree.
+    """
+    later_trees = np.flatnonzero(are_nni_related(tree_bits[j], tree_bits[j + 1 :]))
+    return [(j, k) for k in (later_trees + j + 1).tolist()]
+
+
+def prefix_candidates(j, prefix_index):
+    """Returns the increasing array of trees sharing a prefix node with tree j, which
+    includes tree j itself and every tree that is NNI related to it.
+    """
+    prefixes, postings = prefix_index
+    return np.unique(np.concatenate([postings[node] for node in prefixes[j].tolist()]))
+
+
+def find_nni_trees_indexed(j, tree_bits, prefix_index):
+    """Returns the same list of pairs as find_nni_trees, but only compares tree j
+    against the later trees sharing one of its prefix nodes.
+    """
+    candidates = prefix_candidates(j, prefix_index)
+    candidates = candidates[np.searchsorted(candidates, j, side="right") :]
+    related = are_nni_related(tree_bits[j], tree_bits[candidates])
+    return [(j, k) for k in candidates[related].tolist()]
+
+
+def find_nni_neighbors(j, tree_bits, prefix_index):
+    """Returns the increasing array of all trees, earlier or later, that are a single
+    NNI operation away from tree j. This is how the walk explores the graph lazily.
+    """
+    candidates = prefix_candidates(j, prefix_index)
+    candidates = candidates[candidates != j]
+    return candidates[are_nni_related(tree_bits[j], tree_bits[candidates])]
+
+
+def _init_worker(tree_bits, prefix_index):
+    global _tree_bits, _prefix_index
+    _tree_bits = tree_bits
+    _prefix_index = prefix_index
+
+
+def _find_nni_trees_worker(j):
+    if _prefix_index is None:
+        return find_nni_trees(j, _tree_bits)
+    return find_nni_trees_indexed(j, _tree_bits, _prefix_index)
+
+
+def iter_nni_edge_lists(tree_bits, rows, neighbor_index="prefix", processes=16):
+    """Yields, for each row j of rows in order, the list of pairs (j,k) with j < k such
+    that rows j and k of tree_bits represent trees a single NNI apart, ordered by k.
+    Only the lists that have not been consumed yet are held in memory, so a large row
+    range can be written out as it is computed.
+
+    The neighbor_index parameter selects the engine, either "prefix" or "all-pairs";
+    both give the same edges.
+    """
+    if neighbor_index not in NEIGHBOR_INDEX_CHOICES:
+        raise ValueError(f"Unknown neighbor index: {neighbor_index}")
+    prefix_index = None
+    if neighbor_index == "prefix":
+        prefix_index = build_prefix_index(tree_bits)
+
+    # For the cluster, 16 processes works well.
+    with multiprocessing.Pool(
+        processes=processes,
+        initializer=_init_worker,
+        initargs=(tree_bits, prefix_index),
+    ) as pool:
+        yield from pool.imap(_find_nni_trees_worker, rows, chunksize=256)
+
+
+def find_nni_edges(tree_bits, neighbor_index="prefix", processes=16):
+    """Returns the list of all pairs (j,k) with j < k such that rows j and k of
+    tree_bits represent trees a single NNI apart, ordered by j and then k (see
+    iter_nni_edge_lists).
+    """
+    if neighbor_index not in NEIGHBOR_INDEX_CHOICES:
+        raise ValueError(f"Unknown neighbor index: {neighbor_index}")
+    if len(tree_bits) < 2:
+        return []
+    edge_lists = iter_nni_edge_lists(
+        tree_bits, range(len(tree_bits) - 1), neighbor_index, processes
+    )
+    return [edge for edge_list in edge_lists for edge in edge_list]
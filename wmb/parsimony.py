@@ -0,0 +1,371 @@
+"""Fitch parsimony scores of trees on a nucleotide alignment.
+
+The alignment is encoded once as a uint8 matrix of state sets, with a row per taxon and
+a column per site pattern. A state set has bit 0 for A, bit 1 for C, bit 2 for G and
+bit 3 for T, so that IUPAC ambiguity codes are unions of bits. Gaps and unknown
+characters are treated as any state, as gctree's sankoff_upward does with
+gap_as_char=False. Identical site patterns are collapsed into one column with a weight,
+and patterns whose states all share a base are dropped, since they cost nothing on any
+tree.
+
+A tree is scored with the Fitch algorithm, whose steps are bitwise operations on the
+state sets of all site patterns at once. Multifurcating nodes use Hartigan's
+generalization, which keeps the states that appear in the most children.
+
+The NNI neighbors of a scored tree are scored incrementally. An NNI across an internal
+edge only changes the Fitch state sets of the nodes on the path from that edge to the
+root, so only these are recomputed from the state sets kept for the parent tree.
+"""
+
+import multiprocessing
+from collections import namedtuple
+
+import numpy as np
+
+from wmb.newick import parse_newick, read_newick_file, to_newick
+from wmb.score_cache import (
+    ScoreRecord,
+    alignment_digest,
+    lookup_scores,
+    store_scores,
+    topology_key,
+)
+
+STATE_BITS = {
+    "A": 1,
+    "C": 2,
+    "G": 4,
+    "T": 8,
+    "U": 8,
+    "R": 5,
+    "Y": 10,
+    "S": 6,
+    "W": 9,
+    "K": 12,
+    "M": 3,
+    "B": 14,
+    "D": 13,
+    "H": 11,
+    "V": 7,
+    "N": 15,
+    "-": 15,
+    "?": 15,
+    ".": 15,
+}
+STATE_BIT_COUNT = 4
+
+# Maps each byte to its state set, with 0 for characters that are not states.
+_STATE_TABLE = np.zeros(256, dtype=np.uint8)
+for _char, _bits in STATE_BITS.items():
+    _STATE_TABLE[ord(_char)] = _bits
+    _STATE_TABLE[ord(_char.lower())] = _bits
+
+# The taxa map each taxon name to its row of states, which is a (taxon count x pattern
+# count) uint8 matrix, and weights gives the number of sites of each pattern. The digest
+# identifies the alignment in the score cache (see wmb.score_cache).
+Alignment = namedtuple("Alignment", ["taxa", "states", "weights", "digest"])
+
+# The model name of parsimony scores in the score cache.
+PARSIMONY_CACHE_MODEL = "fitch"
+
+# Worker state, set once per process by _init_worker rather than pickled per task.
+_alignment = None
+
+
+def load_fasta(fasta_path):
+    """Returns a dictionary mapping the names of the sequences of the FASTA file
+    fasta_path to the sequences, in file order.
+    """
+    fasta_map = {}
+    name = None
+    with open(fasta_path) as the_file:
+        for line in the_file:
+            line = line.strip()
+            if line.startswith(">"):
+                name = line[1:].strip()
+                fasta_map[name] = []
+            elif line:
+                fasta_map[name].append(line)
+    return {name: "".join(lines) for name, lines in fasta_map.items()}
+
+
+def encode_states(fasta_map):
+    """Returns the (taxon count x site count) uint8 matrix of the state sets of the
+    dictionary fasta_map from taxon names to aligned sequences, with rows in the order
+    of fasta_map.
+    """
+    sequences = [sequence.encode("ascii") for sequence in fasta_map.values()]
+    if len({len(sequence) for sequence in sequences}) > 1:
+        raise ValueError("The sequences of the alignment differ in length")
+    codes = np.frombuffer(b"".join(sequences), dtype=np.uint8)
+    states = _STATE_TABLE[codes].reshape(len(sequences), -1)
+    if not states.all():
+        bad_chars = sorted({chr(c) for c in codes[_STATE_TABLE[codes] == 0]})
+        raise ValueError(f"Unknown characters in the alignment: {bad_chars}")
+    return states
+
+
+def encode_alignment(fasta_map):
+    """Returns the Alignment of the dictionary fasta_map from taxon names to aligned
+    sequences.
+    """
+    names = list(fasta_map)
+    states = encode_states(fasta_map)
+    patterns, weights = np.unique(states.T, axis=0, return_counts=True)
+    costly = np.bitwise_and.reduce(patterns, axis=1) == 0
+    return Alignment(
+        taxa={name: row for row, name in enumerate(names)},
+        states=np.ascontiguousarray(patterns[costly].T),
+        weights=weights[costly].astype(np.int64),
+        digest=alignment_digest(fasta_map),
+    )
+
+
+def fitch_step(child_states, weights):
+    """Returns the pair (S, c) of the Fitch state sets S of a node with children of
+    the given state sets, and the weighted number of changes c charged at the node.
+    """
+    if len(child_states) == 1:
+        return child_states[0], 0
+    if len(child_states) == 2:
+        left, right = child_states
+        common = left & right
+        disjoint = common == 0
+        return np.where(disjoint, left | right, common), int(weights @ disjoint)
+    counts = np.array(
+        [
+            sum((states >> bit) & 1 for states in child_states)
+            for bit in range(STATE_BIT_COUNT)
+        ]
+    )
+    max_counts = counts.max(axis=0)
+    states = np.zeros_like(child_states[0])
+    for bit in range(STATE_BIT_COUNT):
+        states |= (counts[bit] == max_counts).astype(np.uint8) << bit
+    return states, int(weights @ (len(child_states) - max_counts))
+
+
+def leaf_states(name, alignment):
+    """Returns the state sets of the taxon name in alignment."""
+    if name not in alignment.taxa:
+        raise ValueError(f"Taxon {name} is not in the alignment")
+    return alignment.states[alignment.taxa[name]]
+
+
+def fitch_score(tree, alignment):
+    """Returns the parsimony score of the tree, a nested tuple (see wmb.newick) or a
+    Newick string, on alignment.
+    """
+    if isinstance(tree, str):
+        tree = parse_newick(tree)
+    score = 0
+
+    def subtree_states(node):
+        nonlocal score
+        if isinstance(node, str):
+            return leaf_states(node, alignment)
+        states, cost = fitch_step(
+            [subtree_states(child) for child in node], alignment.weights
+        )
+        score += cost
+        return states
+
+    subtree_states(tree)
+    return score
+
+
+def fitch_node_states(tree, alignment):
+    """Returns the pair (F, s) of the parsimony score s of the nested tuple tree on
+    alignment, and the dictionary F mapping the id of every node of tree to the pair of
+    its Fitch state sets and the weighted number of changes charged at it.
+    """
+    node_states = {}
+
+    def subtree_states(node):
+        if isinstance(node, str):
+            states, cost = leaf_states(node, alignment), 0
+        else:
+            states, cost = fitch_step(
+                [subtree_states(child) for child in node], alignment.weights
+            )
+        node_states[id(node)] = (states, cost)
+        return states
+
+    subtree_states(tree)
+    return node_states, sum(cost for _, cost in node_states.values())
+
+
+def _replace_child(node, position, child):
+    return node[:position] + (child,) + node[position + 1 :]
+
+
+def nni_swaps(tree):
+    """Yields the NNIs of the binary nested tuple tree as triples (P, i, S). Here P is
+    the list of pairs (node, position) giving the path from the root to the lower node
+    v of the internal edge, i is the position of the child of v to swap, and S is the
+    pair (node, position) of the subtree that it is swapped with. The root may have
+    two or three children. This yields the 2(n-3) NNIs of the unrooted tree, once each.
+    """
+
+    def node_swaps(node, path):
+        for position, child in enumerate(node):
+            if isinstance(child, str):
+                continue
+            if len(child) != 2:
+                raise ValueError("NNI requires a binary tree")
+            child_path = path + [(node, position)]
+            siblings = [(node, k) for k in range(len(node)) if k != position]
+            if not path and len(node) == 2:
+                # Both children of a binary root lie on the same unrooted edge, which
+                # is handled once, by swapping with the children of the other one.
+                _, other_position = siblings[0]
+                other_child = node[other_position]
+                if position == 0 and not isinstance(other_child, str):
+                    for k in range(len(other_child)):
+                        yield child_path, 0, (other_child, k)
+            elif len(siblings) == 1:
+                yield child_path, 0, siblings[0]
+                yield child_path, 1, siblings[0]
+            elif not path and len(siblings) == 2:
+                yield child_path, 0, siblings[0]
+                yield child_path, 0, siblings[1]
+            else:
+                raise ValueError("NNI requires a binary tree")
+            yield from node_swaps(child, child_path)
+
+    yield from node_swaps(tree, [])
+
+
+def nni_neighbors(tree):
+    """Yields the nested tuple of each NNI neighbor of tree, a binary nested tuple or
+    Newick string, in the order of nni_swaps.
+    """
+    if isinstance(tree, str):
+        tree = parse_newick(tree)
+    for path, position, (other_node, other_position) in nni_swaps(tree):
+        parent, lower_position = path[-1]
+        lower = parent[lower_position]
+        swapped = lower[position]
+        new_lower = _replace_child(lower, position, other_node[other_position])
+        if other_node is parent:
+            new_node = _replace_child(
+                _replace_child(parent, lower_position, new_lower),
+                other_position,
+                swapped,
+            )
+        else:
+            # The other node is the other child of a binary root.
+            new_other = _replace_child(other_node, other_position, swapped)
+            new_node = _replace_child(parent, lower_position, new_lower)
+            new_node = _replace_child(new_node, 1 - lower_position, new_other)
+        for node, child_position in reversed(path[:-1]):
+            new_node = _replace_child(node, child_position, new_node)
+        yield new_node
+
+
+def nni_neighbor_scores(tree, alignment):
+    """Yields a pair (newick, score) for each NNI neighbor of tree, a binary nested
+    tuple or Newick string (see nni_swaps), giving its Newick string and its parsimony
+    score on alignment. The Fitch state sets of tree are computed once, and each
+    neighbor only recomputes the nodes from the swapped edge up to the root.
+    """
+    if isinstance(tree, str):
+        tree = parse_newick(tree)
+    node_states, score = fitch_node_states(tree, alignment)
+
+    def step(node, changed_states):
+        """Returns the new state sets and cost of node, where changed_states maps the
+        positions of the changed children to their new state sets.
+        """
+        child_states = [
+            changed_states[k] if k in changed_states else node_states[id(child)][0]
+            for k, child in enumerate(node)
+        ]
+        return fitch_step(child_states, alignment.weights)
+
+    for path, position, (other_node, other_position) in nni_swaps(tree):
+        parent, lower_position = path[-1]
+        lower = parent[lower_position]
+        swapped = lower[position]
+        other = other_node[other_position]
+        new_lower = _replace_child(lower, position, other)
+        lower_states, lower_cost = step(lower, {position: node_states[id(other)][0]})
+        new_score = score - node_states[id(lower)][1] + lower_cost
+        if other_node is parent:
+            new_node = _replace_child(
+                _replace_child(parent, lower_position, new_lower),
+                other_position,
+                swapped,
+            )
+            changed = {
+                lower_position: lower_states,
+                other_position: node_states[id(swapped)][0],
+            }
+        else:
+            # The other node is the other child of a binary root.
+            new_other = _replace_child(other_node, other_position, swapped)
+            other_states, other_cost = step(
+                other_node, {other_position: node_states[id(swapped)][0]}
+            )
+            new_score += other_cost - node_states[id(other_node)][1]
+            new_node = _replace_child(parent, lower_position, new_lower)
+            new_node = _replace_child(new_node, 1 - lower_position, new_other)
+            changed = {lower_position: lower_states, 1 - lower_position: other_states}
+        states, cost = step(parent, changed)
+        new_score += cost - node_states[id(parent)][1]
+        for node, child_position in reversed(path[:-1]):
+            new_node = _replace_child(node, child_position, new_node)
+            states, cost = step(node, {child_position: states})
+            new_score += cost - node_states[id(node)][1]
+        yield to_newick(new_node), new_score
+
+
+def _init_worker(alignment):
+    global _alignment
+    _alignment = alignment
+
+
+def _fitch_score_worker(newick):
+    return fitch_score(newick, _alignment)
+
+
+def parsimony_scores(newicks, alignment, processes=16, cache=None):
+    """Returns the int64 array of the parsimony scores of the Newick strings newicks on
+    alignment. The alignment is sent once to each of the worker processes. When a
+    ScoreCache is given, only the topologies missing from it are scored, and their
+    scores are added to it.
+    """
+    if cache is None:
+        return _compute_parsimony_scores(newicks, alignment, processes)
+    keys = [topology_key(newick) for newick in newicks]
+    records = lookup_scores(cache, alignment.digest, PARSIMONY_CACHE_MODEL, keys)
+    missing = {key: newick for key, newick in zip(keys, newicks) if key not in records}
+    missing_scores = _compute_parsimony_scores(
+        list(missing.values()), alignment, processes
+    )
+    new_records = {
+        key: ScoreRecord(None, None, int(score))
+        for key, score in zip(missing, missing_scores)
+    }
+    store_scores(cache, alignment.digest, PARSIMONY_CACHE_MODEL, new_records)
+    records.update(new_records)
+    return np.array([records[key].parsimony_score for key in keys], dtype=np.int64)
+
+
+def _compute_parsimony_scores(newicks, alignment, processes):
+    if processes <= 1 or len(newicks) == 0:
+        scores = [fitch_score(newick, alignment) for newick in newicks]
+    else:
+        with multiprocessing.Pool(
+            processes=processes, initializer=_init_worker, initargs=(alignment,)
+        ) as pool:
+            scores = pool.map(_fitch_score_worker, newicks, chunksize=64)
+    return np.array(scores, dtype=np.int64)
+
+
+def parsimony_scores_of_files(nwk_path, fasta_path, processes=16, cache=None):
+    """Returns the parsimony scores of the Newick strings in the file nwk_path, one per
+    line, on the alignment in the FASTA file fasta_path (see parsimony_scores).
+    """
+    alignment = encode_alignment(load_fasta(fasta_path))
+    return parsimony_scores(read_newick_file(nwk_path), alignment, processes, cache)
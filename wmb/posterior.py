@@ -0,0 +1,546 @@
+"""Posterior distributions of topologies from the tree samples of MrBayes runs.
+
+The trees sampled in MrBayes .t files are rerooted and ordered (see
+wmb.newick.reroot_newick) and counted in a dictionary, so memory grows with the number
+of distinct topologies rather than with the number of samples. The posterior is
+written in the same format as the pipeline
+
+    awk '$1~/tree/ {print $NF}' run.t | nw_topology - | nw_reroot - <taxon> \\
+        | nw_order - | tail -n +<burnin_samples> | sort | uniq -c | sort -nr
+
+followed by an awk script and `column -t`: a line per topology giving its posterior
+probability, the cumulative posterior probability, its sample count and its Newick
+string, from the most to the least sampled. Ties in the count are in reverse order of
+the Newick strings. The probabilities are formatted with %.6g, as awk prints them.
+
+The .trprobs files of MrBayes list each sampled topology once with its posterior
+probability, as the weight [&W <weight>] of the tree. Those of several runs are
+combined by averaging the weights of each unrooted topology.
+
+A posterior, pickled as the pair of the dictionary from topologies to their posterior
+probabilities and the list of topologies in the credible set, can be converted to a
+posterior store: a directory of flat arrays that is memory mapped rather than loaded,
+so that worker processes share its pages. See write_posterior_store. Where no store
+can be written next to a pickle, the pickle is read into an in-memory store instead.
+"""
+
+import hashlib
+import json
+import multiprocessing
+import os
+import pickle
+import re
+import shutil
+import tempfile
+from collections import Counter, deque, namedtuple
+
+import numpy as np
+
+from wmb.newick import canonical_topology, reroot_newick, to_newick
+
+CREDIBLE_LEVEL = 0.95
+
+STORE_FORMAT_VERSION = 1
+TOPOLOGY_HASH_DTYPE = np.dtype("S16")
+
+# The arrays of a posterior store, with a row per topology sorted by hash: hashes are
+# the 128-bit topology hashes, pp the posterior probabilities, credible the bits of
+# the credible set membership (packed little-endian), ranks the positions of the
+# topologies in the posterior dictionary they came from, and credible_rows the rows of
+# the credible set in the order of its list. The Newick string of row j is
+# newicks[newick_offsets[j]:newick_offsets[j + 1]], when the store has them.
+PosteriorStore = namedtuple(
+    "PosteriorStore",
+    [
+        "meta",
+        "hashes",
+        "pp",
+        "credible",
+        "ranks",
+        "credible_rows",
+        "newick_offsets",
+        "newicks",
+    ],
+)
+STORE_ARRAY_DTYPES = {
+    "hashes": TOPOLOGY_HASH_DTYPE,
+    "pp": np.dtype("<f8"),
+    "credible": np.dtype(np.uint8),
+    "ranks": np.dtype("<i8"),
+    "credible_rows": np.dtype("<i8"),
+    "newick_offsets": np.dtype("<i8"),
+    "newicks": np.dtype(np.uint8),
+}
+
+# The number of sampled trees counted per task of a worker process.
+DEFAULT_CHUNK_SIZE = 10_000
+
+_COMMENT_RE = re.compile(r"\[[^\]]*\]")
+_WEIGHT_RE = re.compile(r"\[&W\s+([^\]\s]+)\s*\]")
+
+# Worker state, set once per process by _init_worker rather than pickled per task.
+_taxon = None
+
+
+def iter_sampled_newicks(t_path, burnin_samples=0):
+    """Yields the Newick strings of the trees sampled in the MrBayes .t file t_path,
+    from the lines whose first field contains "tree", as `awk '$1~/tree/'` selects them.
+    As with `tail -n +<burnin_samples>`, the first burnin_samples - 1 trees are skipped.
+    """
+    skipped_count = max(burnin_samples - 1, 0)
+    with open(t_path) as the_file:
+        for line in the_file:
+            fields = line.split()
+            if not fields or "tree" not in fields[0]:
+                continue
+            if skipped_count > 0:
+                skipped_count -= 1
+                continue
+            yield fields[-1]
+
+
+def _chunks(items, chunk_size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _count_topologies(newicks, taxon):
+    return Counter(reroot_newick(newick, taxon) for newick in newicks)
+
+
+def _init_worker(taxon):
+    global _taxon
+    _taxon = taxon
+
+
+def _count_topologies_worker(newicks):
+    return _count_topologies(newicks, _taxon)
+
+
+def count_topologies(
+    t_paths, taxon, burnin_samples=0, processes=16, chunk_size=DEFAULT_CHUNK_SIZE
+):
+    """Returns the Counter of the topologies sampled in the MrBayes .t files t_paths,
+    rerooted on taxon, skipping the burn-in of each file (see iter_sampled_newicks).
+    Chunks of chunk_size trees are counted by the given number of worker processes,
+    with a bounded number of chunks in flight, and their counts are merged.
+    """
+    chunks = _chunks(
+        (
+            newick
+            for t_path in t_paths
+            for newick in iter_sampled_newicks(t_path, burnin_samples)
+        ),
+        chunk_size,
+    )
+    counts = Counter()
+    if processes <= 1:
+        for chunk in chunks:
+            counts.update(_count_topologies(chunk, taxon))
+        return counts
+    with multiprocessing.Pool(
+        processes=processes, initializer=_init_worker, initargs=(taxon,)
+    ) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(_count_topologies_worker, (chunk,)))
+            if len(pending) >= 2 * processes:
+                counts.update(pending.popleft().get())
+        while pending:
+            counts.update(pending.popleft().get())
+    return counts
+
+
+def posterior_rows(counts):
+    """Returns the list of rows (pp, cdf, count, topology) of the posterior of the
+    Counter counts of topologies, ordered as `sort | uniq -c | sort -nr` orders them,
+    with the probabilities formatted as strings with %.6g.
+    """
+    total = sum(counts.values())
+    rows = []
+    cumulative_count = 0
+    for count, topology in sorted(
+        ((count, topology) for topology, count in counts.items()), reverse=True
+    ):
+        cumulative_count += count
+        rows.append(
+            (
+                f"{count / total:.6g}",
+                f"{cumulative_count / total:.6g}",
+                str(count),
+                topology,
+            )
+        )
+    return rows
+
+
+def write_posterior(rows, posterior_path):
+    """Writes the posterior_rows rows to posterior_path in columns, as `column -t`
+    aligns them.
+    """
+    widths = [max((len(row[k]) for row in rows), default=0) for k in range(3)]
+    with open(posterior_path, "w") as the_file:
+        for row in rows:
+            padded = [field.ljust(width) for field, width in zip(row, widths)]
+            the_file.write("  ".join(padded + [row[3]]) + "\n")
+
+
+def write_posterior_pickle(rows, pickle_path, ci=CREDIBLE_LEVEL):
+    """Pickles the pair of the dictionary from the topologies of the posterior_rows
+    rows to their posterior probabilities and the list of the topologies whose
+    cumulative posterior probability is below ci, as wtch-pickle-cdf.py does.
+    """
+    pp_dict = {topology: float(pp) for pp, _, _, topology in rows}
+    tree_ci_list = [topology for _, cdf, _, topology in rows if float(cdf) < ci]
+    with open(pickle_path, "wb") as the_file:
+        pickle.dump((pp_dict, tree_ci_list), the_file)
+
+
+def iter_trprobs_trees(trprobs_path):
+    """Yields the pairs (N, w) of the Newick string N and the weight w of each tree of
+    the MrBayes .trprobs file trprobs_path, from lines such as
+    "tree tree_1 [p = 0.1, P = 0.1] = [&W 0.1] (1,(2,3),4);". As in the .t files, the
+    taxa keep their numbers from the translate block. A tree without a weight has
+    weight 1, as for Bio.Phylo.
+    """
+    with open(trprobs_path) as the_file:
+        for line in the_file:
+            fields = line.split(None, 1)
+            if len(fields) < 2 or fields[0].lower() != "tree":
+                continue
+            match = _WEIGHT_RE.search(line)
+            weight = float(match.group(1)) if match else 1.0
+            newick = _COMMENT_RE.sub("", fields[1]).split("=", 1)[1].strip()
+            yield newick, weight
+
+
+def trprobs_topology_weights(trprobs_path):
+    """Returns a dictionary mapping the canonical unrooted topology of each tree of
+    the .trprobs file trprobs_path (see wmb.newick.canonical_topology) to the list
+    [N, w] of the first Newick string N with that topology and the total weight w of
+    the trees with it, in order of first appearance.
+    """
+    weights = {}
+    for newick, weight in iter_trprobs_trees(trprobs_path):
+        key = to_newick(canonical_topology(newick))
+        if key in weights:
+            weights[key][1] += weight
+        else:
+            weights[key] = [newick, weight]
+    return weights
+
+
+def combine_trprobs_files(trprobs_paths, processes=16):
+    """Returns the pair (N, W) of the list N of Newick strings, one per unrooted
+    topology found in the .trprobs files trprobs_paths, in order of first appearance,
+    and the list W of their weights averaged over the files. The files are parsed by
+    the given number of worker processes.
+    """
+    if processes <= 1 or len(trprobs_paths) <= 1:
+        file_weights = map(trprobs_topology_weights, trprobs_paths)
+    else:
+        with multiprocessing.Pool(min(processes, len(trprobs_paths))) as pool:
+            file_weights = pool.map(trprobs_topology_weights, trprobs_paths)
+    total_weights = {}
+    for weights in file_weights:
+        for key, (newick, weight) in weights.items():
+            if key in total_weights:
+                total_weights[key][1] += weight
+            else:
+                total_weights[key] = [newick, weight]
+    newicks = [newick for newick, _ in total_weights.values()]
+    return newicks, [
+        weight / len(trprobs_paths) for _, weight in total_weights.values()
+    ]
+
+
+def topology_hashes(topologies):
+    """Returns the array of the 128-bit hashes of the Newick strings topologies."""
+    return np.array(
+        [
+            hashlib.blake2b(topology.encode(), digest_size=16).digest()
+            for topology in topologies
+        ],
+        dtype=TOPOLOGY_HASH_DTYPE,
+    )
+
+
+def posterior_store_path_of(pickle_path):
+    """Returns the path of the posterior store converted from a posterior pickle."""
+    return pickle_path + ".store"
+
+
+def posterior_store_arrays(pp_dict, credible_list, with_newicks=True):
+    """Returns the pair (A, M) of the dictionary A of the arrays of the posterior store
+    of the posterior given by the dictionary pp_dict from topologies to posterior
+    probabilities and the list credible_list of topologies in the credible set, and the
+    dictionary M of its metadata. The rows are sorted by topology hash, and the Newick
+    strings are kept when with_newicks, so that the posterior can be read back in order.
+    """
+    topologies = list(pp_dict)
+    hashes = topology_hashes(topologies)
+    order = np.argsort(hashes, kind="stable")
+    sorted_hashes = hashes[order]
+    if len(sorted_hashes) > 1 and (sorted_hashes[1:] == sorted_hashes[:-1]).any():
+        raise ValueError("Two topologies of the posterior have the same hash")
+    credible_set = set(credible_list)
+    missing_count = len(credible_set.difference(pp_dict))
+    if missing_count:
+        raise ValueError(f"{missing_count} credible topologies have no posterior")
+    pp = np.fromiter(pp_dict.values(), dtype=float, count=len(topologies))
+    credible = np.fromiter(
+        (topology in credible_set for topology in topologies),
+        dtype=np.bool_,
+        count=len(topologies),
+    )
+    rows = np.empty(len(topologies), dtype=np.int64)
+    rows[order] = np.arange(len(topologies))
+    positions = {topology: j for j, topology in enumerate(topologies)}
+    arrays = {
+        "hashes": sorted_hashes,
+        "pp": pp[order],
+        "credible": np.packbits(credible[order], bitorder="little"),
+        "ranks": order,
+        "credible_rows": rows[
+            [positions[topology] for topology in dict.fromkeys(credible_list)]
+        ],
+    }
+    if with_newicks:
+        encoded = [topologies[j].encode() for j in order]
+        arrays["newick_offsets"] = np.cumsum([0] + [len(e) for e in encoded])
+        arrays["newicks"] = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    arrays = {
+        name: np.ascontiguousarray(array, dtype=STORE_ARRAY_DTYPES[name])
+        for name, array in arrays.items()
+    }
+    meta = {
+        "format_version": STORE_FORMAT_VERSION,
+        "topology_count": len(topologies),
+        "credible_count": int(credible.sum()),
+        "credible_pp": float(pp[credible].sum()),
+        "with_newicks": with_newicks,
+        "newick_bytes": len(arrays["newicks"]) if with_newicks else 0,
+    }
+    return arrays, meta
+
+
+def _umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+def write_posterior_store(pp_dict, credible_list, store_path, with_newicks=True):
+    """Writes the posterior given by the dictionary pp_dict from topologies to posterior
+    probabilities and the list credible_list of topologies in the credible set to the
+    directory store_path (see posterior_store_arrays).
+
+    The store consists of flat little-endian arrays named by PosteriorStore, in .bin
+    files, and meta.json. It is written to a temporary directory of its own next to
+    store_path and then renamed, so that a store is never seen half written and jobs
+    converting the same posterior at once do not write over each other. When another
+    job puts its store in place first, that store is kept.
+    """
+    arrays, meta = posterior_store_arrays(pp_dict, credible_list, with_newicks)
+    parent_path, store_name = os.path.split(os.path.abspath(store_path))
+    temp_path = tempfile.mkdtemp(prefix=store_name + ".tmp.", dir=parent_path)
+    try:
+        os.chmod(temp_path, 0o777 & ~_umask())
+        for name, array in arrays.items():
+            array.tofile(os.path.join(temp_path, name + ".bin"))
+        with open(os.path.join(temp_path, "meta.json"), "w") as meta_file:
+            json.dump(meta, meta_file, indent=4)
+            meta_file.write("\n")
+        old_path = None
+        if os.path.isdir(store_path):
+            old_path = temp_path + ".old"
+            try:
+                os.rename(store_path, old_path)
+            except FileNotFoundError:
+                old_path = None
+        try:
+            os.replace(temp_path, store_path)
+        except OSError:
+            # Another job put a store in place since the old one was moved.
+            if not os.path.isdir(store_path):
+                raise
+        if old_path is not None:
+            shutil.rmtree(old_path, ignore_errors=True)
+    finally:
+        shutil.rmtree(temp_path, ignore_errors=True)
+    return store_path
+
+
+def convert_posterior_pickle(pickle_path, store_path=None, with_newicks=True):
+    """Converts the posterior pickle pickle_path to a posterior store, by default at
+    posterior_store_path_of(pickle_path), returning the path of the store.
+    """
+    if store_path is None:
+        store_path = posterior_store_path_of(pickle_path)
+    with open(pickle_path, "rb") as the_file:
+        pp_dict, credible_list = pickle.load(the_file)
+    return write_posterior_store(pp_dict, credible_list, store_path, with_newicks)
+
+
+def posterior_store_is_fresh(pickle_path, store_path=None):
+    """Returns whether the posterior store converted from pickle_path exists and is
+    newer than pickle_path.
+    """
+    if store_path is None:
+        store_path = posterior_store_path_of(pickle_path)
+    meta_path = os.path.join(store_path, "meta.json")
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path) as meta_file:
+        meta = json.load(meta_file)
+    return meta.get("format_version") == STORE_FORMAT_VERSION and os.path.getmtime(
+        meta_path
+    ) >= os.path.getmtime(pickle_path)
+
+
+def load_posterior_store(store_path):
+    """Returns the PosteriorStore in the directory store_path, whose arrays are
+    read-only memory maps.
+    """
+    with open(os.path.join(store_path, "meta.json")) as meta_file:
+        meta = json.load(meta_file)
+    topology_count = meta["topology_count"]
+    lengths = {
+        "hashes": topology_count,
+        "pp": topology_count,
+        "credible": -(-topology_count // 8),
+        "ranks": topology_count,
+        "credible_rows": meta["credible_count"],
+        "newick_offsets": topology_count + 1,
+        "newicks": meta["newick_bytes"],
+    }
+    arrays = {"newick_offsets": None, "newicks": None}
+    for name, dtype in STORE_ARRAY_DTYPES.items():
+        path = os.path.join(store_path, name + ".bin")
+        if not os.path.exists(path):
+            continue
+        if lengths[name] == 0:
+            arrays[name] = np.zeros(0, dtype=dtype)
+        else:
+            arrays[name] = np.memmap(path, dtype=dtype, mode="r", shape=lengths[name])
+    return PosteriorStore(meta=meta, **arrays)
+
+
+def posterior_store_of_pickle(pickle_path, with_newicks=True):
+    """Returns the PosteriorStore of the posterior pickle pickle_path, held in memory
+    rather than written to disk.
+    """
+    with open(pickle_path, "rb") as the_file:
+        pp_dict, credible_list = pickle.load(the_file)
+    arrays, meta = posterior_store_arrays(pp_dict, credible_list, with_newicks)
+    arrays.setdefault("newick_offsets", None)
+    arrays.setdefault("newicks", None)
+    return PosteriorStore(meta=meta, **arrays)
+
+
+def open_posterior(path):
+    """Returns the PosteriorStore at path, which is either a posterior store or a
+    posterior pickle. A pickle is converted to a store next to it, unless that store
+    is already fresh. When the directory of the pickle is not writable, the pickle is
+    read into a store in memory instead.
+    """
+    if os.path.isdir(path):
+        return load_posterior_store(path)
+    if posterior_store_is_fresh(path):
+        return load_posterior_store(posterior_store_path_of(path))
+    if not os.access(os.path.dirname(os.path.abspath(path)), os.W_OK | os.X_OK):
+        return posterior_store_of_pickle(path)
+    try:
+        convert_posterior_pickle(path)
+    except PermissionError:
+        return posterior_store_of_pickle(path)
+    return load_posterior_store(posterior_store_path_of(path))
+
+
+def read_posterior(path):
+    """Returns the pair (pp_dict, credible_list) of the posterior at path, which is
+    either a posterior pickle or a posterior store with Newick strings.
+    """
+    if os.path.isdir(path):
+        return posterior_of_store(load_posterior_store(path))
+    with open(path, "rb") as the_file:
+        return pickle.load(the_file)
+
+
+def _store_rows(store, keys):
+    """Returns the pair (R, F) of the rows of store for the topologies keys, which are
+    Newick strings or topology hashes, and whether each was found. The rows of the
+    keys that were not found are 0.
+    """
+    if not isinstance(keys, np.ndarray) or keys.dtype != TOPOLOGY_HASH_DTYPE:
+        keys = topology_hashes(keys)
+    if len(store.hashes) == 0:
+        return np.zeros(len(keys), dtype=np.int64), np.zeros(len(keys), dtype=np.bool_)
+    rows = np.searchsorted(store.hashes, keys)
+    rows[rows == len(store.hashes)] = 0
+    return rows, store.hashes[rows] == keys
+
+
+def lookup_pp(store, keys):
+    """Returns the float64 array of the posterior probabilities in store of the
+    topologies keys (see _store_rows), with 0 for topologies outside the posterior.
+    """
+    rows, found = _store_rows(store, keys)
+    if len(store.hashes) == 0:
+        return np.zeros(len(rows))
+    return np.where(found, store.pp[rows], 0.0)
+
+
+def in_credible(store, keys):
+    """Returns the boolean array of whether the topologies keys (see _store_rows) are
+    in the credible set of store.
+    """
+    rows, found = _store_rows(store, keys)
+    if len(store.hashes) == 0:
+        return found
+    bits = (store.credible[rows >> 3] >> (rows & 7).astype(np.uint8)) & 1
+    return found & bits.astype(np.bool_)
+
+
+def credible_count(store):
+    """Returns the number of topologies in the credible set of store."""
+    return store.meta["credible_count"]
+
+
+def credible_mask(store):
+    """Returns the boolean array of whether each row of store is in its credible set."""
+    bits = np.unpackbits(store.credible, count=len(store.hashes), bitorder="little")
+    return bits.astype(np.bool_)
+
+
+def iter_store_topologies(store):
+    """Yields the Newick strings of the rows of store in order, reading them from the
+    memory map as they are needed. This requires the Newick strings.
+    """
+    if store.newicks is None:
+        raise ValueError("The posterior store does not keep Newick strings")
+    offsets = store.newick_offsets
+    for row in range(len(store.hashes)):
+        yield bytes(store.newicks[offsets[row] : offsets[row + 1]]).decode()
+
+
+def store_topologies(store):
+    """Returns the list of the Newick strings of the rows of store. This requires the
+    Newick strings.
+    """
+    return list(iter_store_topologies(store))
+
+
+def posterior_of_store(store):
+    """Returns the pair (pp_dict, credible_list) of the posterior in store, in the
+    order of the pickle it came from. This requires the Newick strings.
+    """
+    topologies = store_topologies(store)
+    pp_dict = {topologies[row]: float(store.pp[row]) for row in np.argsort(store.ranks)}
+    return pp_dict, [topologies[row] for row in store.credible_rows]
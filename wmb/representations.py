@@ -0,0 +1,514 @@
+"""Subsplit DAG representations of trees as packed bitsets.
+
+A tree in a common subsplit DAG is represented by the set of sDAG node indices
+comprising it. We store a collection of such trees as an (n_trees x word_count) uint64
+matrix, where bit j of a row (bit j % 64 of word j // 64) is set exactly when the tree
+contains sDAG node j. Every row of a matrix has the same word count, so that rows can
+be compared and combined with NumPy operations.
+"""
+
+import gzip
+import hashlib
+import heapq
+import json
+import os
+import shutil
+from array import array
+import numpy as np
+
+# In bito, reps_and_likelihoods uses SIZE_MAX for unknown subsplits.
+INVALID_SDAG_INDEX = 2**64 - 1
+
+# The binary cache of a representation file is a sidecar directory of flat arrays,
+# described by a small JSON file. See write_sdag_rep_cache.
+CACHE_FORMAT_VERSION = 1
+CACHE_COMPRESSION_CHOICES = ["none", "gzip", "zstd"]
+CACHE_ARRAY_DTYPES = {
+    "offsets": np.int64,
+    "indices": np.uint32,
+    "likelihoods": np.float64,
+    "valid": np.bool_,
+}
+
+if hasattr(np, "bitwise_count"):
+
+    def popcount(words):
+        """Returns the number of set bits of each entry of a uint64 array."""
+        return np.bitwise_count(words)
+
+else:
+    _BYTE_POPCOUNTS = np.array([bin(j).count("1") for j in range(256)], dtype=np.uint8)
+
+    def popcount(words):
+        """Returns the number of set bits of each entry of a uint64 array."""
+        words = np.ascontiguousarray(words, dtype=np.uint64)
+        byte_counts = _BYTE_POPCOUNTS[words.view(np.uint8)]
+        return byte_counts.reshape(words.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+
+def word_count_of(node_count):
+    """Returns the number of uint64 words needed to hold node_count bits."""
+    return max(1, -(-node_count // 64))
+
+
+def encode_sdag_nodes_as_bits(sdag_node_list, word_count=None):
+    """Given a list of integers, which represent specific nodes of some subsplit dag,
+    construct the uint64 bitset row that represents this list. Bit j of the row is set
+    exactly when j is in sdag_node_list.
+
+    E.g.: [5,2,0,1] -> array([39], dtype=uint64)
+    """
+    nodes = np.asarray(sdag_node_list, dtype=np.int64)
+    if word_count is None:
+        word_count = word_count_of(int(nodes.max()) + 1 if len(nodes) else 0)
+    bits = np.zeros(word_count, dtype=np.uint64)
+    np.bitwise_or.at(
+        bits, nodes >> 6, np.left_shift(np.uint64(1), (nodes & 63).astype(np.uint64))
+    )
+    return bits
+
+
+def decode_bits_as_sdag_nodes(bits_row):
+    """This is the inverse function of encode_sdag_nodes_as_bits, up to list ordering.
+    The nodes are returned in increasing order.
+    """
+    bytes_row = np.ascontiguousarray(bits_row, dtype="<u8").view(np.uint8)
+    return np.flatnonzero(np.unpackbits(bytes_row, bitorder="little")).tolist()
+
+
+def pack_sdag_reps(offsets, indices, word_count=None):
+    """Returns the bitset matrix of a collection of trees given in compressed sparse row
+    form: the sDAG node indices of tree j are indices[offsets[j]:offsets[j + 1]].
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    indices = np.asarray(indices, dtype=np.int64)
+    if word_count is None:
+        word_count = word_count_of(int(indices.max()) + 1 if len(indices) else 0)
+    tree_count = len(offsets) - 1
+    tree_bits = np.zeros((tree_count, word_count), dtype=np.uint64)
+    rows = np.repeat(np.arange(tree_count), np.diff(offsets))
+    np.bitwise_or.at(
+        tree_bits.reshape(-1),
+        rows * word_count + (indices >> 6),
+        np.left_shift(np.uint64(1), (indices & 63).astype(np.uint64)),
+    )
+    return tree_bits
+
+
+def pad_words(tree_bits, word_count):
+    """Returns tree_bits widened with zero words to word_count words per row."""
+    if tree_bits.shape[-1] >= word_count:
+        return tree_bits
+    padding = [(0, 0)] * (tree_bits.ndim - 1) + [(0, word_count - tree_bits.shape[-1])]
+    return np.pad(tree_bits, padding)
+
+
+def hamming_distances(tree_bits, bits_row):
+    """Returns the number of sDAG nodes by which bits_row differs from each row of
+    tree_bits.
+    """
+    return popcount(tree_bits ^ bits_row).sum(axis=-1, dtype=np.int64)
+
+
+def rows_in(tree_bits, other_bits):
+    """Returns a boolean array marking the rows of tree_bits that are equal to some row
+    of other_bits. The two matrices may have different word counts.
+    """
+    word_count = tree_bits.shape[1]
+    other_bits = pad_words(other_bits, word_count)
+    # Rows with a node beyond the width of tree_bits cannot match any of its rows.
+    in_range = ~other_bits[:, word_count:].any(axis=1)
+    other_rows = {
+        bits_row.tobytes()
+        for bits_row in np.ascontiguousarray(other_bits[in_range, :word_count])
+    }
+    return np.array(
+        [bits_row.tobytes() in other_rows for bits_row in tree_bits], dtype=np.bool_
+    )
+
+
+def cache_path_of(file_path):
+    """Returns the path of the binary cache directory for a representation file."""
+    return file_path + ".cache"
+
+
+def _open_cache_file(path, mode, compression):
+    if compression == "none":
+        return open(path, mode)
+    if compression == "gzip":
+        return gzip.open(path + ".gz", mode)
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError as error:
+            message = "zstd compression requires the zstandard package"
+            raise ImportError(message) from error
+        if mode == "wb":
+            return zstandard.ZstdCompressor().stream_writer(open(path + ".zst", mode))
+        return zstandard.ZstdDecompressor().stream_reader(open(path + ".zst", mode))
+    raise ValueError(f"Unknown cache compression: {compression}")
+
+
+def _parse_sdag_rep_lines(lines):
+    """Returns the arrays (N,I,L,V) for a batch of representation file lines, where N is
+    the number of node indices stored for each line, I the node indices, L the
+    log-likelihoods (NaN when absent) and V whether each tree is valid. The node indices
+    of invalid trees are not stored.
+    """
+    likelihoods = np.full(len(lines), np.nan)
+    heads = []
+    for j, line in enumerate(lines):
+        head, _, tail = line.strip().rpartition(",")
+        heads.append(head)
+        if tail:
+            likelihoods[j] = float(tail)
+    lengths = np.array(
+        [head.count(",") + 1 if head else 0 for head in heads], dtype=np.int64
+    )
+    # Parsing the node indices of the whole batch at once is much faster than int().
+    all_indices = np.fromstring(
+        ",".join(head for head in heads if head), dtype=np.uint64, sep=","
+    )
+    rows = np.repeat(np.arange(len(lines)), lengths)
+    valid = np.ones(len(lines), dtype=np.bool_)
+    valid[rows[all_indices == INVALID_SDAG_INDEX]] = False
+    lengths[~valid] = 0
+    return lengths, all_indices[valid[rows]].astype(np.uint32), likelihoods, valid
+
+
+def iter_sdag_rep_batches(file_path, lines_per_batch=2**16):
+    """Yields the arrays (N,I,L,V) of _parse_sdag_rep_lines for the successive batches
+    of lines_per_batch lines of the representation file file_path.
+    """
+    with open(file_path, "rt") as the_file:
+        while True:
+            lines = [line for _, line in zip(range(lines_per_batch), the_file)]
+            if not lines:
+                break
+            yield _parse_sdag_rep_lines(lines)
+
+
+def sdag_rep_hashes(lengths, indices):
+    """Returns the array of the 128-bit hashes of the sets of sDAG nodes of a batch of
+    trees, where the nodes of tree j are the next lengths[j] entries of indices, as
+    returned by _parse_sdag_rep_lines. Trees with the same nodes have the same hash,
+    whatever the order of their nodes.
+    """
+    indices = np.asarray(indices, dtype="<u4")
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    # The nodes of representation files are usually sorted already.
+    descents = np.flatnonzero(indices[1:] <= indices[:-1]) + 1
+    if not np.isin(descents, offsets).all():
+        rows = np.repeat(np.arange(len(lengths)), lengths)
+        indices = indices[np.lexsort((indices, rows))]
+    return np.array(
+        [
+            hashlib.blake2b(
+                indices[offsets[j] : offsets[j + 1]].tobytes(), digest_size=16
+            ).digest()
+            for j in range(len(lengths))
+        ],
+        dtype="S16",
+    )
+
+
+def write_sdag_rep_cache(
+    file_path, cache_path=None, compression="none", lines_per_batch=2**16
+):
+    """Converts the representation file file_path (in the format described in
+    read_sdag_rep_trees) to a binary cache directory, by default
+    cache_path_of(file_path). This reads file_path once, in batches of lines.
+
+    The cache consists of flat little-endian arrays that load_sdag_rep_cache can memory
+    map: offsets.bin (int64, one more than the number of lines), indices.bin (uint32
+    sDAG node indices, where the nodes of line j are indices[offsets[j]:offsets[j+1]]),
+    likelihoods.bin (float64, NaN when a line has no log-likelihood) and valid.bin
+    (bool, false for trees with an invalid sDAG node index, which store no nodes).
+    These are described by meta.json, which also records the size and modification
+    time of file_path. With compression "gzip" or "zstd" the arrays are compressed, so
+    they are decompressed into memory rather than memory mapped.
+    """
+    if cache_path is None:
+        cache_path = cache_path_of(file_path)
+    source_stat = os.stat(file_path)
+    temp_path = cache_path + ".tmp"
+    shutil.rmtree(temp_path, ignore_errors=True)
+    os.makedirs(temp_path)
+    out_files = {
+        name: _open_cache_file(
+            os.path.join(temp_path, name + ".bin"), "wb", compression
+        )
+        for name in CACHE_ARRAY_DTYPES
+    }
+    tree_count = 0
+    index_count = 0
+    node_count = 0
+    out_files["offsets"].write(np.zeros(1, dtype="<i8").tobytes())
+    for lengths, indices, likelihoods, valid in iter_sdag_rep_batches(
+        file_path, lines_per_batch
+    ):
+        offsets = index_count + np.cumsum(lengths)
+        out_files["offsets"].write(offsets.astype("<i8").tobytes())
+        out_files["indices"].write(indices.astype("<u4").tobytes())
+        out_files["likelihoods"].write(likelihoods.astype("<f8").tobytes())
+        out_files["valid"].write(valid.tobytes())
+        tree_count += len(lengths)
+        index_count += len(indices)
+        if len(indices):
+            node_count = max(node_count, int(indices.max()) + 1)
+    for out_file in out_files.values():
+        out_file.close()
+    meta = {
+        "format_version": CACHE_FORMAT_VERSION,
+        "tree_count": tree_count,
+        "index_count": index_count,
+        "node_count": node_count,
+        "compression": compression,
+        "source_size": source_stat.st_size,
+        "source_mtime_ns": source_stat.st_mtime_ns,
+    }
+    with open(os.path.join(temp_path, "meta.json"), "w") as meta_file:
+        json.dump(meta, meta_file, indent=4)
+        meta_file.write("\n")
+    shutil.rmtree(cache_path, ignore_errors=True)
+    os.replace(temp_path, cache_path)
+    return cache_path
+
+
+def sdag_rep_cache_is_fresh(file_path, cache_path=None):
+    """Returns whether the binary cache of file_path exists and was made from the
+    current version of file_path.
+    """
+    if cache_path is None:
+        cache_path = cache_path_of(file_path)
+    meta_path = os.path.join(cache_path, "meta.json")
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path) as meta_file:
+        meta = json.load(meta_file)
+    source_stat = os.stat(file_path)
+    return (
+        meta.get("format_version") == CACHE_FORMAT_VERSION
+        and meta["source_size"] == source_stat.st_size
+        and meta["source_mtime_ns"] == source_stat.st_mtime_ns
+        and os.path.getmtime(meta_path) >= source_stat.st_mtime
+    )
+
+
+def load_sdag_rep_cache(cache_path):
+    """Returns the meta dictionary and a dictionary of the arrays of a binary cache
+    written by write_sdag_rep_cache. Uncompressed arrays are read-only memory maps.
+    """
+    with open(os.path.join(cache_path, "meta.json")) as meta_file:
+        meta = json.load(meta_file)
+    lengths = {
+        "offsets": meta["tree_count"] + 1,
+        "indices": meta["index_count"],
+        "likelihoods": meta["tree_count"],
+        "valid": meta["tree_count"],
+    }
+    arrays = {}
+    for name, dtype in CACHE_ARRAY_DTYPES.items():
+        path = os.path.join(cache_path, name + ".bin")
+        dtype = np.dtype(dtype).newbyteorder("<")
+        if meta["compression"] != "none":
+            with _open_cache_file(path, "rb", meta["compression"]) as in_file:
+                arrays[name] = np.frombuffer(in_file.read(), dtype=dtype)
+        elif lengths[name] == 0:
+            arrays[name] = np.zeros(0, dtype=dtype)
+        else:
+            arrays[name] = np.memmap(path, dtype=dtype, mode="r", shape=lengths[name])
+    return meta, arrays
+
+
+def valid_tree_csr(arrays):
+    """Returns the pair (O,I) of offsets and node indices of the valid trees of a
+    binary cache, in the compressed sparse row form taken by pack_sdag_reps.
+    """
+    lengths = np.diff(arrays["offsets"])[arrays["valid"]]
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    # Invalid trees store no node indices, so the indices need no filtering.
+    return offsets, arrays["indices"]
+
+
+def read_sdag_rep_trees(
+    file_path, with_likelihoods=False, word_count=None, use_cache=True
+):
+    """
+    Loads the tree data from file_path. The expected file format of file_path is one
+    tree per line, each line consists of i) a comma separated list of integers of the
+    subsplit dag node indices comprising the tree; ii) another comma; iii) nothing when
+    with_likelihoods=False and the log-likelihood of the tree when
+    with_likelilihooods=True; and iv) the newline character \\n (even the final line
+    should have the newline character).
+
+    Since the subsplit DAG is not seen by any of this code, it is assumed that the trees
+    are all from a common sDAG and the node indices are correct. Trees that are not in
+    this commond sDAG are identified by an invalid sDAG node index and are omitted from
+    the returned values.
+
+    :return: A pair (T,L), where T is the uint64 bitset matrix of the trees (a row per
+        tree, with at least word_count words per row when given), and L is a
+        numpy.array of each tree's log-likelihood, in the same order as the rows of T.
+        When with_likelihoods=False, L is a vector of zeros.
+    :rtype: tuple
+
+    When use_cache=True and the binary cache of file_path (see write_sdag_rep_cache) is
+    fresh, the trees are loaded from the cache rather than parsed from file_path.
+    """
+    if use_cache and sdag_rep_cache_is_fresh(file_path):
+        _, arrays = load_sdag_rep_cache(cache_path_of(file_path))
+        tree_bits = pack_sdag_reps(*valid_tree_csr(arrays))
+        tree_likelihood_array = np.zeros(len(tree_bits), dtype=float)
+        if with_likelihoods:
+            tree_likelihood_array[:] = arrays["likelihoods"][arrays["valid"]]
+    else:
+        offsets = [0]
+        indices = []
+        tree_likelihoods = []
+        with open(file_path, "rt") as the_file:
+            for line in the_file:
+                tree_info = line.strip().split(",")
+                sdag_rep = [int(c) for c in tree_info[:-1]]
+                if INVALID_SDAG_INDEX not in sdag_rep:
+                    indices.extend(sdag_rep)
+                    offsets.append(len(indices))
+                    if with_likelihoods:
+                        tree_likelihoods.append(float(tree_info[-1]))
+        tree_bits = pack_sdag_reps(offsets, indices)
+        tree_likelihood_array = np.zeros(len(tree_bits), dtype=float)
+        if with_likelihoods:
+            tree_likelihood_array[:] = tree_likelihoods
+    if word_count is not None:
+        tree_bits = pad_words(tree_bits, word_count)
+    return tree_bits, tree_likelihood_array
+
+
+def count_valid_sdag_reps(file_path):
+    """Returns the number of lines of the representation file file_path that do not
+    contain an invalid sDAG node index, without parsing the lines.
+    """
+    invalid_text = str(INVALID_SDAG_INDEX).encode()
+    with open(file_path, "rb") as the_file:
+        return sum(1 for line in the_file if invalid_text not in line)
+
+
+def valid_sdag_rep_count(file_path, use_cache=True):
+    """Returns the number of valid trees of the representation file file_path, from
+    its binary cache when that is fresh and otherwise by count_valid_sdag_reps.
+    """
+    if use_cache and sdag_rep_cache_is_fresh(file_path):
+        _, arrays = load_sdag_rep_cache(cache_path_of(file_path))
+        return int(np.count_nonzero(arrays["valid"]))
+    return count_valid_sdag_reps(file_path)
+
+
+def kept_tree_count(valid_count, max_tree_count=0, max_tree_ratio=0.0):
+    """Returns the number of best trees to keep out of valid_count trees, using only
+    the first max_tree_count (max_tree_ratio, respectively) of them when positive. When
+    both are given, the more restrictive condition is used.
+    """
+    tree_count = valid_count
+    if max_tree_ratio > 0:
+        tree_count = min(tree_count, int(np.floor(max_tree_ratio * tree_count)))
+    if max_tree_count > 0:
+        tree_count = min(tree_count, max_tree_count)
+    return tree_count
+
+
+def top_score_order(scores, tree_count):
+    """Returns the indices of the tree_count largest entries of scores, ordered by
+    descending score and then by increasing index. This only sorts the selected
+    entries.
+    """
+    tree_count = min(tree_count, len(scores))
+    if tree_count <= 0:
+        return np.zeros(0, dtype=np.int64)
+    if tree_count < len(scores):
+        threshold = np.partition(scores, len(scores) - tree_count)[
+            len(scores) - tree_count
+        ]
+        above = np.flatnonzero(scores > threshold)
+        ties = np.flatnonzero(scores == threshold)[: tree_count - len(above)]
+        selected = np.concatenate((above, ties))
+    else:
+        selected = np.arange(len(scores))
+    return selected[np.lexsort((selected, -scores[selected]))]
+
+
+def read_top_sdag_rep_trees(
+    file_path, max_tree_count=0, max_tree_ratio=0.0, line_scores=None, use_cache=True
+):
+    """
+    Loads the best scoring valid trees from the representation file file_path (see
+    read_sdag_rep_trees), keeping the number of trees given by kept_tree_count. The
+    score of the tree on line j is line_scores[j] when given, and otherwise the
+    log-likelihood at the end of the line.
+
+    Only the kept trees are materialized. From a fresh binary cache the kept trees are
+    selected from the memory-mapped score column. Otherwise the file is streamed
+    through a heap of the best trees seen so far, after a quick pass that counts the
+    valid trees when max_tree_ratio is used.
+
+    :return: A triple (T,S,J) of the bitset matrix of the kept trees, their scores and
+        the line numbers they came from, all sorted by descending score (and then by
+        line number).
+    :rtype: tuple
+    """
+    if use_cache and sdag_rep_cache_is_fresh(file_path):
+        _, arrays = load_sdag_rep_cache(cache_path_of(file_path))
+        valid_lines = np.flatnonzero(arrays["valid"])
+        if line_scores is None:
+            line_scores = arrays["likelihoods"]
+        elif len(line_scores) != len(arrays["valid"]):
+            raise ValueError(f"Expected a score for each line of {file_path}")
+        scores = np.asarray(line_scores, dtype=float)[valid_lines]
+        tree_count = kept_tree_count(len(valid_lines), max_tree_count, max_tree_ratio)
+        order = top_score_order(scores, tree_count)
+        lines = valid_lines[order]
+        starts = arrays["offsets"][lines]
+        lengths = arrays["offsets"][lines + 1] - starts
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        positions = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        tree_bits = pack_sdag_reps(offsets, arrays["indices"][positions])
+        return tree_bits, scores[order], lines
+
+    if line_scores is not None:
+        with open(file_path, "rb") as the_file:
+            line_count = sum(1 for _ in the_file)
+        if len(line_scores) != line_count:
+            raise ValueError(f"Expected a score for each line of {file_path}")
+    tree_count = None
+    if max_tree_ratio > 0:
+        tree_count = kept_tree_count(
+            count_valid_sdag_reps(file_path), max_tree_count, max_tree_ratio
+        )
+    elif max_tree_count > 0:
+        tree_count = max_tree_count
+    invalid_text = str(INVALID_SDAG_INDEX)
+    # A min-heap of (score, -line number, node indices), so that the heap root is the
+    # tree to drop first and ties in score keep the earlier line.
+    best_trees = []
+    with open(file_path, "rt") as the_file:
+        for j, line in enumerate(the_file):
+            if tree_count == 0 or invalid_text in line:
+                continue
+            tree_info = line.strip().split(",")
+            score = float(tree_info[-1]) if line_scores is None else line_scores[j]
+            if tree_count is not None and len(best_trees) == tree_count:
+                if (score, -j) < best_trees[0][:2]:
+                    continue
+                heapq.heappop(best_trees)
+            sdag_rep = array("I", (int(c) for c in tree_info[:-1]))
+            heapq.heappush(best_trees, (score, -j, sdag_rep))
+    best_trees.sort(reverse=True)
+    offsets = np.cumsum([0] + [len(sdag_rep) for _, _, sdag_rep in best_trees])
+    indices = np.fromiter(
+        (c for _, _, sdag_rep in best_trees for c in sdag_rep),
+        dtype=np.int64,
+        count=offsets[-1],
+    )
+    tree_bits = pack_sdag_reps(offsets, indices)
+    tree_scores = np.array([score for score, _, _ in best_trees], dtype=float)
+    lines = np.array([-j for _, j, _ in best_trees], dtype=np.int64)
+    return tree_bits, tree_scores, lines
@@ -0,0 +1,213 @@
+"""A persistent cache of the scores of tree topologies, stored in SQLite.
+
+An entry is keyed by the digest of an alignment, the name of a model (such as
+"iqtree-jc69" for the branch lengths and log-likelihood from iqtree, or "fitch" for
+parsimony scores) and the canonical unrooted topology of a tree (see
+wmb.newick.canonical_topology). It stores whichever of the optimized Newick string, the
+log-likelihood and the parsimony score that model gives.
+
+The cache holds at most max_entries entries, evicting the least recently used ones.
+Triggers keep the number of entries in the counters table, so that checking the size
+cap does not count the whole table.
+Lookups and stores are batched, and several processes can use the same cache. The
+database uses the rollback journal by default, which only needs working file locks and
+so also suits caches on network file systems such as NFS. Write-ahead logging lets
+readers and a writer run at once, but needs shared memory between the processes, so it
+is only safe when the cache is on local disk, where open_score_cache can be given
+journal_mode="WAL".
+"""
+
+import hashlib
+import os
+import sqlite3
+import time
+from collections import namedtuple
+
+from wmb.newick import canonical_topology, to_newick
+
+DEFAULT_MAX_ENTRIES = 10_000_000
+
+# The rollback journal, which works wherever file locking does, unlike "WAL".
+DEFAULT_JOURNAL_MODE = "DELETE"
+
+# Number of keys per SELECT, which stays under the SQLite limit on parameters.
+LOOKUP_BATCH_SIZE = 500
+
+ScoreCache = namedtuple("ScoreCache", ["connection", "max_entries"])
+ScoreRecord = namedtuple(
+    "ScoreRecord", ["optimized_newick", "log_likelihood", "parsimony_score"]
+)
+
+_SCHEMA = """
+BEGIN IMMEDIATE;
+CREATE TABLE IF NOT EXISTS scores (
+    alignment_digest TEXT NOT NULL,
+    model TEXT NOT NULL,
+    topology TEXT NOT NULL,
+    optimized_newick TEXT,
+    log_likelihood REAL,
+    parsimony_score INTEGER,
+    last_used INTEGER NOT NULL,
+    PRIMARY KEY (alignment_digest, model, topology)
+);
+CREATE INDEX IF NOT EXISTS scores_by_last_used ON scores (last_used);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT INTO counters (name, value)
+    SELECT 'entries', (SELECT COUNT(*) FROM scores)
+    WHERE NOT EXISTS (SELECT 1 FROM counters WHERE name = 'entries');
+CREATE TRIGGER IF NOT EXISTS scores_insert AFTER INSERT ON scores BEGIN
+    UPDATE counters SET value = value + 1 WHERE name = 'entries';
+END;
+CREATE TRIGGER IF NOT EXISTS scores_delete AFTER DELETE ON scores BEGIN
+    UPDATE counters SET value = value - 1 WHERE name = 'entries';
+END;
+COMMIT;
+"""
+
+
+def default_score_cache_path():
+    """Returns the path of the score cache, which is $WTCH_SCORE_CACHE when set and
+    otherwise ~/.cache/wmb/scores.sqlite.
+    """
+    if "WTCH_SCORE_CACHE" in os.environ:
+        return os.environ["WTCH_SCORE_CACHE"]
+    return os.path.join(os.path.expanduser("~"), ".cache", "wmb", "scores.sqlite")
+
+
+def alignment_digest(fasta_map):
+    """Returns a hex digest of the dictionary fasta_map from taxon names to aligned
+    sequences, which does not depend on the order of the taxa or the FASTA line breaks.
+    """
+    digest = hashlib.sha256()
+    for name in sorted(fasta_map):
+        digest.update(f">{name}\n{fasta_map[name].upper()}\n".encode())
+    return digest.hexdigest()
+
+
+def topology_key(newick):
+    """Returns the cache key of the topology of the Newick string newick."""
+    return to_newick(canonical_topology(newick))
+
+
+def open_score_cache(
+    path=None, max_entries=DEFAULT_MAX_ENTRIES, journal_mode=DEFAULT_JOURNAL_MODE
+):
+    """Returns the ScoreCache at path, by default default_score_cache_path(), creating
+    it if needed. The database uses the SQLite journal_mode, which should only be "WAL"
+    for a cache on local disk.
+    """
+    if path is None:
+        path = default_score_cache_path()
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    connection = sqlite3.connect(path, timeout=600)
+    connection.execute(f"PRAGMA journal_mode={journal_mode}")
+    connection.executescript(_SCHEMA)
+    return ScoreCache(connection, max_entries)
+
+
+def _add_counter(cache, name, amount):
+    cache.connection.execute(
+        "INSERT INTO counters (name, value) VALUES (?, ?) "
+        "ON CONFLICT (name) DO UPDATE SET value = value + excluded.value",
+        (name, amount),
+    )
+
+
+def lookup_scores(cache, digest, model, keys):
+    """Returns a dictionary mapping those of the topology keys that are in cache for
+    the alignment digest and model to their ScoreRecord. The found entries are marked
+    as recently used.
+    """
+    keys = list(dict.fromkeys(keys))
+    records = {}
+    with cache.connection:
+        for start in range(0, len(keys), LOOKUP_BATCH_SIZE):
+            batch = keys[start : start + LOOKUP_BATCH_SIZE]
+            rows = cache.connection.execute(
+                "SELECT topology, optimized_newick, log_likelihood, parsimony_score "
+                "FROM scores WHERE alignment_digest = ? AND model = ? "
+                f"AND topology IN ({','.join('?' * len(batch))})",
+                [digest, model] + batch,
+            )
+            for topology, *record in rows:
+                records[topology] = ScoreRecord(*record)
+        now = time.time_ns()
+        cache.connection.executemany(
+            "UPDATE scores SET last_used = ? "
+            "WHERE alignment_digest = ? AND model = ? AND topology = ?",
+            [(now, digest, model, key) for key in records],
+        )
+        _add_counter(cache, "hits", len(records))
+        _add_counter(cache, "misses", len(keys) - len(records))
+    return records
+
+
+def store_scores(cache, digest, model, records):
+    """Stores the dictionary records from topology keys to ScoreRecords in cache for
+    the alignment digest and model, then evicts the least recently used entries beyond
+    the size cap.
+    """
+    now = time.time_ns()
+    with cache.connection:
+        cache.connection.executemany(
+            # An upsert rather than INSERT OR REPLACE, whose deletions do not fire
+            # the delete trigger.
+            "INSERT INTO scores VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (alignment_digest, model, topology) DO UPDATE SET "
+            "optimized_newick = excluded.optimized_newick, "
+            "log_likelihood = excluded.log_likelihood, "
+            "parsimony_score = excluded.parsimony_score, "
+            "last_used = excluded.last_used",
+            [
+                (digest, model, key) + tuple(record) + (now,)
+                for key, record in records.items()
+            ],
+        )
+    evict_scores(cache)
+
+
+def evict_scores(cache, max_entries=None):
+    """Deletes the least recently used entries of cache beyond max_entries, by default
+    the size cap of cache, returning the number of deleted entries.
+    """
+    if max_entries is None:
+        max_entries = cache.max_entries
+    with cache.connection:
+        (entry_count,) = cache.connection.execute(
+            "SELECT value FROM counters WHERE name = 'entries'"
+        ).fetchone()
+        excess = entry_count - max_entries
+        if excess <= 0:
+            return 0
+        cache.connection.execute(
+            "DELETE FROM scores WHERE rowid IN "
+            "(SELECT rowid FROM scores ORDER BY last_used LIMIT ?)",
+            (excess,),
+        )
+        _add_counter(cache, "evictions", excess)
+    return excess
+
+
+def score_cache_stats(cache):
+    """Returns a dictionary of statistics of cache: the entry count, the entry count of
+    each model and alignment, and the hit, miss and eviction counters.
+    """
+    connection = cache.connection
+    (entry_count,) = connection.execute("SELECT COUNT(*) FROM scores").fetchone()
+    stats = {"entries": entry_count, "max_entries": cache.max_entries}
+    stats.update({name: 0 for name in ["hits", "misses", "evictions"]})
+    stats.update(
+        connection.execute("SELECT name, value FROM counters WHERE name != 'entries'")
+    )
+    stats["entries_by_model"] = {
+        f"{model} {digest[:12]}": count
+        for model, digest, count in connection.execute(
+            "SELECT model, alignment_digest, COUNT(*) FROM scores "
+            "GROUP BY model, alignment_digest ORDER BY model, alignment_digest"
+        )
+    }
+    return stats
@@ -0,0 +1,240 @@
+"""Subsplit DAGs grown one rooted topology at a time.
+
+A clade is a set of taxa, stored as an int bitmask, and a subsplit is an unordered
+pair of disjoint clades, stored as the pair (c, C) of the smaller and the larger
+bitmask. Every node of a rooted binary tree gives a subsplit: an internal node that of
+the clades below its two children, and a leaf that of its clade and the empty clade.
+
+The subsplit DAG (sDAG) of a collection of rooted trees has a node for every subsplit
+of these trees, along with a DAG root whose only clade is the set of all taxa. Its
+edges are the parent-child subsplit pairs (PCSPs) of the trees, along with an edge
+from the DAG root to the subsplit of the root of each tree. These are the nodes and
+edges that bito builds with make_dag. Since trees can be assembled from PCSPs of
+different trees, the sDAG spans more topologies than it was built from: the number of
+trees below a subsplit is the product over its two clades of the sum of the numbers of
+trees below the children on that side. These counts are kept up to date as trees are
+added, recomputing only the ancestors of new edges.
+
+A rooted tree is spanned by the sDAG exactly when all of its PCSPs are edges of the
+sDAG, so which trees of a posterior the sDAG spans is found without listing the trees
+it spans. A SpanIndex keeps, for each tree of the posterior, the number of its PCSPs
+that the sDAG lacks, and for each of these PCSPs, the trees that have it. As the sDAG
+grows, each new PCSP decrements the counts of its trees, and a tree is spanned when its
+count reaches 0. So each tree is parsed once, and only the PCSPs missing from the sDAG
+are kept.
+"""
+
+from array import array
+from collections import namedtuple
+
+import numpy as np
+
+from wmb.newick import parse_newick
+
+# The taxa map taxon names to their bits, children map each subsplit to a dictionary
+# from its clades to the set of the child subsplits on that side, parents map each
+# subsplit to the set of its parent subsplits, and counts map each subsplit to the
+# number of trees below it in the sDAG.
+SubsplitDag = namedtuple("SubsplitDag", ["taxa", "children", "parents", "counts"])
+
+# The pcsp_ids map the PCSPs (P, C) missing from the sDAG to ints, the trees with PCSP
+# j are rows[indptr[j]:indptr[j + 1]], and missing_counts gives the number of PCSPs
+# each tree lacks, or -1 for trees that can never be spanned.
+SpanIndex = namedtuple("SpanIndex", ["pcsp_ids", "indptr", "rows", "missing_counts"])
+
+# The subsplit of the DAG root, whose clade is filled in as taxa are seen.
+DAG_ROOT = None
+
+
+def new_subsplit_dag():
+    """Returns an empty SubsplitDag."""
+    return SubsplitDag({}, {DAG_ROOT: {}}, {DAG_ROOT: set()}, {DAG_ROOT: 0})
+
+
+def _subsplit_of(first, second):
+    return (first, second) if first < second else (second, first)
+
+
+def tree_pcsps(sdag, tree, add_taxa=True):
+    """Returns the list of PCSPs (P, c, C) of the rooted binary tree tree, a nested
+    tuple or Newick string, each giving the parent subsplit P (DAG_ROOT for the root
+    of the tree), the clade c of P that the child subsplit C splits. Taxa not yet in
+    sdag are given new bits, or raise a KeyError if add_taxa is False.
+    """
+    if isinstance(tree, str):
+        tree = parse_newick(tree)
+    pcsps = []
+
+    def subsplit_below(node):
+        """Returns the pair (c, S) of the clade c and the subsplit S of node, after
+        adding the PCSPs below node to pcsps."""
+        if isinstance(node, str):
+            if node not in sdag.taxa:
+                if not add_taxa:
+                    raise KeyError(f"Taxon {node} is not in the subsplit DAG")
+                sdag.taxa[node] = 1 << len(sdag.taxa)
+            clade = sdag.taxa[node]
+            return clade, (0, clade)
+        if len(node) != 2:
+            raise ValueError("A subsplit DAG requires rooted binary trees")
+        (left_clade, left), (right_clade, right) = map(subsplit_below, node)
+        subsplit = _subsplit_of(left_clade, right_clade)
+        pcsps.append((subsplit, left_clade, left))
+        pcsps.append((subsplit, right_clade, right))
+        return left_clade | right_clade, subsplit
+
+    clade, subsplit = subsplit_below(tree)
+    pcsps.append((DAG_ROOT, clade, subsplit))
+    return pcsps
+
+
+def _add_node(sdag, subsplit):
+    if subsplit not in sdag.children:
+        clades = subsplit if subsplit[0] else ()
+        sdag.children[subsplit] = {clade: set() for clade in clades}
+        sdag.parents[subsplit] = set()
+        sdag.counts[subsplit] = 0 if subsplit[0] else 1
+
+
+def _topology_count_below(sdag, subsplit):
+    count = 1
+    for children in sdag.children[subsplit].values():
+        count *= sum(sdag.counts[child] for child in children)
+    return count
+
+
+def add_topology(sdag, tree):
+    """Adds the rooted binary tree tree, a nested tuple or Newick string, to sdag,
+    returning the list of its PCSPs that are new to sdag, as pairs (P, C) of the parent
+    and child subsplits.
+    """
+    pcsps = tree_pcsps(sdag, tree)
+    _, root_clade, _ = pcsps[-1]
+    if any(clade != root_clade for clade in sdag.children[DAG_ROOT]):
+        raise ValueError("The trees of a subsplit DAG must have the same taxa")
+    new_pcsps = []
+    # The PCSPs are in postorder, so in reverse a parent is added before its children.
+    for parent, clade, child in reversed(pcsps):
+        _add_node(sdag, child)
+        children = sdag.children[parent].setdefault(clade, set())
+        if child not in children:
+            children.add(child)
+            sdag.parents[child].add(parent)
+            new_pcsps.append((parent, child))
+    if not new_pcsps:
+        return new_pcsps
+    # Update the counts of the ancestors of the new edges, children first. A child
+    # splits a smaller clade than its parents, and the DAG root splits all taxa.
+    stale = set()
+    pending = [parent for parent, _ in new_pcsps]
+    while pending:
+        subsplit = pending.pop()
+        if subsplit not in stale:
+            stale.add(subsplit)
+            pending.extend(sdag.parents[subsplit])
+
+    def clade_size(subsplit):
+        if subsplit is DAG_ROOT:
+            return len(sdag.taxa) + 1
+        return bin(subsplit[0] | subsplit[1]).count("1")
+
+    for subsplit in sorted(stale, key=clade_size):
+        sdag.counts[subsplit] = _topology_count_below(sdag, subsplit)
+    return new_pcsps
+
+
+def sdag_subsplit_count(sdag):
+    """Returns the number of nodes of sdag, counting its leaves and its DAG root. This
+    need not agree with the node count of bito's dag_summary_statistics.
+    """
+    return len(sdag.children) if len(sdag.children) > 1 else 0
+
+
+def sdag_pcsp_count(sdag):
+    """Returns the number of edges (PCSPs) of sdag, counting those to its leaves and
+    from its DAG root. This need not agree with the edge count of bito's
+    dag_summary_statistics.
+    """
+    return sum(len(subsplits) for subsplits in sdag.parents.values())
+
+
+def sdag_topology_count(sdag):
+    """Returns the number of rooted topologies spanned by sdag."""
+    return sdag.counts[DAG_ROOT]
+
+
+def contains_pcsps(sdag, pcsps):
+    """Returns whether all of the PCSPs pcsps of a tree (see tree_pcsps) are in sdag."""
+    return all(
+        child in sdag.children.get(parent, {}).get(clade, ())
+        for parent, clade, child in pcsps
+    )
+
+
+def contains_topology(sdag, tree):
+    """Returns whether the rooted binary tree tree, a nested tuple or Newick string, is
+    one of the topologies spanned by sdag.
+    """
+    try:
+        pcsps = tree_pcsps(sdag, tree, add_taxa=False)
+    except KeyError:
+        return False
+    return contains_pcsps(sdag, pcsps)
+
+
+def new_span_index(sdag, trees):
+    """Returns the pair (I, S) of the SpanIndex I of the iterable of rooted binary trees
+    trees, nested tuples or Newick strings numbered in order, against sdag, and the
+    int64 array S of the trees that sdag already spans. Trees with taxa that are not in
+    sdag are never spanned.
+    """
+    pcsp_ids = {}
+    ids = array("q")
+    lengths = array("q")
+    missing_counts = array("q")
+    for tree in trees:
+        try:
+            pcsps = tree_pcsps(sdag, tree, add_taxa=False)
+        except KeyError:
+            lengths.append(0)
+            missing_counts.append(-1)
+            continue
+        missing = {
+            (parent, child)
+            for parent, _, child in pcsps
+            if parent not in sdag.parents.get(child, ())
+        }
+        for pcsp in missing:
+            ids.append(pcsp_ids.setdefault(pcsp, len(pcsp_ids)))
+        lengths.append(len(missing))
+        missing_counts.append(len(missing))
+    ids = np.frombuffer(ids, dtype=np.int64)
+    rows = np.repeat(
+        np.arange(len(lengths), dtype=np.uint32), np.frombuffer(lengths, np.int64)
+    )
+    order = np.argsort(ids, kind="stable")
+    indptr = np.zeros(len(pcsp_ids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(ids, minlength=len(pcsp_ids)), out=indptr[1:])
+    missing_counts = np.array(missing_counts, dtype=np.int64)
+    span_index = SpanIndex(pcsp_ids, indptr, rows[order], missing_counts)
+    return span_index, np.flatnonzero(missing_counts == 0)
+
+
+def update_span_index(span_index, new_pcsps):
+    """Updates span_index for the PCSPs new_pcsps just added to its sDAG (see
+    add_topology), returning the int64 array of the trees that are now spanned.
+    """
+    spanned = []
+    for pcsp in new_pcsps:
+        # A PCSP is only new once, so its id is no longer needed.
+        pcsp_id = span_index.pcsp_ids.pop(pcsp, None)
+        if pcsp_id is None:
+            continue
+        rows = span_index.rows[
+            span_index.indptr[pcsp_id] : span_index.indptr[pcsp_id + 1]
+        ]
+        span_index.missing_counts[rows] -= 1
+        spanned.append(rows[span_index.missing_counts[rows] == 0])
+    if not spanned:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(spanned).astype(np.int64)
@@ -0,0 +1,367 @@
+"""Walk the NNI graph of trees by always visiting the best neighbor next.
+
+Vertices are integer ids 0, ..., n-1. The graph is given either as a compressed sparse
+row (CSR) adjacency, where the neighbors of vertex v are indices[indptr[v]:indptr[v+1]]
+and every edge is stored in both directions, or lazily as a function giving the array
+of neighbors of a vertex. The lazy form only computes the neighborhoods of the vertices
+that the walk actually visits.
+
+For graphs too large to build in one process, the edges can be computed in shards of
+rows (see write_edge_shard) and merged into a CSR adjacency on disk (see
+merge_edge_shards), which load_csr memory maps.
+"""
+
+import functools
+import heapq
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+# An edge shard is a flat little-endian uint32 array of vertex id pairs, described by a
+# JSON file next to it. A merged adjacency is a directory of indptr.bin (int64) and
+# indices.bin (uint32), described by meta.json.
+ADJACENCY_FORMAT_VERSION = 1
+EDGE_DTYPE = np.dtype("<u4")
+INDPTR_DTYPE = np.dtype("<i8")
+
+
+def csr_of_edges(edges, vertex_count):
+    """Returns the CSR adjacency (indptr, indices) of the undirected graph on
+    vertex_count vertices with the given edges, a sequence of pairs of vertex ids. The
+    neighbors of each vertex are sorted.
+    """
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    sources = np.concatenate((edges[:, 0], edges[:, 1]))
+    targets = np.concatenate((edges[:, 1], edges[:, 0]))
+    order = np.lexsort((targets, sources))
+    indptr = np.zeros(vertex_count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=vertex_count), out=indptr[1:])
+    return indptr, targets[order]
+
+
+def shard_meta_path_of(shard_path):
+    """Returns the path of the JSON file describing the edge shard at shard_path."""
+    return shard_path + ".json"
+
+
+def _temp_path_next_to(path):
+    """Returns the path of a new empty file in the directory of path, whose permissions
+    follow the umask as those of a file created by open would.
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(prefix=name + ".tmp.", dir=directory)
+    os.close(fd)
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(temp_path, 0o666 & ~umask)
+    return temp_path
+
+
+def write_edge_shard(
+    edge_lists, shard_path, vertex_count, start_row, stop_row, edges_per_write=2**20
+):
+    """Writes the edges of the iterable of edge lists edge_lists to the edge shard
+    shard_path, as they are produced. The shard holds the edges (j,k) with j in
+    range(start_row, stop_row) of a graph on vertex_count vertices, and these row
+    bounds are recorded so that merge_edge_shards can check that no rows are missing.
+    Returns the number of edges written.
+
+    The edges and the JSON file are each written to a temporary file of their own next
+    to them and renamed into place, the edges first, so that neither a crash nor a
+    concurrent job writing the same shard leaves a truncated file.
+    """
+    temp_path = _temp_path_next_to(shard_path)
+    meta_path = shard_meta_path_of(shard_path)
+    temp_meta_path = None
+    try:
+        edge_count = 0
+        buffered_edges = []
+        with open(temp_path, "wb") as out_file:
+            for edge_list in edge_lists:
+                buffered_edges.extend(edge_list)
+                if len(buffered_edges) >= edges_per_write:
+                    out_file.write(np.array(buffered_edges, dtype=EDGE_DTYPE).tobytes())
+                    edge_count += len(buffered_edges)
+                    buffered_edges = []
+            out_file.write(np.array(buffered_edges, dtype=EDGE_DTYPE).tobytes())
+            edge_count += len(buffered_edges)
+        meta = {
+            "format_version": ADJACENCY_FORMAT_VERSION,
+            "vertex_count": vertex_count,
+            "start_row": start_row,
+            "stop_row": stop_row,
+            "edge_count": edge_count,
+        }
+        temp_meta_path = _temp_path_next_to(meta_path)
+        with open(temp_meta_path, "w") as meta_file:
+            json.dump(meta, meta_file, indent=4)
+            meta_file.write("\n")
+        os.replace(temp_path, shard_path)
+        os.replace(temp_meta_path, meta_path)
+    finally:
+        for path in [temp_path, temp_meta_path]:
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+    return edge_count
+
+
+def _load_edge_shard(shard_path):
+    """Returns the meta dictionary and the memory mapped (edge_count x 2) edge array of
+    the edge shard shard_path.
+    """
+    with open(shard_meta_path_of(shard_path)) as meta_file:
+        meta = json.load(meta_file)
+    if meta.get("format_version") != ADJACENCY_FORMAT_VERSION:
+        raise ValueError(f"Unknown edge shard format in {shard_path}")
+    if os.path.getsize(shard_path) != meta["edge_count"] * 2 * EDGE_DTYPE.itemsize:
+        raise ValueError(f"The edge shard {shard_path} does not match its meta")
+    if meta["edge_count"] == 0:
+        return meta, np.zeros((0, 2), dtype=EDGE_DTYPE)
+    edges = np.memmap(
+        shard_path, dtype=EDGE_DTYPE, mode="r", shape=(meta["edge_count"], 2)
+    )
+    return meta, edges
+
+
+def _check_shard_rows(metas):
+    """Returns the vertex count of the edge shards with the given meta dictionaries,
+    raising a ValueError unless they describe the same graph and their row ranges cover
+    every vertex that can have a later neighbor.
+    """
+    vertex_counts = {meta["vertex_count"] for meta in metas}
+    if len(vertex_counts) != 1:
+        raise ValueError(f"Edge shards disagree on the vertex count: {vertex_counts}")
+    (vertex_count,) = vertex_counts
+    covered_row = 0
+    for meta in sorted(metas, key=lambda meta: meta["start_row"]):
+        if meta["start_row"] != covered_row:
+            raise ValueError(
+                f"Edge shards cover rows up to {covered_row} but the next shard "
+                f"starts at row {meta['start_row']}"
+            )
+        covered_row = meta["stop_row"]
+    if covered_row < vertex_count - 1:
+        raise ValueError(
+            f"Edge shards cover rows up to {covered_row} of {vertex_count} vertices"
+        )
+    return vertex_count
+
+
+def merge_edge_shards(shard_paths, adjacency_path, edges_per_chunk=2**22):
+    """Merges the edge shards shard_paths, which together must cover every row of the
+    graph, into a CSR adjacency directory adjacency_path that load_csr memory maps.
+
+    This takes two passes over the shards, reading edges_per_chunk edges at a time: the
+    first counts the degree of every vertex, which gives indptr, and the second places
+    each edge in both directions into the memory mapped indices array. So the memory
+    used is linear in the number of vertices rather than the number of edges. The
+    neighbors of a vertex are not sorted, which does not change the walk.
+    """
+    shards = [_load_edge_shard(shard_path) for shard_path in shard_paths]
+    vertex_count = _check_shard_rows([meta for meta, _ in shards])
+
+    def edge_chunks():
+        for _, edges in shards:
+            for start in range(0, len(edges), edges_per_chunk):
+                yield np.asarray(edges[start : start + edges_per_chunk], dtype=np.int64)
+
+    degrees = np.zeros(vertex_count, dtype=np.int64)
+    for edges in edge_chunks():
+        degrees += np.bincount(edges.ravel(), minlength=vertex_count)
+    indptr = np.zeros(vertex_count + 1, dtype=INDPTR_DTYPE)
+    np.cumsum(degrees, out=indptr[1:])
+
+    temp_path = adjacency_path + ".tmp"
+    shutil.rmtree(temp_path, ignore_errors=True)
+    os.makedirs(temp_path)
+    indptr.tofile(os.path.join(temp_path, "indptr.bin"))
+    index_count = int(indptr[-1])
+    if index_count > 0:
+        indices = np.memmap(
+            os.path.join(temp_path, "indices.bin"),
+            dtype=EDGE_DTYPE,
+            mode="w+",
+            shape=index_count,
+        )
+        next_slot = indptr[:-1].copy()
+        for edges in edge_chunks():
+            sources = np.concatenate((edges[:, 0], edges[:, 1]))
+            targets = np.concatenate((edges[:, 1], edges[:, 0]))
+            order = np.argsort(sources, kind="stable")
+            sources, targets = sources[order], targets[order]
+            vertices, first_positions, counts = np.unique(
+                sources, return_index=True, return_counts=True
+            )
+            ranks = np.arange(len(sources)) - np.repeat(first_positions, counts)
+            indices[next_slot[sources] + ranks] = targets
+            next_slot[vertices] += counts
+        indices.flush()
+        del indices
+    else:
+        open(os.path.join(temp_path, "indices.bin"), "wb").close()
+    meta = {
+        "format_version": ADJACENCY_FORMAT_VERSION,
+        "vertex_count": vertex_count,
+        "edge_count": index_count // 2,
+    }
+    with open(os.path.join(temp_path, "meta.json"), "w") as meta_file:
+        json.dump(meta, meta_file, indent=4)
+        meta_file.write("\n")
+    shutil.rmtree(adjacency_path, ignore_errors=True)
+    os.replace(temp_path, adjacency_path)
+    return adjacency_path
+
+
+def load_csr(adjacency_path):
+    """Returns the CSR adjacency (indptr, indices) written by merge_edge_shards, as
+    read-only memory maps.
+    """
+    with open(os.path.join(adjacency_path, "meta.json")) as meta_file:
+        meta = json.load(meta_file)
+    if meta.get("format_version") != ADJACENCY_FORMAT_VERSION:
+        raise ValueError(f"Unknown adjacency format in {adjacency_path}")
+    indptr = np.memmap(
+        os.path.join(adjacency_path, "indptr.bin"),
+        dtype=INDPTR_DTYPE,
+        mode="r",
+        shape=meta["vertex_count"] + 1,
+    )
+    if meta["edge_count"] == 0:
+        return indptr, np.zeros(0, dtype=EDGE_DTYPE)
+    indices = np.memmap(
+        os.path.join(adjacency_path, "indices.bin"),
+        dtype=EDGE_DTYPE,
+        mode="r",
+        shape=2 * meta["edge_count"],
+    )
+    return indptr, indices
+
+
+def cached_neighbors(neighbors_of):
+    """Returns a version of the neighbor function neighbors_of that computes the
+    neighbors of each vertex only once.
+    """
+    return functools.lru_cache(maxsize=None)(neighbors_of)
+
+
+def max_weight_walk(neighbors_of, weights, start_vertices=(), **budget):
+    """Returns the list of the vertices visited by iter_max_weight_walk."""
+    return list(iter_max_weight_walk(neighbors_of, weights, start_vertices, **budget))
+
+
+def iter_max_weight_walk(
+    neighbors_of,
+    weights,
+    start_vertices=(),
+    max_visit_count=0,
+    max_score_drop=None,
+    tree_bits=None,
+    max_sdag_growth=0,
+):
+    """Yields a list of vertex ids with large weights values. More precisely, the
+    list begins with a vertex of maximal weight, along with the vertices in
+    start_vertices, and each later element of the list has maximal weight among the
+    neighors of all earlier elements. Ties in weight go to the smaller vertex id. The
+    neighbors of a vertex are given by neighbors_of, which is called once per visited
+    vertex.
+
+    The walk stops early once any of the following budgets is used up:
+        max_visit_count: the number of vertices in the list, when positive.
+        max_score_drop: when given, the walk stops rather than visit a vertex whose
+            weight is more than max_score_drop below the maximal weight.
+        max_sdag_growth: when positive, the walk stops after the visit that grows the
+            union of the sDAG nodes of the visited trees for the max_sdag_growth-th
+            time. This requires tree_bits, the bitset matrix with row v for vertex v.
+
+    The frontier is a heap keyed on weight, and a boolean array marks the vertices that
+    have been visited or put on the frontier, so each vertex is pushed at most once.
+    Vertices are yielded as they are visited, so the caller may also stop the walk
+    early by no longer iterating.
+    """
+    weights = np.asarray(weights, dtype=float)
+    vertex_count = len(weights)
+    if vertex_count == 0:
+        return
+    if max_sdag_growth > 0 and tree_bits is None:
+        raise ValueError("An sDAG growth budget requires the tree bitsets")
+    best_vertex = int(np.argmax(weights))
+    min_weight = -np.inf
+    if max_score_drop is not None:
+        min_weight = weights[best_vertex] - max_score_drop
+    start_vertices = [int(v) for v in start_vertices]
+    initial_vertices = [] if best_vertex in start_vertices else [best_vertex]
+    initial_vertices.extend(start_vertices)
+    seen = np.zeros(vertex_count, dtype=np.bool_)
+    seen[initial_vertices] = True
+    frontier = []
+    visit_count = 0
+    sdag_nodes = None if tree_bits is None else np.zeros_like(tree_bits[0])
+    sdag_growth = 0
+
+    def visit(vertex):
+        """Count the visit of vertex, returning whether the walk may continue."""
+        nonlocal visit_count, sdag_nodes, sdag_growth
+        visit_count += 1
+        if sdag_nodes is not None and (tree_bits[vertex] & ~sdag_nodes).any():
+            sdag_nodes = sdag_nodes | tree_bits[vertex]
+            sdag_growth += 1
+        return not (
+            (max_visit_count > 0 and visit_count >= max_visit_count)
+            or (max_sdag_growth > 0 and sdag_growth >= max_sdag_growth)
+        )
+
+    def add_neighbors(vertex):
+        neighbors = np.asarray(neighbors_of(vertex), dtype=np.int64)
+        neighbors = neighbors[~seen[neighbors]]
+        seen[neighbors] = True
+        for weight, neighbor in zip((-weights[neighbors]).tolist(), neighbors.tolist()):
+            heapq.heappush(frontier, (weight, neighbor))
+
+    for vertex in initial_vertices:
+        yield vertex
+        if not visit(vertex):
+            return
+    for vertex in initial_vertices:
+        add_neighbors(vertex)
+    while frontier:
+        negative_weight, vertex = heapq.heappop(frontier)
+        if -negative_weight < min_weight:
+            break
+        yield vertex
+        if not visit(vertex):
+            break
+        add_neighbors(vertex)
+
+
+def csr_neighbors(indptr, indices):
+    """Returns the neighbor function of the graph with CSR adjacency (indptr,
+    indices).
+    """
+    return lambda vertex: indices[indptr[vertex] : indptr[vertex + 1]]
+
+
+def prefix_neighbors(neighbors_of, vertex_count):
+    """Returns the neighbor function of the subgraph induced on the vertices
+    0, ..., vertex_count-1 of the graph with neighbor function neighbors_of. Since the
+    trees are sorted by score, this is the graph of the vertex_count best trees.
+    """
+
+    def neighbors_in_prefix(vertex):
+        neighbors = np.asarray(neighbors_of(vertex))
+        return neighbors[neighbors < vertex_count]
+
+    return neighbors_in_prefix
+
+
+def max_weight_neighbor_traversal(
+    indptr, indices, weights, start_vertices=(), **budget
+):
+    """Runs max_weight_walk on the graph with CSR adjacency (indptr, indices). The
+    keyword arguments budget are the stopping budgets of max_weight_walk.
+    """
+    return max_weight_walk(
+        csr_neighbors(indptr, indices), weights, start_vertices, **budget
+    )
@@ -0,0 +1,158 @@
+"""Cumulative metrics of walks through trees in a common subsplit DAG.
+
+The trees of a walk are compared with the credible set and the posterior by the 128-bit
+hashes of their sets of sDAG nodes (see wmb.representations.sdag_rep_hashes), which
+are looked up in sorted hash arrays rather than by comparing lists of nodes. A tree
+makes the sDAG spanned by the walk bigger when it has a node that no earlier tree of
+the walk has, which is checked against a running bitset of the nodes seen so far, in
+the layout of a row of wmb.representations.
+
+The same metrics can be computed online as a walk visits trees (see walk_metric_rows),
+so that a walk can report them as it goes and stop once they reach a target.
+"""
+
+from collections import namedtuple
+
+import hashlib
+
+import numpy as np
+
+from wmb.representations import (
+    decode_bits_as_sdag_nodes,
+    iter_sdag_rep_batches,
+    pad_words,
+    sdag_rep_hashes,
+    word_count_of,
+)
+
+# The sorted distinct hashes of the valid trees of a representation file, a value per
+# hash, and the number of lines of the file, including those of invalid trees.
+TreeSet = namedtuple("TreeSet", ["hashes", "values", "line_count"])
+
+LINES_PER_BATCH = 2**16
+
+# The cumulative metrics of a walk after each visit, as in the analysis of
+# wtch-investigate-nni-walk.py.
+WALK_METRIC_COLUMNS = [
+    "support_size",
+    "is_cred",
+    "pp",
+    "total_pp",
+    "cred_total",
+    "cred_frac",
+    "bigger_sdag",
+    "sdag_iter",
+]
+
+
+def read_tree_set(rep_path, values=None, lines_per_batch=LINES_PER_BATCH):
+    """Returns the TreeSet of the representation file rep_path, read in batches of
+    lines. The values, one per line of the file, default to 1. When a tree appears on
+    several lines, its value is that of the last one.
+    """
+    hashes = []
+    valid = []
+    for lengths, indices, _, batch_valid in iter_sdag_rep_batches(
+        rep_path, lines_per_batch
+    ):
+        hashes.append(sdag_rep_hashes(lengths, indices)[batch_valid])
+        valid.append(batch_valid)
+    hashes = np.concatenate(hashes) if hashes else np.zeros(0, dtype="S16")
+    valid = np.concatenate(valid) if valid else np.zeros(0, dtype=np.bool_)
+    if values is None:
+        values = np.ones(len(valid))
+    values = np.asarray(values, dtype=float)
+    if len(values) != len(valid):
+        raise ValueError(
+            f"{rep_path} has {len(valid)} trees but {len(values)} values were given"
+        )
+    values = values[valid]
+    # np.unique finds the first of repeated hashes, which in reverse is the last.
+    unique_hashes, last_rows = np.unique(hashes[::-1], return_index=True)
+    return TreeSet(unique_hashes, values[::-1][last_rows], len(valid))
+
+
+def tree_set_lookup(tree_set, hashes):
+    """Returns the pair (F, V) of the boolean array F of whether each of the tree
+    hashes is in the TreeSet tree_set, and the array V of their values, 0 for those
+    that are not.
+    """
+    if len(tree_set.hashes) == 0:
+        return np.zeros(len(hashes), dtype=np.bool_), np.zeros(len(hashes))
+    rows = np.searchsorted(tree_set.hashes, hashes)
+    rows[rows == len(tree_set.hashes)] = 0
+    found = tree_set.hashes[rows] == hashes
+    return found, np.where(found, tree_set.values[rows], 0.0)
+
+
+def new_node_flags(lengths, indices, seen_bits):
+    """Returns the pair (F, S) of the boolean array F of whether each tree of a batch
+    (see sdag_rep_hashes) has an sDAG node that is neither in the bitset row seen_bits
+    nor in an earlier tree of the batch, and the bitset row S of seen_bits and the
+    nodes of the batch.
+    """
+    indices = np.asarray(indices, dtype=np.int64)
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    if len(indices):
+        seen_bits = pad_words(seen_bits, word_count_of(int(indices.max()) + 1))
+    words = indices >> 6
+    shifts = (indices & 63).astype(np.uint64)
+    unseen = ((seen_bits[words] >> shifts) & np.uint64(1)) == 0
+    # The nodes are listed tree by tree, so the first entry of a node is in the first
+    # tree of the batch that has it.
+    _, first_entries = np.unique(indices[unseen], return_index=True)
+    flags = np.zeros(len(lengths), dtype=np.bool_)
+    flags[rows[unseen][first_entries]] = True
+    seen_bits = seen_bits.copy()
+    np.bitwise_or.at(seen_bits, words, np.left_shift(np.uint64(1), shifts))
+    return flags, seen_bits
+
+
+def bits_row_hash(bits_row):
+    """Returns the hash of the sDAG nodes of the bitset row bits_row, as given by
+    sdag_rep_hashes for the same nodes.
+    """
+    nodes = np.array(decode_bits_as_sdag_nodes(bits_row), dtype="<u4")
+    return hashlib.blake2b(nodes.tobytes(), digest_size=16).digest()
+
+
+def walk_metric_rows(vertices, tree_bits, credible=None, pp_set=None):
+    """Yields the pair (v, M) for each vertex v of the iterable vertices of a walk, as
+    they come, where M is the list of the metrics of the walk up to v, in the order of
+    WALK_METRIC_COLUMNS. The tree of vertex v is row v of the bitset matrix tree_bits.
+    Credible membership comes from the TreeSet credible and pp from the TreeSet pp_set,
+    and without them no tree is credible, cred_frac is NaN, and pp is 0.
+    """
+    seen_bits = np.zeros(tree_bits.shape[1], dtype=np.uint64)
+    total_pp = 0.0
+    cred_total = 0
+    sdag_iter = 0
+    for support_size, vertex in enumerate(vertices, 1):
+        bits_row = tree_bits[vertex]
+        is_cred = False
+        pp = 0.0
+        if credible is not None or pp_set is not None:
+            tree_hash = np.array([bits_row_hash(bits_row)], dtype="S16")
+            if credible is not None:
+                is_cred = bool(tree_set_lookup(credible, tree_hash)[0][0])
+            if pp_set is not None:
+                pp = float(tree_set_lookup(pp_set, tree_hash)[1][0])
+        total_pp += pp
+        cred_total += is_cred
+        bigger_sdag = bool((bits_row & ~seen_bits).any())
+        if bigger_sdag:
+            seen_bits |= bits_row
+            sdag_iter += 1
+        cred_frac = np.nan
+        if credible is not None and credible.line_count > 0:
+            cred_frac = cred_total / credible.line_count
+        yield vertex, [
+            support_size,
+            is_cred,
+            pp,
+            total_pp,
+            cred_total,
+            cred_frac,
+            bigger_sdag,
+            sdag_iter,
+        ]